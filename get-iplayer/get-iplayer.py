@@ -20,15 +20,21 @@
 
 import totem
 import gobject
-import urllib2
 import gtk
 import gconf
 import threading
 import subprocess
 import re
 import os
-from collections import defaultdict
-from getiplayer_interface import GetIPlayer, combine_modes
+import sys
+import urllib
+from collections import OrderedDict, deque
+from getiplayer_interface import GetIPlayer, IO_REACTOR, combine_modes
+from getiplayer_thumbnails import ThumbnailCache
+from getiplayer_recordings import RecordingQueue
+from getiplayer_prefetch import Prefetcher
+from getiplayer_instrumentation import INSTRUMENTATION
+from getiplayer_mainloop import MAIN_LOOP, idle_add, timeout_add
 
 IDX_TITLE = 0
 IDX_DISPLAY = 1
@@ -47,6 +53,27 @@ GCONF_KEY = "/apps/totem/plugins/get-iplayer"
 AVAILABLE_FILTERS = ["channel", "category", "type", "version"]
 DEFAULT_FILTERS = ["type", "channel", "category"]
 
+INFO_DEBOUNCE_MS = 150 # Wait this long after the selection settles before loading programme information
+
+THUMBNAIL_CACHE_DIR = "~/.totem-get-iplayer/thumbnails"
+THUMBNAIL_WIDTH = 150
+THUMBNAIL_HEIGHT = 100
+
+RECORDING_QUEUE_FILE = "~/.totem-get-iplayer/recordings.json"
+RECORDING_PROGRESS_MS = 1000 # How often the progress of running recordings is updated
+
+PREFETCH_DEBOUNCE_MS = 300 # Wait this long after the tree stops changing before prefetching what is on screen
+PREFETCH_MAX_PROGRAMMES = 40 # Most programmes on screen to prefetch
+
+TREE_BATCH_ROWS = 200 # Most rows to add to the programme tree in one idle callback
+
+STATS_ENV = "TOTEM_GETIPLAYER_STATS" # Set to a number of seconds to print call timings that often
+MAINLOOP_ENV = "TOTEM_GETIPLAYER_MAINLOOP" # Set to a number of milliseconds to profile main loop callbacks, logging any that run longer
+
+def file_uri(location):
+	'''A file:// URI for a local path, escaped so names with spaces or # can be played.'''
+	return "file://" + urllib.pathname2url(os.path.abspath(location))
+
 class TreeValues(object):
 	def __init__(self, title, loading_node=False, loaded=False, prog_idx=-1, info_type=None):
 		self.title = title
@@ -72,12 +99,24 @@ class GetIplayerPlugin (totem.Plugin):
 		totem.Plugin.__init__ (self)
 		self.totem = None
 		self.showing_info = None
+		self._info_loading = [] # Anything loading for the info panel, which we cancel when it changes programme
+		self._info_timeout_id = None
+		self._modes_loading = None
 		self._mode_callback_id = None
 		self.has_sidebar = False
 		self.current_search = None
 		self._current_search_input = None
 		self.gip = None
+		self.thumbnails = ThumbnailCache(os.path.expanduser(THUMBNAIL_CACHE_DIR))
+		self._tree_generation = 0 # Changes whenever the programme tree is rebuilt, so old loads know they are not needed
 		self._is_starting_stream = False # Used when a file is closed to figure out when to avoid killing a stream
+		self._history_series = {} # Series name : row in the history pane
+		self._history_rows = {} # Recording location : row in the history pane
+		self._history_recording_row = None # The "Currently Recording" branch, if shown
+		self._history_recording_jobs = [] # Ids of the jobs shown in it, in order
+		self._recording_progress_id = None # Timeout updating the recordings' progress, while any are running
+		self.prefetcher = None
+		self._prefetch_timeout_id = None
 
 	def activate (self, totem_object):
 		# Build the interface
@@ -91,6 +130,9 @@ class GetIplayerPlugin (totem.Plugin):
 		self._ui_progs_list.connect("row-expanded", self._row_expanded_cb)
 		self._ui_progs_list.get_selection().connect("changed", self._row_selection_changed_cb)
 		self._ui_progs_list.connect("row-activated", self._row_activated_cb)
+		self._ui_progs_list.connect("row-collapsed", self._schedule_prefetch)
+		if self._ui_progs_list.get_vadjustment() is not None:
+			self._ui_progs_list.get_vadjustment().connect("value-changed", self._schedule_prefetch)
 		self._ui_progs_refresh = builder.get_object("getiplayer_progs_refresh")
 		self._ui_progs_refresh.connect("clicked", self._refresh_clicked_cb)
 
@@ -124,16 +166,37 @@ class GetIplayerPlugin (totem.Plugin):
 
 		self.config = Configuration(builder, self.attach_getiplayer)
 		self.totem = totem_object
+		self.recording_queue = RecordingQueue(os.path.expanduser(RECORDING_QUEUE_FILE), onchange=self._recording_changed)
 
 		self.totem.connect("file-closed", self._file_closed_cb)
 
+		stats_interval = os.environ.get(STATS_ENV)
+		dump_interval = None
+		if stats_interval:
+			try:
+				dump_interval = float(stats_interval)
+				INSTRUMENTATION.enable(dump_interval, IO_REACTOR)
+			except ValueError:
+				sys.stderr.write("%s should be a number of seconds, not %r\n" % (STATS_ENV, stats_interval))
+		stall_ms = os.environ.get(MAINLOOP_ENV)
+		if stall_ms:
+			try:
+				MAIN_LOOP.enable(float(stall_ms) / 1000, dump_interval, IO_REACTOR)
+			except ValueError:
+				sys.stderr.write("%s should be a number of milliseconds, not %r\n" % (MAINLOOP_ENV, stall_ms))
+
 		self.attach_getiplayer()
 
 	def deactivate (self, totem_object):
 		totem_object.remove_sidebar_page ("get-iplayer")
 		self.has_sidebar = False
+		self.recording_queue.close()
+		if self.prefetcher is not None:
+			self.prefetcher.cancel()
 		if self.gip is not None:
 			self.gip.close()
+		self.thumbnails.close()
+		MAIN_LOOP.disable()
 
 	def attach_getiplayer(self):
 		location_correct = False
@@ -142,6 +205,10 @@ class GetIplayerPlugin (totem.Plugin):
 			flvstreamerloc = self.config.config_flvstreamer_location or which("rtmpdump") or which("flvstreamer")
 			ffmpegloc = self.config.config_ffmpeg_location or which("ffmpeg")
 			localfiles_dirs = self.config.config_localfiles_directories
+			self.recording_queue.close() # Recordings stopped by closing are run again once attached
+			if self.prefetcher is not None:
+				self.prefetcher.cancel()
+				self.prefetcher = None
 			if self.gip is not None:
 				self.gip.close()
 			try:
@@ -149,6 +216,10 @@ class GetIplayerPlugin (totem.Plugin):
 			except OSError: pass
 			else:
 				location_correct = True
+				self.prefetcher = Prefetcher(self.gip, self.thumbnails, (THUMBNAIL_WIDTH, THUMBNAIL_HEIGHT))
+				self.recording_queue.max_running = self.config.config_max_recordings
+				self.recording_queue.bandwidth = self.config.config_recording_bandwidth * 1024 or None
+				self.recording_queue.attach(self.gip)
 
 		# Add the interface to Totem's sidebar only if get_iplayer is accessible, otherwise show error
 		if not location_correct:
@@ -157,6 +228,11 @@ class GetIplayerPlugin (totem.Plugin):
 		return location_correct
 
 	def _reset_progtree(self):
+		self._tree_generation += 1
+		if self.prefetcher is not None:
+			self.prefetcher.cancel()
+		if self.gip is not None:
+			self.gip.scheduler.drop_irrelevant()
 		if self.has_sidebar:
 			self._ui_progs_list.get_model().clear()
 			self._populate_filter_level(self._ui_progs_list, None)
@@ -217,6 +293,22 @@ class GetIplayerPlugin (totem.Plugin):
 				open_iter = treemodel.iter_children(open_iter)
 			else:
 				open_iter = None
+		self._schedule_prefetch()
+
+	def _schedule_prefetch(self, *args):
+		'''Prefetch the programmes on screen once the tree settles, if prefetching is turned on.'''
+		if not self.config.config_prefetch or self.prefetcher is None:
+			return
+		if self._prefetch_timeout_id is not None:
+			gobject.source_remove(self._prefetch_timeout_id)
+		self._prefetch_timeout_id = timeout_add(PREFETCH_DEBOUNCE_MS, self._prefetch_visible)
+
+	def _prefetch_visible(self):
+		self._prefetch_timeout_id = None
+		if self.prefetcher is not None:
+			indices = visible_programmes(self._ui_progs_list, PREFETCH_MAX_PROGRAMMES)
+			self.prefetcher.prefetch(indices, self.config.config_preferred_version)
+		return False
 
 	def _row_selection_changed_cb(self, selection):
 		treestore, branch = selection.get_selected()
@@ -229,6 +321,17 @@ class GetIplayerPlugin (totem.Plugin):
 		if index != -1:
 			self.play_programme(index)
 
+	def _play_local_copy(self, index, name=None, version=None):
+		'''Play a recording of the programme if there is one, returning whether there was.'''
+		local = self.gip.find_local_copy(index, version, self.config.config_preferred_version)
+		if local is None:
+			return False
+		location, series, episode = local
+		if name is None:
+			name = series + " - " + episode
+		idle_add(self.totem.add_to_playlist_and_play, file_uri(location), name, True) # Can be called from a callback thread
+		return True
+
 	def _refresh_clicked_cb(self, button):
 		self._ui_container.set_sensitive(False)
 		oldbuttontt = button.get_tooltip_text()
@@ -237,7 +340,7 @@ class GetIplayerPlugin (totem.Plugin):
 			button.set_tooltip_text(oldbuttontt)
 			self._ui_container.set_sensitive(True)
 			self.reset_ui(True)
-		self.gip.refresh_cache(False).on_complete(lambda _: gobject.idle_add(refresh_complete), self.show_errors("refreshing"))
+		self.gip.refresh_cache(False).on_complete(lambda _: idle_add(refresh_complete), self.show_errors("refreshing"))
 
 	def _record_clicked_cb(self, button):
 		if self.showing_info is None:
@@ -250,18 +353,13 @@ class GetIplayerPlugin (totem.Plugin):
 		mode = self._ui_mode_list.get_model().get_value(selected_mode, 0)
 		if not mode:
 			return # Loading
-		def on_recording_fail(errs):
-			self.show_errors("recording")(errs)
-			self._populate_history()
-		self.gip.record_programme(
-			self.showing_info,
-			None,
-			version,
-			mode
-		).on_complete(
-			lambda _: self._populate_history(),
-			on_recording_fail
-		)
+		self.recording_queue.add(self.showing_info, None, version, mode)
+
+	def _recording_changed(self, job):
+		if job["state"] == "failed":
+			self.show_errors("recording")(job["errors"])
+		elif job["state"] == "running":
+			idle_add(self._watch_recording_progress)
 		self._populate_history()
 
 	def _play_clicked_cb(self, button):
@@ -283,16 +381,32 @@ class GetIplayerPlugin (totem.Plugin):
 		Give this the correct information and it will play a programme.
 		With the wrong information it will try and fail somewhere in the streaming.
 		Give no information and it will work it out if it can...
+		A programme that has already been recorded is played from disk, without get_iplayer being run at all.
 		'''
+		if self._play_local_copy(index, name, version):
+			return
 		if name is None or version is None:
+			early_streams = None
+			if version is None and mode is None and self.config.config_fast_start:
+				# Most programmes have the preferred version, so find its streams while the info is being fetched.
+				# Choosing a mode below then picks up this query rather than starting another.
+				early_streams = self.gip.get_stream_info(index, self.config.config_preferred_version)
+			def let_go_of_early_streams():
+				if early_streams is not None:
+					early_streams.cancel() # Only stops the query if nothing else is waiting on it
 			def got_info(info):
 				newname = name if name is not None else "%s - %s" % (info.get("name", "Unknown name"), info.get("episode", ""))
 				if version is None and self.config.config_preferred_version not in info.get("versions", "").split(","):
+					let_go_of_early_streams()
 					self.totem.action_error("Get iPlayer", "Preferred version not found for programme %s." % index)
 					return
 				newversion = version if version is not None else self.config.config_preferred_version
 				self.play_programme(index, name=newname, version=newversion, mode=mode)
-			self.gip.get_programme_info(index).on_complete(got_info, self.show_errors("trying to play programme"))
+				let_go_of_early_streams()
+			def info_failed(errs):
+				let_go_of_early_streams()
+				self.show_errors("trying to play programme")(errs)
+			self.gip.get_programme_info(index).on_complete(got_info, info_failed)
 			return
 		if mode is None:
 			def got_streams(streams):
@@ -306,9 +420,18 @@ class GetIplayerPlugin (totem.Plugin):
 			return
 
 		self._is_starting_stream = True # Next file close will not kill the main stream
-		fd, streamresult = self.gip.stream_programme_to_pipe(index, version, mode)
+		if self.config.config_record_while_watching:
+			url, recorded = self.gip.stream_and_record_programme(index, name, version, mode, http=self.config.config_stream_over_http)
+			self.recording_queue.track(index, name, version, mode, recorded) # Shown with the others, and run again if interrupted
+			idle_add(self.totem.add_to_playlist_and_play, url, name, False)
+			return
+		if self.config.config_stream_over_http:
+			url, streamresult = self.gip.stream_programme_to_http(index, version, mode)
+		else:
+			fd, streamresult = self.gip.stream_programme_to_pipe(index, version, mode, self.config.config_stream_buffer * 1024)
+			url = "fd://%s" % fd
 		streamresult.on_complete(onerror=self.show_errors("playing programme"))
-		gobject.idle_add(self.totem.add_to_playlist_and_play, "fd://%s" % fd, name, False)
+		idle_add(self.totem.add_to_playlist_and_play, url, name, False)
 
 
 	def _version_selected_cb(self, version_list, index, info):
@@ -347,7 +470,14 @@ class GetIplayerPlugin (totem.Plugin):
 				self._ui_mode_list.set_active(0)
 			self._ui_mode_list.set_sensitive(True)
 
-		self.gip.get_stream_info(index, version).on_complete(lambda modes: gobject.idle_add(got_modes, modes, version), self.show_errors("retrieving modes"))
+		if self._modes_loading is not None:
+			self._modes_loading.cancel() # Only interested in the version now selected
+		self._modes_loading = self.gip.get_stream_info(
+			index,
+			version,
+			relevant=lambda: self.showing_info == index
+		)
+		self._modes_loading.on_complete(lambda modes: idle_add(got_modes, modes, version), self.show_errors("retrieving modes"))
 
 	def _mode_selected_cb(self, mode_list):
 		mode_iter = mode_list.get_active_iter()
@@ -366,7 +496,7 @@ class GetIplayerPlugin (totem.Plugin):
 		episode = treemodel.get_value(iter, IDXH_NAME)
 		series = treemodel.get_value(treemodel.iter_parent(iter), IDXH_NAME)
 		name = series + " - " + episode
-		self.totem.add_to_playlist_and_play("file://" + file, name, True)
+		self.totem.add_to_playlist_and_play(file_uri(file), name, True)
 
 	def _history_keypress_cb(self, treeview, event):
 		if "Delete" != gtk.gdk.keyval_name(event.keyval):
@@ -399,9 +529,11 @@ class GetIplayerPlugin (totem.Plugin):
 			childiter = treemodel.iter_children(treeiter)
 			while childiter is not None:
 				os.remove(treemodel.get_value(childiter, IDXH_LOCATION))
+				self.gip.recording_deleted(treemodel.get_value(childiter, IDXH_LOCATION))
 				childiter = treemodel.iter_next(childiter)
 		else:
 			os.remove(file)
+			self.gip.recording_deleted(file)
 		self._populate_history()
 
 		return True
@@ -433,57 +565,128 @@ class GetIplayerPlugin (totem.Plugin):
 		populate = load_branch(progs_list, branch)
 		if populate is None:
 			return
-		def got_filters(filters):
-			populate([(TreeValues(f, info_type=populating), []) for f in filters])
-
+		def children(levels):
+			filter_type, filters = levels[0]
+			if len(levels) == 1:
+				return [(TreeValues(f, info_type=filter_type), []) for f in filters]
+			# A single value whose own level is already known, so it is added loaded and expanding it costs nothing
+			return [(TreeValues(filters[0], loaded=True, info_type=filter_type), children(levels[1:]))]
+		def got_levels(levels):
+			populate(children(levels))
+
+		# The levels below are worked out too while each has only one value, as they will be expanded straight away
 		active_filters = self._active_filters(progs_store, branch)
-		self.gip.get_filters_and_blanks(
-			populating,
+		self.gip.get_filter_cascade(
+			self.config.config_filter_order[populate_depth:],
 			self.current_search,
+			relevant=self._tree_relevance(),
 			**active_filters
 		).on_complete(
-			got_filters,
+			got_levels,
 			self.show_errors_and_cancel_populate(populate, populating)
 		)
 
 	def _populate_series_and_episodes(self, progs_list, branch):
-		populate = load_branch(progs_list, branch)
-		if populate is None:
+		loader = load_branch_in_batches(progs_list, branch)
+		if loader is None:
 			return
+		add, finish = loader
+		streamed = set() # Series already added as get_iplayer's output arrived
+		def series_node(s, eps):
+			return (TreeValues(s, info_type="series"), [(TreeValues(ep[1], prog_idx=ep[0], info_type="episode"), None) for ep in eps])
+		def got_series(s, eps):
+			streamed.add(s)
+			add([series_node(s, eps)])
 		def got_episodes(series):
-			populate([
-				(TreeValues(s, info_type="series"), [(TreeValues(ep[1], prog_idx=ep[0], info_type="episode"), None) for ep in eps])
-				for s, eps in series.iteritems()
-			])
+			finish([series_node(s, eps) for s, eps in series.iteritems() if s not in streamed])
+			idle_add(self._schedule_prefetch)
 		active_filters = self._active_filters(progs_list.get_model(), branch)
 		self.gip.get_episodes(
 			self.current_search,
+			relevant=self._tree_relevance(),
+			onseries=got_series,
 			**active_filters
 		).on_complete(
 			got_episodes,
-			self.show_errors_and_cancel_populate(populate, "programme")
+			self.show_errors_and_cancel_populate(finish, "programme")
 		)
 
+	def _tree_relevance(self):
+		'''Creates a function telling whether a load started now is still wanted by the programme tree.'''
+		generation = self._tree_generation
+		return lambda: generation == self._tree_generation
+
 	def _populate_history(self):
 		def populate_store(history):
-			self._ui_history_pane.hide_all()
 			historystore = self._ui_history_list.get_model()
-			historystore.clear()
-			if self.gip.recordings.values():
-				recording_branch = historystore.append(None, [-1, "Currently Recording", "", "", ""])
-				for name, version, mode in self.gip.recordings.values():
-					historystore.append(recording_branch, [-1, name + " (Recording...)", version, mode, ""])
-			by_series = defaultdict(list)
-			for index, series, episode, version, mode, location in history:
-				by_series[series].append((index, episode, version, mode, location))
-			for series, episodes in by_series.iteritems():
-				series_branch = historystore.append(None, [-1, series, "", "", ""])
-				for index, episode, version, mode, location in episodes:
-					historystore.append(series_branch, [index, episode, version, mode, location])
+			self._show_recordings()
+
+			# Only change the rows that differ from what is shown, rather than rebuilding the whole store
+			wanted = OrderedDict((location, (index, series, episode, version, mode)) for index, series, episode, version, mode, location in history)
+			for location in [location for location in self._history_rows if location not in wanted]:
+				row = self._history_rows.pop(location)
+				if row.valid():
+					series_iter = historystore.iter_parent(historystore.get_iter(row.get_path()))
+					historystore.remove(historystore.get_iter(row.get_path()))
+					if not historystore.iter_has_child(series_iter):
+						del self._history_series[historystore.get_value(series_iter, IDXH_NAME)]
+						historystore.remove(series_iter)
+			for location, (index, series, episode, version, mode) in wanted.iteritems():
+				if location in self._history_rows:
+					continue
+				series_row = self._history_series.get(series)
+				if series_row is None:
+					series_iter = historystore.append(None, [-1, series, "", "", ""])
+					self._history_series[series] = gtk.TreeRowReference(historystore, historystore.get_path(series_iter))
+				else:
+					series_iter = historystore.get_iter(series_row.get_path())
+				episode_iter = historystore.append(series_iter, [index, episode, version, mode, location])
+				self._history_rows[location] = gtk.TreeRowReference(historystore, historystore.get_path(episode_iter))
+
 			if historystore.get_iter_root() is not None:
 				self._ui_history_pane.show_all()
+			else:
+				self._ui_history_pane.hide_all()
 
-		self.gip.get_history().on_complete(lambda history: gobject.idle_add(populate_store, history), self.show_errors("retrieving recordings"))
+		self.gip.get_history().on_complete(lambda history: idle_add(populate_store, history), self.show_errors("retrieving recordings"))
+
+	def _show_recordings(self):
+		'''
+		Show queued and running recordings in the history pane, with how they are getting on.
+		The rows are updated in place while the same jobs are there, so the branch stays as the user left it.
+		Returns whether anything is recording.
+		'''
+		historystore = self._ui_history_list.get_model()
+		jobs = self.recording_queue.jobs()
+		job_ids = [job["id"] for job in jobs]
+		branch = self._history_recording_row
+		if branch is not None and branch.valid() and job_ids == self._history_recording_jobs:
+			child = historystore.iter_children(historystore.get_iter(branch.get_path()))
+			for job in jobs:
+				historystore.set_value(child, IDXH_NAME, recording_label(job))
+				child = historystore.iter_next(child)
+		else:
+			if branch is not None and branch.valid():
+				historystore.remove(historystore.get_iter(branch.get_path()))
+			self._history_recording_row = None
+			if jobs:
+				recording_branch = historystore.prepend(None, [-1, "Currently Recording", "", "", ""])
+				self._history_recording_row = gtk.TreeRowReference(historystore, historystore.get_path(recording_branch))
+				for job in jobs:
+					historystore.append(recording_branch, [-1, recording_label(job), job["version"], job["mode"], ""])
+			self._history_recording_jobs = job_ids
+		return any(job["state"] == "running" for job in jobs)
+
+	def _watch_recording_progress(self):
+		'''Keep the recordings' progress up to date while any are running.'''
+		if self._recording_progress_id is not None:
+			return
+		def update():
+			if self._show_recordings():
+				return True
+			self._recording_progress_id = None
+			return False
+		self._recording_progress_id = timeout_add(RECORDING_PROGRESS_MS, update)
 
 	def _convert_search_terms(self, terms):
 		st = self.config.config_search_type
@@ -511,6 +714,8 @@ class GetIplayerPlugin (totem.Plugin):
 	def _load_info(self, index):
 		'''Loads information for a particular programme.'''
 		self.showing_info = index
+		self._cancel_info_loading()
+		self.gip.scheduler.drop_irrelevant()
 
 		# First show a loading page
 		def prepare_loading():
@@ -534,7 +739,7 @@ class GetIplayerPlugin (totem.Plugin):
 			self._ui_play.set_sensitive(False)
 			self._ui_record.set_sensitive(False)
 			self._ui_programme_info.show_all()
-		gobject.idle_add(prepare_loading)
+		idle_add(prepare_loading)
 
 		if index is None:
 			return
@@ -585,12 +790,12 @@ class GetIplayerPlugin (totem.Plugin):
 			else:
 				self._ui_version_list.set_active(0)
 
-			# Need to load image on another thread
+			# Shown straight away if we have seen it recently, otherwise loaded on another thread
 			thumb = info.get("thumbnail")
 			if thumb:
-				load_image_in_background(self._ui_thumb, thumb,
-					cancelcheck=lambda: self.showing_info != index,
-					transform=lambda pb: ensure_image_small(pb, 150, 100))
+				self._info_loading.append(self.thumbnails.load_into(self._ui_thumb, thumb,
+					THUMBNAIL_WIDTH, THUMBNAIL_HEIGHT,
+					cancelcheck=lambda: self.showing_info != index))
 
 		def on_fail(errs):
 			self._ui_programme_info.hide_all()
@@ -599,13 +804,34 @@ class GetIplayerPlugin (totem.Plugin):
 		def finished(result, errs):
 			if len(errs) == 1 and errs[0].startswith("WARNING: No programmes are available for this pid"):
 				errs = [] # Programme has expired
-				result["hasexpired"] = True
+				result = dict(result, hasexpired=True)
 			if errs:
-				gobject.idle_add(on_fail, errs)
+				idle_add(on_fail, errs)
 			else:
-				gobject.idle_add(got_info, result)
+				idle_add(got_info, result)
 
-		self.gip.get_programme_info(index).on_complete(always=finished)
+		def start_loading():
+			self._info_timeout_id = None
+			if self.showing_info != index:
+				return False
+			info = self.gip.get_programme_info(index, relevant=lambda: self.showing_info == index)
+			self._info_loading.append(info.cancel)
+			info.on_complete(always=finished)
+			return False
+		# Wait for the selection to settle, so scrolling through the list does not start a process for every row
+		self._info_timeout_id = timeout_add(INFO_DEBOUNCE_MS, start_loading)
+
+	def _cancel_info_loading(self):
+		'''Stop loading anything for the programme previously shown in the info panel.'''
+		if self._info_timeout_id is not None:
+			gobject.source_remove(self._info_timeout_id)
+			self._info_timeout_id = None
+		if self._modes_loading is not None:
+			self._modes_loading.cancel()
+			self._modes_loading = None
+		for cancel in self._info_loading:
+			cancel()
+		self._info_loading = []
 
 	def show_errors(self, activity=None):
 		'''Creates a function that can display a list of errors.'''
@@ -621,14 +847,14 @@ class GetIplayerPlugin (totem.Plugin):
 			)
 			dlg.run()
 			dlg.destroy()
-		return lambda errs: gobject.idle_add(show_errs, errs)
+		return lambda errs: idle_add(show_errs, errs)
 
 	def show_errors_and_cancel_populate(self, populate, activity=None):
 		title = "Failed to load"
 		if activity is not None:
 			title += " %ss" % (activity,)
 		def pop_and_show(errs):
-			gobject.idle_add(populate, [(TreeValues(title, loaded=True), [])])
+			idle_add(populate, [(TreeValues(title, loaded=True), [])])
 			self.show_errors("populating %ss" % (activity,))(errs)
 		return pop_and_show
 
@@ -645,6 +871,36 @@ def is_branch_loading(treestore, branch_iter):
 		return False
 	return treestore.get_value(treestore.iter_children(branch_iter), IDX_LOADING_NODE)
 
+def next_visible_row(tree, row):
+	'''The row shown after row in a tree view, going into expanded branches, or None at the end.'''
+	treestore = tree.get_model()
+	if treestore.iter_has_child(row) and tree.row_expanded(treestore.get_path(row)):
+		return treestore.iter_children(row)
+	while row is not None:
+		following = treestore.iter_next(row)
+		if following is not None:
+			return following
+		row = treestore.iter_parent(row)
+	return None
+
+def visible_programmes(tree, limit):
+	'''Indices of the programmes in the rows of a tree view that are on screen, in order, at most limit of them.'''
+	visible = tree.get_visible_range()
+	if visible is None:
+		return []
+	start, end = visible
+	treestore = tree.get_model()
+	indices = []
+	row = treestore.get_iter(start)
+	while row is not None and len(indices) < limit:
+		index = treestore.get_value(row, IDX_PROGRAMME_INDEX)
+		if index != -1:
+			indices.append(index)
+		if treestore.get_path(row) == end:
+			break
+		row = next_visible_row(tree, row)
+	return indices
+
 def load_branch(tree, branch_iter, force=False):
 	'''Start loading a branch, return either a function to call on load completion or None if it is already loading.'''
 	treestore = tree.get_model()
@@ -665,7 +921,7 @@ def load_branch(tree, branch_iter, force=False):
 		if expansion_state is not None:
 			if expansion_state: tree.expand_row(branch_path, False)
 			else: tree.collapse_row(branch_path)
-	gobject.idle_add(start_load)
+	idle_add(start_load)
 
 	def populate(children):
 		'''
@@ -703,47 +959,97 @@ def load_branch(tree, branch_iter, force=False):
 			if expansion_state: tree.expand_row(branch_path, False)
 			else: tree.collapse_row(branch_path)
 		return False
-	return lambda children: gobject.idle_add(populate, children)
+	return lambda children: idle_add(populate, children)
+
+def load_branch_in_batches(tree, branch_iter):
+	'''
+	Start loading a branch whose children arrive a few at a time, they are added in small batches while idle.
+	Returns functions (add, finish) or None if it is already loading. add(children) adds more children,
+	finish(children) adds the last of them. Children are in the same form as for load_branch.
+	'''
+	treestore = tree.get_model()
+	if is_branch_loaded(treestore, branch_iter) or is_branch_loading(treestore, branch_iter):
+		return None
+	load_branch(tree, branch_iter) # Shows the loading node until the first batch
+	branch_path = None if branch_iter is None else treestore.get_path(branch_iter)
 
-def load_image_in_background(image, imageurl, cancelcheck=None, transform=None):
-	def on_complete(pb):
-		if pb is None or cancelcheck is None or cancelcheck():
-			return
-		image.set_from_pixbuf(pb)
+	lock = threading.Lock()
+	pending = deque() # Rows still to be added as (key, parent's key or None for the branch, tree values, subchildren)
+	parents = {} # Key : iter for rows with children, tree store iters stay valid while the row exists
+	state = {"scheduled": False, "started": False, "finished": False, "abandoned": False}
+
+	def get_branch():
+		return None if branch_path is None else treestore.get_iter(branch_path)
+
+	def start(branch_iter):
+		'''Swap the loading node out for the first real children, unless the branch has been reloaded since.'''
+		if not is_branch_loading(treestore, branch_iter):
+			return False
+		expanded = branch_path is not None and tree.row_expanded(branch_path)
+		treestore.remove(treestore.iter_children(branch_iter))
+		if branch_iter is not None:
+			treestore.set_value(branch_iter, IDX_HAS_LOADED, True)
+		state["expanded"] = expanded
+		return True
 
-	def load_image():
-		pb = None
+	def add_batch():
 		try:
-			response = urllib2.urlopen(imageurl)
-			loader = gtk.gdk.PixbufLoader()
-			loader.write(response.read())
-			loader.close()
-			pb = loader.get_pixbuf()
-		except:
-			pass
-		if pb is not None and transform is not None:
-			pb = transform(pb)
-		gobject.idle_add(on_complete, pb)
-	threading.Thread(target=load_image).start()
-
-def ensure_image_small(pb, max_width, max_height):
-	width = pb.get_width()
-	height = pb.get_height()
-	resize = False
-	if width > max_width:
-		resize = True
-		height *= float(max_width)/float(width)
-		height = int(height)
-		width = max_width
-	if height > max_height:
-		resize = True
-		width *= float(max_height)/float(height)
-		width = int(width)
-		height = max_height
-	if resize:
-		return pb.scale_simple(width, height, gtk.gdk.INTERP_BILINEAR)
-	else:
-		return pb
+			branch_iter = get_branch()
+		except ValueError:
+			branch_iter = None
+			state["abandoned"] = True # The tree was cleared underneath us
+		if not state["started"] and not state["abandoned"]:
+			state["started"] = True
+			state["abandoned"] = not start(branch_iter)
+		elif "anchor" in state and not state["anchor"].valid():
+			state["abandoned"] = True # Our rows were removed, the branch is being reloaded
+		with lock:
+			if state["abandoned"]:
+				pending.clear()
+			batch = [pending.popleft() for _ in xrange(min(TREE_BATCH_ROWS, len(pending)))]
+		for key, parent, values, subchildren in batch:
+			parent_iter = branch_iter if parent is None else parents[parent]
+			row_iter = treestore.append(parent_iter, values)
+			if "anchor" not in state:
+				state["anchor"] = gtk.TreeRowReference(treestore, treestore.get_path(row_iter))
+			if subchildren == []:
+				treestore.append(row_iter, TreeValues("Nothing"))
+			elif subchildren is not None:
+				parents[key] = row_iter
+				with lock:
+					pending.extendleft(reversed([(object(), key, child, grandchildren) for child, grandchildren in subchildren]))
+		if batch and state.pop("expanded", False):
+			tree.expand_row(branch_path, False)
+		with lock:
+			if pending and not state["abandoned"]:
+				return True
+			state["scheduled"] = False
+			return False
+
+	def queue(children, finished):
+		with lock:
+			if state["finished"] or state["abandoned"]:
+				return
+			pending.extend((object(), None, values, subchildren) for values, subchildren in children)
+			state["finished"] = finished
+			if state["scheduled"]:
+				return
+			state["scheduled"] = True
+		idle_add(add_batch)
+
+	return (lambda children: queue(children, False)), (lambda children: queue(children, True))
+
+def recording_label(job):
+	'''What to show for a recording job in the history pane.'''
+	if job["state"] != "running":
+		return job["name"] + " (Queued)"
+	progress = job.get("progress")
+	if not progress or progress["percent"] is None:
+		return job["name"] + " (Recording...)"
+	status = "%.0f%%" % (progress["percent"],)
+	if progress["throughput"]:
+		status += " at %.1f Mb/s" % (progress["throughput"] * 8 / 1000000,)
+	return "%s (Recording %s)" % (job["name"], status)
 
 def which(program):
 	'''Finds a program's location based on its name.'''
@@ -811,6 +1117,14 @@ class Configuration(object):
 		localfiles_entry.connect("activate", self._localfiles_add_cb, localfiles_entry)
 		builder.get_object("config_local_files_remove").connect("clicked", self._localfiles_remove_cb, localfiles_entry)
 
+		self._uiconfig_max_recordings = builder.get_object("config_max_recordings")
+		self._uiconfig_recording_bandwidth = builder.get_object("config_recording_bandwidth")
+		self._uiconfig_stream_buffer = builder.get_object("config_stream_buffer")
+		self._uiconfig_stream_over_http = builder.get_object("config_stream_over_http")
+		self._uiconfig_record_while_watching = builder.get_object("config_record_while_watching")
+		self._uiconfig_fast_start = builder.get_object("config_fast_start")
+		self._uiconfig_prefetch = builder.get_object("config_prefetch")
+
 	def create_configure_dialog(self, *args):
 		self._init_ui(self.config_getiplayer_location, self._uiconfig_getiplayer_location, self._uiconfig_getiplayer_guess)
 		self._init_ui(self.config_flvstreamer_location, self._uiconfig_flvstreamer_location, self._uiconfig_flvstreamer_guess)
@@ -847,6 +1161,14 @@ class Configuration(object):
 		for directory in self.config_localfiles_directories:
 			localfiles_model.append([directory])
 
+		self._uiconfig_max_recordings.set_value(self.config_max_recordings)
+		self._uiconfig_recording_bandwidth.set_value(self.config_recording_bandwidth)
+		self._uiconfig_stream_buffer.set_value(self.config_stream_buffer)
+		self._uiconfig_stream_over_http.set_active(self.config_stream_over_http)
+		self._uiconfig_record_while_watching.set_active(self.config_record_while_watching)
+		self._uiconfig_fast_start.set_active(self.config_fast_start)
+		self._uiconfig_prefetch.set_active(self.config_prefetch)
+
 		self.config_dialog.set_default_response(gtk.RESPONSE_OK)
 		return self.config_dialog
 
@@ -961,6 +1283,14 @@ class Configuration(object):
 
 		self.config_localfiles_directories = [row[0] for row in self._uiconfig_localfiles_directories.get_model()]
 
+		self.config_max_recordings = self._uiconfig_max_recordings.get_value()
+		self.config_recording_bandwidth = self._uiconfig_recording_bandwidth.get_value()
+		self.config_stream_buffer = self._uiconfig_stream_buffer.get_value()
+		self.config_stream_over_http = self._uiconfig_stream_over_http.get_active()
+		self.config_record_while_watching = self._uiconfig_record_while_watching.get_active()
+		self.config_fast_start = self._uiconfig_fast_start.get_active()
+		self.config_prefetch = self._uiconfig_prefetch.get_active()
+
 		self.onconfigchanged()
 		self.config_dialog.hide()
 
@@ -1042,3 +1372,66 @@ class Configuration(object):
 	@config_localfiles_directories.setter
 	def config_localfiles_directories(self, value):
 		self.gconf.set_list(GCONF_KEY + "/localfiles_directories", gconf.VALUE_STRING, value)
+
+	@property
+	def config_max_recordings(self):
+		mr = self.gconf.get_int(GCONF_KEY + "/max_recordings")
+		return mr if mr > 0 else 3
+
+	@config_max_recordings.setter
+	def config_max_recordings(self, value):
+		self.gconf.set_int(GCONF_KEY + "/max_recordings", int(value))
+
+	@property
+	def config_recording_bandwidth(self):
+		'''Most KB/s all recordings together may download at, 0 for no limit.'''
+		return max(0, self.gconf.get_int(GCONF_KEY + "/recording_bandwidth"))
+
+	@config_recording_bandwidth.setter
+	def config_recording_bandwidth(self, value):
+		self.gconf.set_int(GCONF_KEY + "/recording_bandwidth", int(value))
+
+	@property
+	def config_stream_buffer(self):
+		'''KB to read ahead of Totem when playing, 0 to stream straight into Totem's pipe.'''
+		return max(0, self.gconf.get_int(GCONF_KEY + "/stream_buffer"))
+
+	@config_stream_buffer.setter
+	def config_stream_buffer(self, value):
+		self.gconf.set_int(GCONF_KEY + "/stream_buffer", int(value))
+
+	@property
+	def config_stream_over_http(self):
+		'''Whether to play through the local HTTP server, so Totem can seek back, rather than a pipe.'''
+		return self.gconf.get_bool(GCONF_KEY + "/stream_over_http")
+
+	@config_stream_over_http.setter
+	def config_stream_over_http(self, value):
+		self.gconf.set_bool(GCONF_KEY + "/stream_over_http", bool(value))
+
+	@property
+	def config_record_while_watching(self):
+		'''Whether playing a programme also saves it, from the same download.'''
+		return self.gconf.get_bool(GCONF_KEY + "/record_while_watching")
+
+	@config_record_while_watching.setter
+	def config_record_while_watching(self, value):
+		self.gconf.set_bool(GCONF_KEY + "/record_while_watching", bool(value))
+
+	@property
+	def config_fast_start(self):
+		'''Whether to look up the preferred version's streams at the same time as a programme's info when playing it.'''
+		return self.gconf.get_bool(GCONF_KEY + "/fast_start")
+
+	@config_fast_start.setter
+	def config_fast_start(self, value):
+		self.gconf.set_bool(GCONF_KEY + "/fast_start", bool(value))
+
+	@property
+	def config_prefetch(self):
+		'''Whether to look up the programmes on screen in the background, before they are clicked.'''
+		return self.gconf.get_bool(GCONF_KEY + "/prefetch")
+
+	@config_prefetch.setter
+	def config_prefetch(self, value):
+		self.gconf.set_bool(GCONF_KEY + "/prefetch", bool(value))
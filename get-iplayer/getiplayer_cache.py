@@ -0,0 +1,255 @@
+'''
+Reads get_iplayer's programme cache files directly so that listings can be answered without running get_iplayer.
+'''
+
+# totem-get-iplayer
+# Copyright (C) 2013  Andy Gurden
+#
+#     This file is part of totem-get-iplayer.
+#
+#     totem-get-iplayer is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     totem-get-iplayer is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with totem-get-iplayer.  If not, see <http://www.gnu.org/licenses/>.
+
+import re
+import os
+import glob
+import threading
+from collections import OrderedDict, defaultdict
+
+# Used when a cache file has no header line, this is the order get_iplayer writes them in
+DEFAULT_CACHE_FIELDS = [
+	"index", "type", "name", "pid", "available", "expires", "episode", "seriesnum", "episodenum", "versions",
+	"duration", "desc", "channel", "categories", "thumbnail", "timeadded", "guidance", "web"
+]
+
+# Filter names as used by the plugin, mapped to the field in the cache holding them
+FILTER_FIELDS = {
+	"channel": "channel",
+	"category": "categories",
+	"categories": "categories",
+	"type": "type",
+	"version": "versions",
+	"versions": "versions",
+}
+
+# Fields that hold comma separated lists of values rather than a single value
+MULTIVALUE_FIELDS = set(["categories", "versions"])
+
+MEMOISED_RESULTS = 64 # Most query results kept, least recently used dropped first
+COMPILED_REGEXES = 128 # Most compiled search and filter patterns kept
+
+def default_profile_dir():
+	'''The profile directory get_iplayer uses when it is not told otherwise.'''
+	return os.environ.get("GETIPLAYERUSERPREFS") or os.path.join(os.path.expanduser("~"), ".get_iplayer")
+
+def parse_cache_file(input):
+	'''Parse the contents of a get_iplayer cache file, yielding a dict for each programme.'''
+	fields = DEFAULT_CACHE_FIELDS
+	for line in input.splitlines():
+		if not line:
+			continue
+		if line.startswith("#"):
+			fields = line[1:].rstrip("|").split("|")
+			continue
+		values = line.split("|")
+		if len(values) < len(fields):
+			values.extend([""] * (len(fields) - len(values)))
+		prog = dict(zip(fields, values))
+		try:
+			prog["index"] = int(prog["index"])
+		except (KeyError, ValueError):
+			continue # Not a programme we could ever refer to
+		yield prog
+
+def field_values(prog, field):
+	'''All of the values a programme has for a field, an empty list when it is blank.'''
+	value = prog.get(field, "")
+	if field in MULTIVALUE_FIELDS:
+		return [v for v in value.split(",") if v]
+	return [value] if value else []
+
+def episode_number(prog):
+	try:
+		return int(prog.get("episodenum", ""))
+	except ValueError:
+		return 0
+
+class ProgrammeCache(object):
+	'''
+	In-memory table of every programme in get_iplayer's cache files, reloaded when the files change.
+	Queries follow get_iplayer's own matching: case insensitive regex searches where a blank filter
+	matches only programmes with nothing in that field.
+	'''
+
+	def __init__(self, profile_dir=None):
+		self.profile_dir = profile_dir or default_profile_dir()
+		self._lock = threading.RLock()
+		self._files = {} # Cache file : (mtime, size, list of programmes)
+		self._programmes = []
+		self._by_index = {}
+		self._by_pid = {}
+		self._results = OrderedDict() # Memoised query results, dropped whenever the table is reloaded
+		self._regexes = OrderedDict()
+
+	def _cache_files(self):
+		return glob.glob(os.path.join(self.profile_dir, "*.cache"))
+
+	def _refresh(self):
+		'''Reload any cache file that has changed since we last looked. Returns whether there is anything loaded.'''
+		changed = False
+		current = set()
+		for filename in self._cache_files():
+			try:
+				st = os.stat(filename)
+			except OSError:
+				continue
+			current.add(filename)
+			known = self._files.get(filename)
+			if known is not None and known[0] == st.st_mtime and known[1] == st.st_size:
+				continue
+			try:
+				with open(filename) as cachefile:
+					progs = list(parse_cache_file(cachefile.read()))
+			except IOError:
+				continue
+			self._files[filename] = (st.st_mtime, st.st_size, progs)
+			changed = True
+		for filename in set(self._files) - current:
+			del self._files[filename]
+			changed = True
+		if changed:
+			self._programmes = [prog for _, _, progs in self._files.itervalues() for prog in progs]
+			self._by_index = {prog["index"]: prog for prog in self._programmes}
+			self._by_pid = {prog["pid"]: prog["index"] for prog in self._programmes if prog.get("pid")}
+			self._results = OrderedDict()
+		return bool(self._files)
+
+	def available(self):
+		'''Whether there are any cache files we can answer queries from.'''
+		with self._lock:
+			return self._refresh()
+
+	def _remember(self, memory, key, value, entries):
+		'''Keep a value as the most recently used, dropping the least recently used beyond entries.'''
+		memory.pop(key, None)
+		memory[key] = value
+		while len(memory) > entries:
+			memory.popitem(last=False)
+		return value
+
+	def _regex(self, pattern):
+		regex = self._regexes.get(pattern)
+		if regex is None:
+			try:
+				regex = re.compile(pattern, re.IGNORECASE)
+			except re.error as exc:
+				raise ValueError("Cannot use search %r natively: %s" % (pattern, exc))
+		return self._remember(self._regexes, pattern, regex, COMPILED_REGEXES)
+
+	def _matcher(self, search, type, filters):
+		'''Create a function to test whether a programme matches a search, type list and dict of field:regex filters.'''
+		tests = []
+		if search:
+			regex = self._regex(search)
+			tests.append(lambda prog: regex.search(" ".join((prog.get("name", ""), prog.get("episode", ""), prog.get("desc", "")))))
+		types = set(type.split(",")) if type and type != "all" else None
+		if types is not None:
+			tests.append(lambda prog: prog.get("type", "") in types)
+		for field, pattern in filters.iteritems():
+			if pattern is None or pattern == ".*":
+				continue
+			if not pattern:
+				tests.append(lambda prog, field=field: not prog.get(field, ""))
+			else:
+				regex = self._regex(pattern)
+				tests.append(lambda prog, field=field, regex=regex: regex.search(prog.get(field, "")))
+		return lambda prog: all(test(prog) for test in tests)
+
+	def _memoised(self, key, build):
+		result = self._results.pop(key, None)
+		if result is None:
+			result = build()
+		return self._remember(self._results, key, result, MEMOISED_RESULTS)
+
+	def _matching(self, search, type, channel, category, version):
+		'''Every programme matching the filters.'''
+		def build():
+			matches = self._matcher(search, type, {"channel": channel, "categories": category, "versions": version})
+			return [prog for prog in self._programmes if matches(prog)]
+		return self._memoised(("matching", search, type, channel, category, version), build)
+
+	def _ensure_loaded(self):
+		if not self._refresh():
+			raise ValueError("No get_iplayer cache files found in %s" % (self.profile_dir,))
+
+	def get_filter_counts(self, filter_type, search=None, type="all", channel=".*", category=".*", version=".*", refresh=True):
+		'''
+		How many matching programmes have each value of a filter, and how many have it blank, as (counts, blanks).
+		Without refresh the files are not checked for changes, for a run of queries just after available().
+		'''
+		def build():
+			counts = defaultdict(int)
+			blanks = 0
+			for prog in self._matching(search, type, channel, category, version):
+				values = field_values(prog, field)
+				if not values:
+					blanks += 1
+				for v in values:
+					counts[v] += 1
+			return OrderedDict(sorted(counts.iteritems())), blanks
+		with self._lock:
+			if refresh:
+				self._ensure_loaded()
+			field = FILTER_FIELDS[filter_type]
+			counts, blanks = self._memoised(("counts", field, search, type, channel, category, version), build)
+			return OrderedDict(counts), blanks
+
+	def get_filters(self, filter_type, search=None, type="all", channel=".*", category=".*", version=".*"):
+		'''Every distinct value of a filter for matching programmes, sorted in the same way as get_iplayer's listings.'''
+		return list(self.get_filter_counts(filter_type, search, type, channel, category, version)[0])
+
+	def count_missing_attrib(self, blankattrib, search=None, type="all", channel=".*", category=".*", version=".*"):
+		'''Counts the number of programmes with the given attribute blank, but that fit the other filters.'''
+		return self.get_filter_counts(blankattrib, search, type, channel, category, version)[1]
+
+	def get_episodes(self, search=None, type="all", channel=".*", category=".*", version=".*"):
+		'''Matching programmes grouped by series, in the same form as parse_episodes().'''
+		def build():
+			by_series = defaultdict(list)
+			for prog in self._matching(search, type, channel, category, version):
+				by_series[prog.get("name", "")].append(prog)
+			return OrderedDict(
+				(series, [(p["index"], p.get("episode", "")) for p in sorted(eps, key=lambda p: (episode_number(p), p["index"]))])
+				for series, eps in sorted(by_series.iteritems())
+			)
+		with self._lock:
+			self._ensure_loaded()
+			episodes = self._memoised(("episodes", search, type, channel, category, version), build)
+			return OrderedDict((series, list(eps)) for series, eps in episodes.iteritems())
+
+	def get_programme(self, index):
+		'''The cached fields for a single programme index, or None if it is not in the cache.'''
+		with self._lock:
+			self._refresh()
+			prog = self._by_index.get(index)
+			return None if prog is None else dict(prog)
+
+	def get_index(self, pid, refresh=True):
+		'''
+		The index of the programme with the given pid, or None if it is not in the cache.
+		Without refresh the files are not checked for changes, for a run of lookups just after available().
+		'''
+		with self._lock:
+			if refresh:
+				self._refresh()
+			return self._by_pid.get(pid)
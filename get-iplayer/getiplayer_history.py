@@ -0,0 +1,143 @@
+'''
+Reads get_iplayer's download history file directly, parsing only what has been appended since the last read.
+'''
+
+# totem-get-iplayer
+# Copyright (C) 2013  Andy Gurden
+#
+#     This file is part of totem-get-iplayer.
+#
+#     totem-get-iplayer is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     totem-get-iplayer is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with totem-get-iplayer.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+import threading
+from getiplayer_cache import default_profile_dir
+
+# The order get_iplayer writes the fields of each download_history line in
+HISTORY_FIELDS = [
+	"pid", "name", "episode", "type", "timeadded", "mode", "filename", "versions", "duration", "desc",
+	"channel", "categories", "thumbnail", "guidance", "web", "episodenum", "seriesnum"
+]
+
+# Seconds before a recording's file is checked for again, so files deleted outside the plugin are noticed eventually
+DELETED_CHECK_INTERVAL = 60
+
+def guess_version(location):
+	'''get_iplayer does not record which version it downloaded, but names the file after it.'''
+	filename = os.path.splitext(os.path.basename(location))[0]
+	return filename.rsplit("_", 1)[-1]
+
+def parse_history_line(line):
+	'''Parse one line of download_history into a dict, or None if it is not a recording.'''
+	values = line.split("|")
+	if len(values) < len(HISTORY_FIELDS):
+		values.extend([""] * (len(HISTORY_FIELDS) - len(values)))
+	entry = dict(zip(HISTORY_FIELDS, values))
+	if not entry["filename"] or not entry["name"]:
+		return None
+	return entry
+
+def append_history(filename, entry):
+	'''Add a recording to a download_history file, in the same form get_iplayer writes.'''
+	def value(field):
+		v = entry.get(field) or ""
+		if isinstance(v, (list, tuple, set)):
+			v = ",".join(v)
+		v = v.encode("utf-8") if isinstance(v, unicode) else str(v)
+		return v.replace("|", " ").replace("\n", " ")
+	line = "|".join(value(field) for field in HISTORY_FIELDS) + "|\n"
+	with open(filename, "a") as history:
+		history.write(line)
+
+class HistoryIndex(object):
+	'''
+	Every recording in download_history, kept in memory. get_iplayer only ever appends to the file, so each
+	refresh reads on from where the last stopped, starting again only if the file shrinks or is replaced.
+	Whether each recording's file still exists is checked when it is asked for, at most every DELETED_CHECK_INTERVAL.
+	'''
+
+	def __init__(self, profile_dir=None, programme_cache=None):
+		self.filename = os.path.join(profile_dir or default_profile_dir(), "download_history")
+		self.programme_cache = programme_cache # Used to find the index of each recording's programme
+		self._lock = threading.RLock()
+		self._reset(None)
+
+	def _reset(self, inode):
+		self._inode = inode
+		self._offset = 0
+		self._entries = []
+		self._exists = {} # Filename : (exists, when checked)
+
+	def available(self):
+		return os.path.exists(self.filename)
+
+	def refresh(self):
+		'''Parse anything appended since the last refresh, returning how many recordings were added.'''
+		with self._lock:
+			try:
+				st = os.stat(self.filename)
+			except OSError:
+				self._reset(None)
+				return 0
+			if st.st_ino != self._inode or st.st_size < self._offset:
+				self._reset(st.st_ino)
+			if st.st_size == self._offset:
+				return 0
+			with open(self.filename, "rb") as history:
+				history.seek(self._offset)
+				appended = history.read(st.st_size - self._offset)
+			end = appended.rfind("\n") + 1 # Leave any partly written line for next time
+			self._offset += end
+			added = 0
+			for line in appended[:end].splitlines():
+				entry = parse_history_line(line)
+				if entry is not None:
+					self._entries.append(entry)
+					added += 1
+			return added
+
+	def forget(self, filename):
+		'''Note that a recording's file has been deleted, without waiting for it to be checked again.'''
+		with self._lock:
+			self._exists[filename] = (False, time.time())
+
+	def _file_exists(self, filename, now):
+		exists, checked = self._exists.get(filename, (None, 0))
+		if exists is None or now - checked > DELETED_CHECK_INTERVAL:
+			exists = os.path.exists(filename)
+			self._exists[filename] = (exists, now)
+		return exists
+
+	def _index_of(self, pid):
+		if self.programme_cache is None:
+			return -1
+		index = self.programme_cache.get_index(pid, refresh=False)
+		return -1 if index is None else index
+
+	def get_history(self, guess_versions=True):
+		'''Recordings whose files still exist, in the same form as parse_history().'''
+		with self._lock:
+			self.refresh()
+			if self.programme_cache is not None:
+				self.programme_cache.available() # Checked for changes once, not for every entry
+			now = time.time()
+			history = []
+			for entry in self._entries:
+				filename = entry["filename"]
+				if not self._file_exists(filename, now):
+					continue
+				version = guess_version(filename) if guess_versions else entry["versions"]
+				history.append((self._index_of(entry["pid"]), entry["name"], entry["episode"], version, entry["mode"], filename))
+			return history
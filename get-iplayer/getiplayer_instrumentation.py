@@ -0,0 +1,213 @@
+'''
+Timings for each get_iplayer call, broken down by where the time went. Off by default and close to free when off.
+'''
+
+# totem-get-iplayer
+# Copyright (C) 2013  Andy Gurden
+#
+#     This file is part of totem-get-iplayer.
+#
+#     totem-get-iplayer is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     totem-get-iplayer is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with totem-get-iplayer.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import time
+import threading
+from collections import deque, defaultdict
+
+# Upper bounds of histogram buckets, in seconds for timings. Sizes in bytes use BYTE_BUCKETS.
+TIME_BUCKETS = [0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 30, 60]
+BYTE_BUCKETS = [2**i for i in xrange(8, 30, 2)]
+
+# What each metric means, in the order they happen during a call
+METRICS = [
+	("queue_wait", "seconds waiting in the scheduler before starting"),
+	("spawn", "seconds to start the process"),
+	("first_byte", "seconds from starting to the first output"),
+	("runtime", "seconds from starting to the process finishing"),
+	("output_bytes", "bytes of output, normal and errors"),
+	("parse", "seconds parsing the output"),
+	("native", "seconds answering from the cache files instead of running get_iplayer"),
+	("dispatch_delay", "seconds from finishing to callbacks running"),
+	("buffer_fill_bytes", "bytes read ahead of Totem when streaming, sampled"),
+	("underrun", "seconds Totem had nothing left to read while streaming"),
+	("throughput_bytes", "bytes per second passed on to Totem while streaming"),
+]
+
+class Histogram(object):
+	'''A rolling window of recent values, summarised as percentiles and bucket counts.'''
+
+	def __init__(self, buckets, window=1000):
+		self.buckets = buckets
+		self._values = deque(maxlen=window)
+		self.total_count = 0
+
+	def add(self, value):
+		self._values.append(value)
+		self.total_count += 1
+
+	def summary(self):
+		ordered = sorted(self._values)
+		if not ordered:
+			return {"count": 0, "total_count": self.total_count}
+		counts = [0] * (len(self.buckets) + 1)
+		bucket = 0
+		for value in ordered:
+			while bucket < len(self.buckets) and value > self.buckets[bucket]:
+				bucket += 1
+			counts[bucket] += 1
+		return {
+			"count": len(ordered),
+			"total_count": self.total_count,
+			"mean": sum(ordered) / float(len(ordered)),
+			"p50": ordered[len(ordered) // 2],
+			"p90": ordered[int(len(ordered) * 0.9)],
+			"p99": ordered[int(len(ordered) * 0.99)],
+			"max": ordered[-1],
+			"buckets": [(bound, count) for bound, count in zip(self.buckets + [None], counts) if count],
+		}
+
+class _NullProbe(object):
+	'''Stands in for a probe when instrumentation is off, every method does nothing.'''
+	enabled = False
+
+	def mark(self, name, when=None):
+		pass
+
+	def started(self):
+		pass
+
+	def finished(self, when=None):
+		pass
+
+	def output(self, nbytes):
+		pass
+
+	def dispatched(self):
+		pass
+
+NULL_PROBE = _NullProbe()
+
+class Probe(object):
+	'''Follows one call from being queued to its callbacks running, recording each stage as it completes.'''
+	enabled = True
+
+	def __init__(self, instrumentation, operation):
+		self._instrumentation = instrumentation
+		self.operation = operation
+		self._times = {"submitted": time.time()}
+
+	def mark(self, name, when=None):
+		self._times[name] = when if when is not None else time.time()
+
+	def _record_between(self, metric, start, end):
+		if start in self._times and end in self._times:
+			self._instrumentation.record(self.operation, metric, self._times[end] - self._times[start])
+
+	def started(self):
+		self.mark("started")
+		self._record_between("queue_wait", "submitted", "started")
+
+	def finished(self, when=None):
+		self.mark("finished", when)
+		self._record_between("spawn", "started", "spawned")
+		self._record_between("first_byte", "started", "first_byte")
+		self._record_between("runtime", "started", "finished")
+
+	def output(self, nbytes):
+		self._instrumentation.record(self.operation, "output_bytes", nbytes)
+
+	def dispatched(self):
+		self.mark("dispatched")
+		self._record_between("dispatch_delay", "finished", "dispatched")
+
+class Instrumentation(object):
+	'''Collects histograms of each metric for each operation.'''
+
+	def __init__(self, window=1000):
+		self.enabled = False
+		self.window = window
+		self._lock = threading.Lock()
+		self._histograms = defaultdict(dict) # operation : metric : histogram
+		self._cancel_dump = None
+
+	def enable(self, dump_interval=None, reactor=None, write=sys.stderr.write):
+		'''Start collecting, and optionally write a summary every dump_interval seconds using the reactor's timers.'''
+		self.enabled = True
+		if dump_interval and reactor is not None and self._cancel_dump is None:
+			def dump():
+				write(self.dump())
+				self._cancel_dump = reactor.call_later(dump_interval, dump)
+			self._cancel_dump = reactor.call_later(dump_interval, dump)
+
+	def disable(self):
+		self.enabled = False
+		if self._cancel_dump is not None:
+			self._cancel_dump()
+			self._cancel_dump = None
+
+	def probe(self, operation):
+		'''Something to follow a call with, which does nothing when instrumentation is off.'''
+		if not self.enabled:
+			return NULL_PROBE
+		return Probe(self, operation)
+
+	def record(self, operation, metric, value):
+		if not self.enabled:
+			return
+		with self._lock:
+			histogram = self._histograms[operation].get(metric)
+			if histogram is None:
+				histogram = Histogram(BYTE_BUCKETS if metric.endswith("bytes") else TIME_BUCKETS, self.window)
+				self._histograms[operation][metric] = histogram
+			histogram.add(value)
+
+	def timed(self, operation, metric, function):
+		'''Wrap function so each call is recorded as metric, only adding a check of enabled when off.'''
+		def timed_function(*vargs, **kwargs):
+			if not self.enabled:
+				return function(*vargs, **kwargs)
+			started = time.time()
+			try:
+				return function(*vargs, **kwargs)
+			finally:
+				self.record(operation, metric, time.time() - started)
+		return timed_function
+
+	def snapshot(self):
+		'''Summaries of every histogram, as operation : metric : summary.'''
+		with self._lock:
+			return {
+				operation: {metric: histogram.summary() for metric, histogram in metrics.iteritems()}
+				for operation, metrics in self._histograms.iteritems()
+			}
+
+	def reset(self):
+		with self._lock:
+			self._histograms = defaultdict(dict)
+
+	def dump(self):
+		'''A text table of the current summaries, timings in milliseconds.'''
+		order = [metric for metric, _ in METRICS]
+		lines = ["%-24s %-15s %7s %10s %10s %10s %10s" % ("operation", "metric", "count", "mean", "p50", "p99", "max")]
+		for operation, metrics in sorted(self.snapshot().iteritems()):
+			for metric, summary in sorted(metrics.iteritems(), key=lambda m: (order.index(m[0]) if m[0] in order else len(order), m[0])):
+				if not summary["count"]:
+					continue
+				scale = 1 if metric.endswith("bytes") else 1000
+				lines.append("%-24s %-15s %7d %10.1f %10.1f %10.1f %10.1f" % (
+					operation, metric, summary["count"],
+					summary["mean"] * scale, summary["p50"] * scale, summary["p99"] * scale, summary["max"] * scale))
+		return "\n".join(lines) + "\n"
+
+INSTRUMENTATION = Instrumentation()
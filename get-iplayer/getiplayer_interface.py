@@ -24,19 +24,52 @@ import sys
 import re
 import threading
 import subprocess
-import tempfile
 import signal
+import time
+import copy
+import heapq
+import Queue
+import traceback
 import os.path
-from collections import OrderedDict, defaultdict
+from collections import OrderedDict, defaultdict, deque
+from getiplayer_cache import ProgrammeCache, FILTER_FIELDS, MULTIVALUE_FIELDS, default_profile_dir
+from getiplayer_history import HistoryIndex, guess_version, append_history
+from getiplayer_workers import WorkerPool
+from getiplayer_reactor import IOReactor, LineReader
+from getiplayer_instrumentation import INSTRUMENTATION, NULL_PROBE
+from getiplayer_streaming import StreamRelay, Spool, SpoolFeeder, StreamProxy, container_extension, remove_stale_spools
 
 RE_LISTING_ENTRY = re.compile(r"^(.+) \((\d+?)\)$", re.MULTILINE)
 RE_MATCH_TOTAL = re.compile(r"^INFO: (\d+) Matching Programmes$", re.MULTILINE)
 RE_TREE_EPISODE = re.compile(r"^  (\d+?): \((\d*?)\) (.*)$")
-RE_INFO_LINE = re.compile(r"^(.+?):\s+(.+)$", re.MULTILINE)
+RE_INFO_LINE = re.compile(r"^(.+?):[ \t]+(.+)$", re.MULTILINE)
 RE_HISTORY = re.compile(r"^\((\d+)\):\((.+)\):\((.*)\):\((.+)\):\((.+)\):\((.+)\)$", re.MULTILINE)
 RE_MODE_GROUP = re.compile(r"^([^\d]*?)\d*$")
 RE_STREAMINFO_LINE = re.compile(r"^([a-zA-Z]+):\s+(.*)$")
+RE_INFO_INDEX = re.compile(r"^index:\s+(\d+)\s*$", re.MULTILINE)
+RE_PROGRAMME_HEADING = re.compile(r"^(\d+):\t", re.MULTILINE)
+RE_STREAM_START = re.compile(r"^stream:", re.MULTILINE)
+RE_STREAM_VERSION = re.compile(r"^version:\s+(\S+)", re.MULTILINE)
 RE_SUBTITLE_LOCATION = re.compile(r"^INFO: Downloading Subtitles to '(.*)'$", re.MULTILINE)
+RE_PROGRESS = re.compile(r"^\s*(\d+(?:\.\d+)?)% of ~?\s*(\d+(?:\.\d+)?) MB @\s*(\d+(?:\.\d+)?) Mb/s ETA: (\d+):(\d+):(\d+)")
+RE_RTMPDUMP_PROGRESS = re.compile(r"^\s*(\d+(?:\.\d+)?) kB / (\d+(?:\.\d+)?) sec(?: \((\d+(?:\.\d+)?)%\))?")
+
+FILTER_VALUE_PREFIX = "FILTERVALUE:" # Marks our lines in a listing made to count filter values
+
+RECORDING_OUTPUT_LINES = 200 # Latest lines of a recording's output kept, enough to report why it failed
+
+# Order in which queued get_iplayer calls are started, lowest first
+PRIORITY_INTERACTIVE = 0 # Playback and the programme info panel
+PRIORITY_TREE = 1 # Populating the programme tree
+PRIORITY_BACKGROUND = 2 # Prefetching and cache refreshes
+
+# Seconds a query result stays valid for, None for results only invalidated by a cache refresh
+QUERY_CACHE_TTLS = {
+	"filters": None,
+	"episodes": None,
+	"info": 30 * 60,
+	"streaminfo": 5 * 60, # Stream urls expire
+}
 
 def parse_listings(input, withcounts=False):
 	listings = RE_LISTING_ENTRY.finditer(input)
@@ -49,6 +82,69 @@ def parse_listings(input, withcounts=False):
 		else:
 			yield name
 
+def parse_filter_values(input, multivalue=False):
+	'''Count the values of a filter in output listed with FILTER_VALUE_PREFIX, returning (counts, blank count).'''
+	counts = defaultdict(int)
+	blanks = 0
+	for line in input.splitlines():
+		if not line.startswith(FILTER_VALUE_PREFIX):
+			continue
+		value = line[len(FILTER_VALUE_PREFIX):]
+		values = [v.strip() for v in value.split(",")] if multivalue else [value.strip()]
+		values = [v for v in values if v]
+		if not values:
+			blanks += 1
+		for v in values:
+			counts[v] += 1
+	return OrderedDict(sorted(counts.iteritems())), blanks
+
+def parse_filter_rows(input, fields):
+	'''Split output listed with FILTER_VALUE_PREFIX and several fields separated by "|" into a dict for each programme.'''
+	rows = []
+	for line in input.splitlines():
+		if not line.startswith(FILTER_VALUE_PREFIX):
+			continue
+		values = line[len(FILTER_VALUE_PREFIX):].split("|")
+		if len(values) == len(fields):
+			rows.append(dict(zip(fields, (v.strip() for v in values))))
+	return rows
+
+def with_blank_filter(filter_type, values, blanks):
+	'''A filter's values with "" first if there are programmes which have it blank, as the tree shows them.'''
+	if blanks and filter_type != "type" and filter_type != "version":
+		return [""] + list(values)
+	return list(values)
+
+def cascade_filter_rows(rows, filter_types):
+	'''
+	The values of each of filter_types in turn for the programmes in rows, as get_filters_and_blanks() would give them,
+	going on to the next only while a level has a single value. The programmes are narrowed to that value at each
+	step, matching in the same way as get_iplayer. Returns [(filter type, values)] for each level worked out.
+	'''
+	levels = []
+	for filter_type in filter_types:
+		field = FILTER_FIELDS[filter_type]
+		values = set()
+		blanks = False
+		for row in rows:
+			row_values = [v.strip() for v in row[field].split(",")] if field in MULTIVALUE_FIELDS else [row[field]]
+			row_values = [v for v in row_values if v]
+			values.update(row_values)
+			blanks = blanks or not row_values
+		values = with_blank_filter(filter_type, sorted(values), blanks)
+		levels.append((filter_type, values))
+		if len(values) != 1:
+			break
+		if not values[0]:
+			rows = [row for row in rows if not row[field]]
+			continue
+		try:
+			regex = re.compile(values[0], re.IGNORECASE)
+		except re.error:
+			break # Leave it to get_iplayer to make sense of when that level is expanded
+		rows = [row for row in rows if regex.search(row[field])]
+	return levels
+
 def parse_match_count(input):
 	count = RE_MATCH_TOTAL.search(input)
 	if count is None:
@@ -56,22 +152,51 @@ def parse_match_count(input):
 	return int(count.groups()[0])
 
 def parse_episodes(input):
-	episodes = {} # Series name : list of episode index, number and names
+	'''
+	Parse --tree output, given as a string or any iterable of lines, yielding (series name, episodes) as each
+	series ends. Episodes are a list of (index, name) sorted by episode number.
+	'''
+	if isinstance(input, basestring):
+		input = input.splitlines()
 	series = None
-	for line in input.splitlines():
+	series_episodes = [] # Episode index, number and name
+	for line in input:
 		match = RE_TREE_EPISODE.match(line)
-		if not match:
-			series = line
+		if match:
+			idx, num, name = match.groups()
+			series_episodes.append((int(idx), int(num) if num else 0, name))
 			continue
-		series_list = episodes.get(series, [])
-		episodes[series] = series_list # In case we got list through default
-		idx, num, name = match.groups()
-		series_list.append((int(idx), int(num) if num else 0, name))
-	# Need to sort by episode number and then drop number from data
-	sorted_eps = {}
-	for series_name, series_episodes in episodes.iteritems():
-		sorted_eps[series_name] = [(i, name) for i, n, name in sorted(series_episodes, key=lambda ep: ep[1])]
-	return sorted_eps
+		if series_episodes:
+			yield series, [(i, name) for i, n, name in sorted(series_episodes, key=lambda ep: ep[1])]
+		series = line
+		series_episodes = []
+	if series_episodes:
+		yield series, [(i, name) for i, n, name in sorted(series_episodes, key=lambda ep: ep[1])]
+
+def collect_episodes(blocks):
+	'''Gather the blocks from parse_episodes into series name : episodes, a series appearing twice has its blocks joined.'''
+	episodes = OrderedDict()
+	for series, series_episodes in blocks:
+		episodes.setdefault(series, []).extend(series_episodes)
+	return episodes
+
+class SeriesStream(object):
+	'''Fed --tree output a line at a time, calls onseries(series name, episodes) as soon as each series has been read.'''
+
+	def __init__(self, onseries):
+		self._onseries = onseries
+		self._lines = []
+
+	def __call__(self, line):
+		if self._lines and not RE_TREE_EPISODE.match(line):
+			self.flush()
+		self._lines.append(line)
+
+	def flush(self):
+		'''Pass on the series read so far, the last one is only known to be complete at the end of the output.'''
+		for series, episodes in parse_episodes(self._lines):
+			self._onseries(series, episodes)
+		self._lines = []
 
 def parse_info(input, versions):
 	relevant = input.split("\n\n")[-2]
@@ -116,6 +241,40 @@ def parse_streaminfo(input, includesubtitles=False):
 				del streaminfo[stream]
 	return streaminfo
 
+def split_info(input, versions):
+	'''Split --info output for several programmes into each one's info, keyed by the index given in it.'''
+	infos = {}
+	for block in input.split("\n\n"):
+		match = RE_INFO_INDEX.search(block)
+		if match:
+			infos[int(match.group(1))] = parse_info(block + "\n\n", versions)
+	return infos
+
+def split_streaminfo_by_programme(input, indices):
+	'''
+	Split --streaminfo output for several programmes at the heading before each one's streams.
+	None if it cannot be told which streams are whose, as when the headings are missing or all come first.
+	'''
+	headings = list(RE_PROGRAMME_HEADING.finditer(input))
+	sections = {}
+	for heading, following in zip(headings, headings[1:] + [None]):
+		sections[int(heading.group(1))] = input[heading.end():len(input) if following is None else following.start()]
+	if set(sections) != set(indices) or not all(RE_STREAM_START.search(section) for section in sections.itervalues()):
+		return None
+	return sections
+
+def split_streaminfo_by_version(input, versions):
+	'''Split --streaminfo output for one programme into each version's streams, or None if the streams do not say their version.'''
+	blocks = {version: [] for version in versions}
+	for block in input.split("\n\n"):
+		if not RE_STREAM_START.search(block):
+			continue
+		match = RE_STREAM_VERSION.search(block)
+		if match is None:
+			return None
+		blocks.setdefault(match.group(1), []).append(block)
+	return {version: parse_streaminfo("\n\n".join(blocks[version])) for version in versions}
+
 def parse_versions(version_collections):
 	versions = set()
 	for vc in version_collections:
@@ -176,9 +335,7 @@ def parse_history(input, guess_versions):
 		index, name, episode, version, mode, location = match.groups()
 		index = int(index)
 		if guess_versions:
-			filename = os.path.basename(location)
-			filename = os.path.splitext(filename)[0]
-			version = filename.rsplit("_", 1)[-1]
+			version = guess_version(location)
 		yield (index, name, episode, version, mode, location)
 
 def parse_subtitles(input):
@@ -203,26 +360,292 @@ def is_error_line(line):
 		return True # VLC error (often seen when trying to play rtsp)
 	return False
 
+class RecordingProgress(object):
+	'''
+	How far a recording has got, kept up to date from get_iplayer's progress lines (or rtmpdump's, when
+	get_iplayer passes them on) as they arrive. Throughput is measured over the last few seconds.
+	'''
+
+	def __init__(self, window=5):
+		self._lock = threading.Lock()
+		self._window = window
+		self._samples = deque() # (time, bytes downloaded) over the last window seconds
+		self.percent = None
+		self.total_bytes = None
+		self.downloaded_bytes = 0
+		self.reported_rate = None # Bytes per second according to get_iplayer
+		self.eta = None # Seconds left according to get_iplayer
+		self.updated = None
+
+	def feed(self, line):
+		'''Take in a line of output, ignoring it unless it is a progress line.'''
+		match = RE_PROGRESS.match(line)
+		if match:
+			percent, total_mb, rate_mbit, hours, minutes, seconds = match.groups()
+			total = float(total_mb) * 1024 * 1024
+			self._update(float(percent), total, total * float(percent) / 100, float(rate_mbit) * 1000000 / 8,
+				int(hours) * 3600 + int(minutes) * 60 + int(seconds))
+			return
+		match = RE_RTMPDUMP_PROGRESS.match(line)
+		if match:
+			kb, _, percent = match.groups()
+			percent = float(percent) if percent else None
+			downloaded = float(kb) * 1024
+			total = downloaded * 100 / percent if percent else None
+			self._update(percent, total, downloaded, None, None)
+
+	def _update(self, percent, total, downloaded, rate, eta):
+		now = time.time()
+		with self._lock:
+			self.percent, self.total_bytes, self.downloaded_bytes = percent, total, downloaded
+			self.reported_rate, self.eta, self.updated = rate, eta, now
+			self._samples.append((now, downloaded))
+			while self._samples and self._samples[0][0] < now - self._window:
+				self._samples.popleft()
+
+	def throughput(self):
+		'''Bytes per second over the last few seconds, None until there have been two progress lines.'''
+		with self._lock:
+			if len(self._samples) < 2:
+				return self.reported_rate
+			(start, first), (end, last) = self._samples[0], self._samples[-1]
+			if end <= start:
+				return self.reported_rate
+			return (last - first) / (end - start)
+
+	def snapshot(self):
+		throughput = self.throughput()
+		with self._lock:
+			return {
+				"percent": self.percent,
+				"total_bytes": self.total_bytes,
+				"downloaded_bytes": self.downloaded_bytes,
+				"throughput": throughput,
+				"eta": self.eta,
+				"updated": self.updated,
+			}
+
+class CancelledError(Exception):
+	'''Raised when getting a result that was cancelled or dropped before it could be produced.'''
+	pass
+
+def summarise_times(times):
+	'''Mean, 90th percentile and maximum of some durations.'''
+	ordered = sorted(times)
+	if not ordered:
+		return {"count": 0, "mean": 0.0, "p90": 0.0, "max": 0.0}
+	return {
+		"count": len(ordered),
+		"mean": sum(ordered) / len(ordered),
+		"p90": ordered[int(len(ordered) * 0.9)],
+		"max": ordered[-1],
+	}
+
+class TaskPool(object):
+	'''A bounded set of threads to run short tasks on, threads are only started when every existing one is busy.'''
+
+	def __init__(self, size):
+		self.size = size
+		self._tasks = Queue.Queue()
+		self._lock = threading.Lock()
+		self._threads = 0
+		self._idle = 0
+		self._completed = 0
+
+	def submit(self, task, *args):
+		with self._lock:
+			self._tasks.put((task, args))
+			if self._idle >= self._tasks.qsize() or self._threads >= self.size:
+				return
+			self._threads += 1
+			self._idle += 1
+		thread = threading.Thread(target=self._work)
+		thread.daemon = True
+		thread.start()
+
+	def _work(self):
+		while True:
+			task, args = self._tasks.get() # No timeout, waiting with one polls and would delay every task
+			with self._lock:
+				self._idle -= 1
+			try:
+				task(*args)
+			except Exception:
+				traceback.print_exc()
+			with self._lock:
+				self._completed += 1
+				self._idle += 1
+
+	def stats(self):
+		with self._lock:
+			return {"threads": self._threads, "idle": self._idle, "queued": self._tasks.qsize(), "completed": self._completed}
+
+class CompletionDispatcher(object):
+	'''
+	Drives every pending result that has callbacks waiting on it. One thread checks the results it is watching
+	whenever it is woken, which whatever produces a result does as it completes, without blocking on any of them.
+	Their callbacks are then run on a small pool of threads.
+	'''
+
+	def __init__(self, callback_threads=4, history=500):
+		self._pool = TaskPool(callback_threads)
+		self._condition = threading.Condition()
+		self._watching = [] # (pending result, time it started being watched)
+		self._woken = False # Whether anything may have completed since the watcher last looked
+		self._watcher = None
+		self._latencies = deque(maxlen=history) # Seconds from noticing a result to its callbacks running
+		self._durations = deque(maxlen=history) # Seconds spent running callbacks
+
+	def watch(self, result):
+		'''Start watching a result, its callbacks are dispatched once it has one.'''
+		with self._condition:
+			self._watching.append((result, time.time()))
+			if self._watcher is None:
+				self._watcher = threading.Thread(target=self._watch)
+				self._watcher.daemon = True
+				self._watcher.start()
+			self._woken = True
+			self._condition.notify()
+
+	def wake(self):
+		'''Tell the watcher something may have finished. Anything that completes a result must call this.'''
+		with self._condition:
+			self._woken = True
+			self._condition.notify()
+
+	def _watch(self):
+		while True:
+			with self._condition:
+				while not self._woken:
+					self._condition.wait()
+				self._woken = False
+				watching = self._watching
+				self._watching = []
+			still_waiting = []
+			for result, since in watching:
+				try:
+					complete = result.has_result()
+				except Exception:
+					complete = True # Let getting the result raise the problem in the pool
+				if complete:
+					self._pool.submit(self._dispatch, result, time.time())
+				else:
+					still_waiting.append((result, since))
+			with self._condition:
+				self._watching.extend(still_waiting)
+
+	def is_watcher(self):
+		'''Whether this is being called on the thread that watches for results.'''
+		return threading.current_thread() is self._watcher
+
+	def run_soon(self, task, *args):
+		'''Run a task on the callback threads, for work that should not hold up the watcher.'''
+		self._pool.submit(task, *args)
+
+	def _dispatch(self, result, noticed):
+		started = time.time()
+		self._latencies.append(started - noticed)
+		INSTRUMENTATION.record("completion", "dispatch_delay", started - noticed)
+		result._complete()
+		self._durations.append(time.time() - started)
+
+	def stats(self):
+		'''Thread counts, results being watched and how quickly callbacks run, in seconds.'''
+		with self._condition:
+			watching = len(self._watching)
+		pool = self._pool.stats()
+		return {
+			"watching": watching,
+			"threads": pool["threads"] + (1 if self._watcher is not None else 0),
+			"callback_threads": pool["threads"],
+			"callbacks_queued": pool["queued"],
+			"dispatched": pool["completed"],
+			"callback_latency": summarise_times(self._latencies),
+			"callback_duration": summarise_times(self._durations),
+		}
+
 class PendingResult(object):
-	def __init__(self, hasresult, getresult, showserrors):
+	def __init__(self, hasresult, getresult, showserrors, oncancel=None):
 		self._resultlock = threading.Lock()
 		self._waiterlock = threading.Lock()
+		self._cancellock = threading.Lock()
 		self._hasresult = hasresult
 		self._getresult = getresult
 		self._showserrors = showserrors # value of getresult() will be treated as (result, [errors])
 		self._result = None
 		self._errors = []
 		self._gotresult = False
+		self._cancelled = False
 		self._callbacks = []
+		self._dispatched = False # Whether callbacks have been dispatched, later ones are run straight away
+		self._cancelhooks = [] if oncancel is None else [oncancel] # Stop whatever is producing the result
+		self._sources = [] # Results this was derived from, released when this is cancelled
+		self._holds = 0
 
 	def has_result(self):
 		return self._hasresult()
 
+	def is_cancelled(self):
+		return self._cancelled
+
+	def _derive(self, *sources):
+		'''Mark this result as derived from the sources, so cancelling it lets go of them.'''
+		for source in sources:
+			source.hold()
+			self._sources.append(source)
+		return self
+
+	def hold(self):
+		'''
+		Stop this result being cancelled because the results derived from it were. It will only be cancelled
+		through them once every hold is released. Results derived from this one hold it automatically.
+		'''
+		with self._cancellock:
+			self._holds += 1
+
+	def release(self):
+		'''Let go of a hold, cancelling the result if nothing else needs it.'''
+		with self._cancellock:
+			self._holds -= 1
+			unneeded = self._holds <= 0
+		if unneeded:
+			self.cancel()
+
+	def cancel(self):
+		'''
+		Cancel the result if it is not already complete, stopping whatever was producing it.
+		The results it was derived from are released, so they are cancelled too unless something else holds them.
+		Returns whether the result was cancelled.
+		'''
+		with self._cancellock:
+			if self._gotresult or self._cancelled:
+				return False
+			self._cancelled = True
+			self._hasresult = lambda: True
+			hooks, self._cancelhooks = self._cancelhooks, []
+			sources, self._sources = self._sources, []
+		for hook in hooks:
+			hook()
+		for source in sources:
+			source.release()
+		COMPLETION_DISPATCHER.wake()
+		return True
+
 	def get_result(self):
 		with self._resultlock:
+			if self._cancelled:
+				raise CancelledError()
 			if self._gotresult:
 				return self._result
-			r = self._getresult()
+			try:
+				r = self._getresult()
+			except CancelledError:
+				self._cancelled = True
+				self._hasresult = lambda: True
+				COMPLETION_DISPATCHER.wake()
+				raise
+			if self._cancelled:
+				raise CancelledError() # Whatever we got was cut short
 			if self._showserrors:
 				self._result, self._errors = r
 			else:
@@ -235,48 +658,104 @@ class PendingResult(object):
 		self.get_result()
 		return self._errors
 
-	def on_complete(self, callback=None, onerror=None, always=None):
+	def _outcome(self):
+		'''Wait for the result and give (result, errors, cancelled).'''
+		try:
+			return self.get_result(), self.get_errors(), False
+		except CancelledError:
+			return None, [], True
+
+	@staticmethod
+	def _run_callbacks(callbacks, outcome):
+		res, err, cancelled = outcome
+		for cb_success, cb_err, cb_always, cb_cancel in callbacks:
+			if cancelled:
+				if cb_cancel is not None:
+					cb_cancel()
+				continue
+			if cb_err is not None and err:
+				cb_err(err)
+			elif cb_success is not None:
+				cb_success(res)
+			if cb_always is not None:
+				cb_always(res, err)
+
+	def on_complete(self, callback=None, onerror=None, always=None, oncancel=None):
 		'''
 		Run a function when the result is complete. At most one of callback or onerror is ever run.
 		If neither are specified then neither will be run, otherwise onerror is run when it is specified and there
 		is an error, or callback is run the rest of the time.
 		Always is always run (if given) and given both normal and error outputs.
+		If the result is cancelled then only oncancel is run (if given).
+		Callbacks for results that are already complete are run straight away on the calling thread.
 		'''
+		callbacks = [(callback, onerror, always, oncancel)]
 		with self._waiterlock:
-			thread_exists = bool(self._callbacks)
-			self._callbacks.append((callback, onerror, always))
-			if not thread_exists:
-				def run(self):
-					res = self.get_result()
-					err = self.get_errors()
-					with self._waiterlock:
-						for cb_success, cb_err, cb_always in self._callbacks:
-							if cb_err is not None and err:
-								cb_err(err)
-							elif cb_success is not None:
-								cb_success(res)
-							if cb_always is not None:
-								cb_always(res, err)
-						self._callbacks = []
-				threading.Thread(target=run, args=(self,)).start()
+			runnow = self._dispatched or (self._gotresult and not self._callbacks) or self._cancelled
+			if not runnow:
+				watched = bool(self._callbacks)
+				self._callbacks.extend(callbacks)
+		if runnow:
+			self._run_callbacks(callbacks, self._outcome())
+		elif not watched:
+			COMPLETION_DISPATCHER.watch(self)
+
+	def _complete(self):
+		'''Run the waiting callbacks, called by the dispatcher once we have a result.'''
+		outcome = self._outcome()
+		with self._waiterlock:
+			callbacks, self._callbacks = self._callbacks, []
+			self._dispatched = True
+		self._run_callbacks(callbacks, outcome)
 
 	def translate(self, trans):
 		if self._showserrors:
-			return PendingResult(self._hasresult, lambda: (trans(self.get_result()), self.get_errors()), True)
+			return PendingResult(self.has_result, lambda: (trans(self.get_result()), self.get_errors()), True)._derive(self)
 		else:
-			return PendingResult(self._hasresult, lambda: trans(self.get_result()), False)
+			return PendingResult(self.has_result, lambda: trans(self.get_result()), False)._derive(self)
 
 	def then(self, tonext):
 		translated = self.translate(tonext)
+		following = [] # The result we moved on to, once we have it
+		advancing = [] # Set once tonext has been asked to run, and whether it failed
+		def advance():
+			try:
+				translated.get_result()
+				advancing[:] = [False]
+			except Exception:
+				advancing[:] = [True] # Getting the result raises the problem again, where it is dispatched
+			COMPLETION_DISPATCHER.wake()
 		def hasresult():
-			return translated.has_result() and translated.get_result().has_result()
+			if translated.is_cancelled():
+				return True
+			if not translated.has_result():
+				return False
+			if translated._gotresult:
+				return translated._result.has_result()
+			if not COMPLETION_DISPATCHER.is_watcher():
+				try:
+					return translated.get_result().has_result()
+				except CancelledError:
+					return True
+			# The watcher must not be held up running tonext, so that happens on a callback thread instead
+			if not advancing:
+				advancing.append(None)
+				COMPLETION_DISPATCHER.run_soon(advance)
+			return advancing[-1] is True
 		def getresult():
 			r = translated.get_result()
+			following.append(r)
+			if result.is_cancelled():
+				r.cancel()
 			if self._showserrors:
 				return (r.get_result(), translated.get_errors() + r.get_errors())
 			else:
 				return r.get_result()
-		return PendingResult(hasresult, getresult, self._showserrors)
+		def cancel_following():
+			for r in following:
+				r.cancel()
+		result = PendingResult(hasresult, getresult, self._showserrors, cancel_following)._derive(translated)
+		return result
 
 	def redistribute_streams(self, iserrorstd=None, iserrorerr=None):
 		'''
@@ -306,11 +785,13 @@ class PendingResult(object):
 			stdout = "\n".join(stdout)
 			return (stdout, stderr)
 			
-		return PendingResult(self.has_result, getresult, self._showserrors)
+		return PendingResult(self.has_result, getresult, self._showserrors)._derive(self)
 
 	@classmethod
 	def constant(cls, c):
-		return PendingResult(lambda: True, lambda: (c, []), True)
+		result = PendingResult(lambda: True, lambda: (c, []), True)
+		result.get_result() # Resolve now so callbacks can run without waiting
+		return result
 
 	@classmethod
 	def all(cls, **pendingresults):
@@ -323,12 +804,223 @@ class PendingResult(object):
 				return (res, [err for p in pendingresults.itervalues() for err in p.get_errors()])
 			else:
 				return res
-		return PendingResult(hasresult, getresult, showerrors)
+		return PendingResult(hasresult, getresult, showerrors)._derive(*pendingresults.values())
+
+COMPLETION_DISPATCHER = CompletionDispatcher()
+IO_REACTOR = IOReactor()
+
+class CallScheduler(object):
+	'''
+	Limits how many get_iplayer calls run at once. Calls over the limit are queued and started in priority order,
+	and queued calls that are no longer relevant when their turn comes are dropped without being run.
+	'''
+
+	def __init__(self, max_running=3, history=200):
+		self.max_running = max_running
+		self._lock = threading.Lock()
+		self._queue = [] # Heap of (priority, sequence number, call)
+		self._sequence = 0
+		self._running = 0
+		self._started = defaultdict(int) # priority : calls started
+		self._dropped = defaultdict(int) # priority : calls dropped
+		self._waits = defaultdict(lambda: deque(maxlen=history)) # priority : recent seconds spent queued
+
+	def submit(self, start, priority=PRIORITY_TREE, relevant=None):
+		'''
+		Queue a call. start() should begin the call and return a pending result for it, it is only run
+		once there is space. If relevant is given, the call is dropped if relevant() is false when it would start.
+		'''
+		call = {
+			"start": start, "relevant": relevant, "priority": priority, "queued": time.time(),
+			"ready": threading.Event(), "started": False, "cancelled": False, "result": None
+		}
+		with self._lock:
+			call["sequence"] = self._sequence
+			heapq.heappush(self._queue, (priority, self._sequence, call))
+			self._sequence += 1
+		def hasresult():
+			return call["ready"].is_set() and (call["result"] is None or call["result"].has_result())
+		def getresult():
+			call["ready"].wait()
+			if call["result"] is None:
+				raise CancelledError()
+			return (call["result"].get_result(), call["result"].get_errors())
+		def cancel():
+			with self._lock:
+				call["cancelled"] = True
+				if not call["started"]:
+					self._queue.remove((priority, call["sequence"], call))
+					heapq.heapify(self._queue)
+					self._drop(call)
+			if call["result"] is not None:
+				call["result"].cancel() # Kills it, and its slot is freed when it finishes
+		result = PendingResult(hasresult, getresult, True, cancel)
+		self._start_queued()
+		return result
+
+	def _drop(self, call):
+		self._dropped[call["priority"]] += 1
+		call["ready"].set() # With no result, so it is cancelled
+		COMPLETION_DISPATCHER.wake()
+
+	def _start_queued(self):
+		while True:
+			with self._lock:
+				if self._running >= self.max_running or not self._queue:
+					return
+				priority, _, call = heapq.heappop(self._queue)
+				if call["relevant"] is not None and not call["relevant"]():
+					self._drop(call)
+					continue
+				call["started"] = True
+				self._running += 1
+				self._started[priority] += 1
+				self._waits[priority].append(time.time() - call["queued"])
+			try:
+				result = call["start"]()
+			except OSError as exc:
+				result = PendingResult(lambda: True, lambda: ("", [str(exc)]), True)
+			call["result"] = result
+			call["ready"].set()
+			COMPLETION_DISPATCHER.wake() # In case the call finished before it was ready
+			result.on_complete(always=lambda res, errs: self._finished(), oncancel=self._finished)
+			if call["cancelled"]:
+				result.cancel() # Cancelled while it was starting
+
+	def _finished(self):
+		with self._lock:
+			self._running -= 1
+		self._start_queued()
+
+	def drop_irrelevant(self):
+		'''Drop every queued call that is no longer relevant, rather than waiting for its turn.'''
+		with self._lock:
+			keep = []
+			for priority, seq, call in self._queue:
+				if call["relevant"] is not None and not call["relevant"]():
+					self._drop(call)
+				else:
+					keep.append((priority, seq, call))
+			heapq.heapify(keep)
+			self._queue = keep
+
+	def stats(self):
+		'''Queue depth and wait time statistics, with waits in seconds and broken down by priority.'''
+		with self._lock:
+			queued = defaultdict(int)
+			for priority, _, _ in self._queue:
+				queued[priority] += 1
+			waits = {priority: summarise_times(recent) for priority, recent in self._waits.iteritems()}
+			return {
+				"running": self._running,
+				"max_running": self.max_running,
+				"queue_depth": len(self._queue),
+				"queued": dict(queued),
+				"started": dict(self._started),
+				"dropped": dict(self._dropped),
+				"wait": waits,
+			}
+
+class QueryCache(object):
+	'''
+	Remembers the results of get_iplayer queries, keyed on the arguments they were run with.
+	Identical queries that are still running share a single pending result rather than starting another process.
+	'''
+
+	def __init__(self, max_entries=256, ttls=None):
+		self.max_entries = max_entries
+		self.ttls = dict(QUERY_CACHE_TTLS, **(ttls or {}))
+		self._lock = threading.Lock()
+		self._entries = OrderedDict() # key : (expiry time or None, result), least recently used first
+		self._inflight = {} # key : pending result
+		self._relevance = {} # key : relevance checks of everyone waiting on an in-flight query
+		self._generation = 0 # Bumped on invalidation so queries running at the time are not stored
+
+	def _key(self, kind, args):
+		return (kind, args[0], tuple(sorted(args[1:])))
+
+	def fetch(self, kind, args, run, relevant=None):
+		'''
+		Get a pending result for a query, from the cache if we can or otherwise by calling run(isrelevant).
+		A running query stays relevant while relevant() is true for anyone waiting on it (or anyone gave no check).
+		'''
+		key = self._key(kind, args)
+		with self._lock:
+			entry = self._entries.pop(key, None)
+			if entry is not None:
+				expiry, value = entry
+				if expiry is None or expiry > time.time():
+					self._entries[key] = entry
+					return PendingResult.constant(copy.deepcopy(value))
+			if key in self._inflight:
+				self._relevance[key].append(relevant)
+				return self._inflight[key].translate(lambda r: r)
+			generation = self._generation
+			checks = [relevant]
+			self._relevance[key] = checks
+			result = run(lambda: any(check is None or check() for check in checks))
+			self._inflight[key] = result
+
+		def forget():
+			with self._lock:
+				if self._inflight.get(key) is result:
+					del self._inflight[key]
+					del self._relevance[key]
+		def store(value, errs):
+			forget()
+			if not errs:
+				self._put(key, value, generation)
+		result.on_complete(always=store, oncancel=forget)
+		return result.translate(lambda r: r) # Each caller gets a view, so cancelling it only affects them
+
+	@property
+	def generation(self):
+		'''Changes whenever the cache is invalidated, see put().'''
+		return self._generation
+
+	def get(self, kind, args):
+		'''A copy of the cached result of a query, or None if it is not cached.'''
+		key = self._key(kind, args)
+		with self._lock:
+			entry = self._entries.get(key)
+			if entry is None or (entry[0] is not None and entry[0] <= time.time()):
+				return None
+			return copy.deepcopy(entry[1])
+
+	def put(self, kind, args, value, generation=None):
+		'''
+		Cache the result of a query that was answered some other way, such as part of a batch.
+		Given the generation when the answer was asked for, it is dropped if the cache has been invalidated since.
+		'''
+		self._put(self._key(kind, args), value, generation)
+
+	def _put(self, key, value, generation=None):
+		with self._lock:
+			if generation is not None and generation != self._generation:
+				return
+			ttl = self.ttls.get(key[0])
+			self._entries.pop(key, None)
+			self._entries[key] = (None if ttl is None else time.time() + ttl, copy.deepcopy(value))
+			while len(self._entries) > self.max_entries:
+				self._entries.popitem(last=False)
+
+	def invalidate(self, kind=None):
+		'''Forget cached results, either all of them or those of one kind.'''
+		with self._lock:
+			self._generation += 1
+			self._inflight = {k: r for k, r in self._inflight.iteritems() if kind is not None and k[0] != kind}
+			self._relevance = {k: c for k, c in self._relevance.iteritems() if k in self._inflight}
+			for key in self._entries.keys():
+				if kind is None or key[0] == kind:
+					del self._entries[key]
 
 class GetIPlayer(object):
-	def __init__(self, location, flvstreamerloc=None, ffmpegloc=None, localfiles_directories=None, output_location="~/.totem-get-iplayer"):
+	def __init__(self, location, flvstreamerloc=None, ffmpegloc=None, localfiles_directories=None, output_location="~/.totem-get-iplayer", profile_dir=None, native_cache=True, execution="pool", pool_size=2, max_running=3, spool_location=None):
 		self.stock_vargs = [location]
 		self.stock_kwargs = {"nocopyright": "", "nopurge": ""}
+		if profile_dir is not None:
+			profile_dir = os.path.abspath(os.path.expanduser(profile_dir))
+			self.stock_kwargs["profile-dir"] = profile_dir
 		if flvstreamerloc is not None:
 			self.stock_kwargs["flvstreamer"] = flvstreamerloc
 		if ffmpegloc is not None:
@@ -337,20 +1029,62 @@ class GetIPlayer(object):
 			localfiles_directories = ["/non/existent/directory"]
 		self.stock_kwargs["localfilesdirs"] = ",".join(localfiles_directories)
 		self.recordings = {}
+		self._local_copies = {} # (Index, version) : (location, name, episode) of finished recordings, from the last history read
+		self._recording_progress = {} # (Index, version) : RecordingProgress for each recording running
+		self._main_relay = None # StreamRelay feeding Totem, when playing with a read-ahead buffer
+		self._main_spool_url = None # Where Totem is fetching the main stream from, when playing over HTTP
+		self._main_spool_recording = False # Whether that spool is also being recorded
+		self._stream_proxy = None # Started the first time something is played over HTTP
+		self._main_feed = None # SpoolFeeder copying a recording to Totem, when recording while watching
 		self._running_processes = {}
 		self.output_location = os.path.abspath(os.path.expanduser(output_location))
+		# Streams can be large, so they are spooled on disk with the recordings rather than in a temporary directory that may be in memory
+		self.spool_location = os.path.abspath(os.path.expanduser(spool_location)) if spool_location else self.output_location
+		for directory in set([self.output_location, self.spool_location]):
+			remove_stale_spools(directory)
+		self.programme_cache = ProgrammeCache(profile_dir) if native_cache else None
+		self._native_pool = TaskPool(1) # Loads and searches the programme cache files off the caller's thread
+		self.history_index = HistoryIndex(profile_dir, self.programme_cache) if native_cache else None
+		self.history_file = os.path.join(profile_dir or default_profile_dir(), "download_history")
+		self.query_cache = QueryCache()
+		self.scheduler = CallScheduler(max_running)
+		self.worker_pool = None # Only used when execution is "pool", "popen" starts a new process for everything
+		if execution == "pool":
+			self.worker_pool = WorkerPool(location, size=pool_size)
+			if self.worker_pool.available():
+				self.worker_pool.prewarm()
+			else:
+				self.worker_pool = None
 		self._version_result = self.get_filters("version")
+		self._version_result.hold() # Shared by every info request, so never cancelled by them
 
 	def close(self):
-		for proc in self._running_processes.itervalues():
-			if proc.poll() is None:
-				try:
-					os.killpg(proc.pid, signal.SIGKILL)
-				except OSError:
-					sys.stderr.write("Could not terminate process %s" % (proc.pid,))
+		self.query_cache.invalidate()
+		if self.worker_pool is not None:
+			self.worker_pool.close()
+		for proc in self._running_processes.values():
+			self._kill(proc)
+		self._abort_main_relay()
+		self._stop_main_feed()
+		if self._stream_proxy is not None:
+			self._stream_proxy.close()
+			self._stream_proxy = None
+			self._main_spool_url = None
+
+	def _kill(self, proc):
+		'''Kill a process we started along with anything it started.'''
+		if proc.poll() is None:
+			try:
+				os.killpg(proc.pid, signal.SIGKILL)
+			except OSError:
+				sys.stderr.write("Could not terminate process %s" % (proc.pid,))
 
 	def close_main_stream(self):
+		'''Stop whatever Totem is playing. Recordings being watched carry on without it.'''
 		MAIN_STREAM_LIMITER.close()
+		self._abort_main_relay()
+		self._close_main_spool()
+		self._stop_main_feed()
 
 	def _parse_args(self, *vargs, **kwargs):
 		args = list(self.stock_vargs)
@@ -374,39 +1108,104 @@ class GetIPlayer(object):
 		'''Call and return the new process.'''
 		return subprocess.Popen(args, preexec_fn=os.setsid, stdout=stdout, stderr=stderr)
 
-	def _call_stream(self, stdout, args, haltonerror=True):
-		'''Call and return whatever stdout was (expects an fd or pipe).'''
+	def _call_stream(self, stdout, args, haltonerror=True, operation="stream", limit=True):
+		'''
+		Call and return whatever stdout was (expects an fd or pipe).
+		Unless limit is False the process is the main stream, and is killed when another takes its place.
+		'''
+		probe = INSTRUMENTATION.probe(operation)
+		probe.started()
 		proc = self.__call(stdout, subprocess.PIPE, args)
-		MAIN_STREAM_LIMITER.add_process(proc)
+		probe.mark("spawned")
+		if limit:
+			MAIN_STREAM_LIMITER.add_process(proc)
 		procdone = self.__add_running_process(proc)
 		monitor = ProcessMonitor(proc, filtererr=is_error_line, haltonerror=haltonerror)
 		result = monitor.get_pending_result()
-		result.on_complete(lambda _: procdone())
+		result.on_complete(always=lambda res, errs: procdone(), oncancel=procdone)
+		if probe.enabled:
+			result.on_complete(always=lambda res, errs: self._probe_complete(probe, monitor.finished_time, res, errs))
 		return result
 
-	def _call(self, args, norefresh=True, longoutput=False):
-		'''Calls and returns pending result for output. Can avoid refreshes occurring during the call and output to file rather than buffer.'''
+	def _call(self, args, norefresh=True, longoutput=False, priority=PRIORITY_TREE, relevant=None, online=None, operation="get_iplayer", onprocess=None, progress=None, pooled=False):
+		'''
+		Calls and returns pending result for output. Can avoid refreshes occurring during the call.
+		Only pooled calls, short read-only queries, run on a warm worker; everything else gets a process of its own.
+		The call waits its turn in the scheduler at the given priority, or starts straight away if priority is None.
+		It is dropped if relevant is given and relevant() is false by the time it would start.
+		If online is given it is called with each line of normal output as it arrives, from the I/O reactor's thread.
+		If onprocess is given it is called with the process once it has started.
+		If progress is given every normal line is fed to it, carriage returns end lines and only the latest lines are kept.
+		Timings are recorded under operation when instrumentation is on.
+		'''
 		if norefresh:
-			args.append("--expiry=315360000") # Cache expires in 10 year's time...
-			args.append("--refresh-exclude=.*") # Don't refresh things that don't exist in the cache at all
-		if longoutput:
-			stdoutfile = tempfile.TemporaryFile()
-			stderrfile = tempfile.TemporaryFile()
-			proc = self.__call(stdoutfile, stderrfile, args)
-			def get_result():
-				proc.communicate()
-				stdoutfile.seek(0)
-				stderrfile.seek(0)
-				return (stdoutfile.read(), stderrfile.readlines())
+			# A copy, as the caller's args may be a query cache key
+			args = args + [
+				"--expiry=315360000", # Cache expires in 10 year's time...
+				"--refresh-exclude=.*", # Don't refresh things that don't exist in the cache at all
+			]
+		probe = INSTRUMENTATION.probe(operation)
+		start = lambda: self._start_call(args, norefresh, longoutput, online, probe, onprocess, progress, pooled)
+		if priority is None:
+			return start()
+		return self.scheduler.submit(start, priority, relevant)
+
+	def _start_call(self, args, norefresh, longoutput, online=None, probe=NULL_PROBE, onprocess=None, progress=None, pooled=False):
+		probe.started()
+		if pooled and norefresh and not longoutput and online is None and onprocess is None and progress is None and self.worker_pool is not None:
+			return self._call_worker(args, probe)
+		# Both pipes are drained by the I/O reactor as the output arrives, classifying each line as it goes
+		proc = self.__call(subprocess.PIPE, subprocess.PIPE, args)
+		probe.mark("spawned")
+		procdone = self.__add_running_process(proc)
+		if onprocess is not None:
+			onprocess(proc)
+		if progress is None:
+			monitor = ProcessMonitor(proc, listenstd=True, listenerr=True, filterstd=is_error_line, filtererr=is_error_line, strip=False, onoutput=online)
 		else:
+			monitor = ProcessMonitor(
+				proc, listenstd=True, listenerr=True, filterstd=is_error_line, filtererr=is_error_line,
+				onoutput=progress.feed, onerroutput=progress.feed, splitcr=True, maxlines=RECORDING_OUTPUT_LINES)
+		result = monitor.get_pending_result()
+		result.on_complete(always=lambda res, errs: procdone(), oncancel=procdone)
+		if probe.enabled:
+			def complete(res, errs):
+				probe.mark("first_byte", monitor.first_output_time)
+				self._probe_complete(probe, monitor.finished_time, res, errs)
+			result.on_complete(always=complete)
+		return result
+
+	def _probe_complete(self, probe, finished_time, res, errs):
+		'''Record the end of a call once its callbacks are running.'''
+		if finished_time is not None:
+			probe.finished(finished_time)
+		probe.output((len(res) if isinstance(res, basestring) else 0) + sum(len(e) for e in errs))
+		probe.dispatched()
+
+	def _call_worker(self, args, probe=NULL_PROBE):
+		'''Run a short query on a warm worker, falling back to a process of its own if the worker fails.'''
+		def direct():
 			proc = self.__call(subprocess.PIPE, subprocess.PIPE, args)
-			def get_result():
-				stdout, stderr = proc.communicate()
-				return (stdout, stderr.splitlines())
-		procdone = self.__add_running_process(proc)
-		result = PendingResult(lambda: proc.poll() is not None, get_result, True)
-		result.on_complete(lambda _: procdone())
-		return result.redistribute_streams(is_error_line, is_error_line)
+			procdone = self.__add_running_process(proc)
+			stdout, stderr = proc.communicate()
+			procdone()
+			return (stdout, stderr, proc.returncode)
+		ondone = COMPLETION_DISPATCHER.wake
+		onoutput = None
+		if probe.enabled:
+			finished = []
+			def ondone():
+				finished.append(time.time())
+				COMPLETION_DISPATCHER.wake()
+			onoutput = lambda: probe.mark("first_byte") # When the worker sends its output, which it does all at once
+		hasresult, wait, cancel = self.worker_pool.run(args[1:], direct, ondone, onoutput)
+		def get_result():
+			stdout, stderr, _ = wait()
+			return (stdout, stderr.splitlines())
+		result = PendingResult(hasresult, get_result, True, cancel).redistribute_streams(is_error_line, is_error_line)
+		if probe.enabled:
+			result.on_complete(always=lambda res, errs: self._probe_complete(probe, finished[0] if finished else None, res, errs))
+		return result
 
 	def _fix_blank_search(self, **kwargs):
 		if "channel" in kwargs and not kwargs["channel"]:
@@ -417,113 +1216,490 @@ class GetIPlayer(object):
 			kwargs["category"] = ".*"
 		return kwargs
 
+	def _query(self, kind, args, parse, priority=PRIORITY_TREE, relevant=None, online=None, operation=None):
+		'''
+		Run a query through the query cache, parsing its output when it is not already cached.
+		If the query has to be run then online(line) is also given each line of normal output as it arrives.
+		'''
+		operation = operation or kind
+		parse = INSTRUMENTATION.timed(operation, "parse", parse)
+		return self.query_cache.fetch(
+			kind, args,
+			lambda isrelevant: self._call(args, priority=priority, relevant=isrelevant, online=online, operation=operation, pooled=True).translate(parse),
+			relevant)
+
+	def _native(self, fallback, query, *vargs, **kwargs):
+		'''
+		Answer a query from the programme cache files without running get_iplayer. The files are loaded and searched
+		on a thread of their own, never the caller's. When they cannot answer it, fallback() gives the pending result
+		of asking get_iplayer instead.
+		'''
+		if self.programme_cache is None:
+			return fallback()
+		answer = INSTRUMENTATION.timed(query, "native", getattr(self.programme_cache, query))
+		def native():
+			try:
+				return answer(*vargs, **kwargs) # Checks the files have not changed, once
+			except ValueError:
+				return None # No cache files, or a search only get_iplayer understands
+		return self._in_background(native).then(lambda native: fallback() if native is None else PendingResult.constant(native))
+
+	def _in_background(self, task):
+		'''Run task on the native cache's thread, giving a pending result for what it returns, or None if it fails.'''
+		done = threading.Event()
+		outcome = []
+		def run():
+			try:
+				outcome.append(task())
+			except Exception:
+				traceback.print_exc()
+				outcome.append(None)
+			done.set()
+			COMPLETION_DISPATCHER.wake()
+		self._native_pool.submit(run)
+		def getresult():
+			done.wait()
+			return (outcome[0], [])
+		return PendingResult(done.is_set, getresult, True)
+
+	def get_filters_and_blanks(self, filter_type, search=None, type="all", channel=".*", category=".*", version=".*", priority=PRIORITY_TREE, relevant=None):
+		'''All values of a filter, with "" first if there are programmes which have it blank.'''
+		def complete_filters(counts_and_blanks):
+			counts, blanks = counts_and_blanks
+			return with_blank_filter(filter_type, counts, blanks > 0)
+		return self.get_filter_counts(filter_type, search, type, channel, category, version, priority, relevant).translate(complete_filters)
+
+	def get_filter_counts(self, filter_type, search=None, type="all", channel=".*", category=".*", version=".*", priority=PRIORITY_TREE, relevant=None):
+		'''
+		How many matching programmes have each value of a filter and how many have none, as (counts, blanks).
+		Everything comes from a single listing rather than a --list run and a separate count of the blanks.
+		'''
+		def fallback():
+			field = FILTER_FIELDS[filter_type]
+			fixed_filtering = self._fix_blank_search(type=type, channel=channel, category=category, version=version)
+			args = self._parse_args(*([search] if search else []), long="", listformat=FILTER_VALUE_PREFIX + "<%s>" % (field,), **fixed_filtering)
+			return self._query("filters", args, lambda fs: parse_filter_values(fs, field in MULTIVALUE_FIELDS), priority, relevant, operation="get_filter_counts")
+		return self._native(fallback, "get_filter_counts", filter_type, search, type, channel, category, version)
+
+	def get_filter_cascade(self, filter_types, search=None, type="all", channel=".*", category=".*", version=".*", priority=PRIORITY_TREE, relevant=None):
+		'''
+		The values of each of filter_types in turn, as get_filters_and_blanks() would give them, going on to the next
+		filter only while there is a single value, choosing that value for it. Gives [(filter type, values)].
+		A chain of levels with one value each is worked out from one listing, rather than a query per level.
+		'''
+		def fallback():
+			fields = [FILTER_FIELDS[filter_type] for filter_type in filter_types]
+			fixed_filtering = self._fix_blank_search(type=type, channel=channel, category=category, version=version)
+			listformat = FILTER_VALUE_PREFIX + "|".join("<%s>" % (field,) for field in fields)
+			args = self._parse_args(*([search] if search else []), long="", listformat=listformat, **fixed_filtering)
+			parse = lambda output: cascade_filter_rows(parse_filter_rows(output, fields), filter_types)
+			return self._query("filters", args, parse, priority, relevant, operation="get_filter_cascade")
+		if self.programme_cache is None:
+			return fallback()
+		cascade = INSTRUMENTATION.timed("get_filter_cascade", "native", self._native_filter_cascade)
+		native = lambda: cascade(filter_types, search, type=type, channel=channel, category=category, version=version)
+		return self._in_background(native).then(lambda native: fallback() if native is None else PendingResult.constant(native))
+
+	def _native_filter_cascade(self, filter_types, search, **filters):
+		'''
+		get_filter_cascade() from the programme cache files, or None if any level cannot be answered from them.
+		The files are checked for changes once, before the first level.
+		'''
+		if not self.programme_cache.available():
+			return None
+		levels = []
+		for filter_type in filter_types:
+			try:
+				counts, blanks = self.programme_cache.get_filter_counts(filter_type, search, refresh=False, **filters)
+			except ValueError:
+				return None
+			values = with_blank_filter(filter_type, counts, blanks > 0)
+			levels.append((filter_type, values))
+			if len(values) != 1:
+				break
+			filters[filter_type] = values[0]
+		return levels
+
+	def get_filters(self, filter_type, search=None, type="all", channel=".*", category=".*", version=".*", priority=PRIORITY_TREE, relevant=None):
+		def fallback():
+			listed = {"category": "categories", "version": "versions"}.get(filter_type, filter_type)
+			fixed_filtering = self._fix_blank_search(type=type, channel=channel, category=category, version=version)
+			args = self._parse_args(*([search] if search else []), list=listed, long="", **fixed_filtering)
+			if listed == "versions":
+				return self._query("filters", args, lambda fs: parse_versions(parse_listings(fs)), priority, relevant, operation="get_filters")
+			else:
+				return self._query("filters", args, lambda fs: list(parse_listings(fs)), priority, relevant, operation="get_filters")
+		return self._native(fallback, "get_filters", filter_type, search, type, channel, category, version)
 
-	def get_filters_and_blanks(self, filter_type, search=None, type="all", channel=".*", category=".*", version=".*"):
-		filters = {
-			"normal": self.get_filters(filter_type, search, type, channel, category, version),
-			"missing": self.count_missing_attrib(filter_type, search, type, channel, category, version)
-		}
-		def complete_filters(filters):
-			if filters["missing"] > 0:
-				filters["normal"].insert(0, "")
-			return filters["normal"]
-		return PendingResult.all(**filters).translate(complete_filters)
-
-	def get_filters(self, filter_type, search=None, type="all", channel=".*", category=".*", version=".*"):
-		if filter_type == "category":
-			filter_type = "categories"
-		if filter_type == "version":
-			filter_type = "versions"
-		fixed_filtering = self._fix_blank_search(type=type, channel=channel, category=category, version=version)
-		args = self._parse_args(*([search] if search else []), list=filter_type, long="", **fixed_filtering)
-		filters = self._call(args)
-		available_filters = filters.translate(lambda fs: list(parse_listings(fs)))
-		if filter_type == "versions":
-			return available_filters.translate(parse_versions)
-		else:
-			return available_filters
-
-	def count_missing_attrib(self, blankattrib, search=None, type="all", channel=".*", category=".*", version=".*"):
+	def count_missing_attrib(self, blankattrib, search=None, type="all", channel=".*", category=".*", version=".*", priority=PRIORITY_TREE, relevant=None):
 		'''Counts the number of programmes with the given attribute blank, but that fit the other filters.'''
 		if blankattrib == "type" or blankattrib == "version":
 			return PendingResult.constant(0) # Don't have an option to exclude these, but I don't think you can have blank types
-		exclude = {}
-		exclude["exclude-"+blankattrib] = ".+"
-		args = self._parse_args(*([search] if search else []), long="", type=type, channel=channel, category=category, **exclude)
-		blank = self._call(args)
-		return blank.translate(parse_match_count)
-
-	def get_episodes(self, search=None, type="all", channel=".*", category=".*", version=".*"):
-		fixed_filtering = self._fix_blank_search(type=type, channel=channel, category=category, version=version)
-		args = self._parse_args(*([search] if search else []), long="", tree="", listformat="<index>: (<episodenum>) <episode>", **fixed_filtering)
-		episodes = self._call(args)
-		return episodes.translate(parse_episodes)
-
-	def get_programme_info(self, index, availableversions=None):
+		def fallback():
+			exclude = {}
+			exclude["exclude-"+blankattrib] = ".+"
+			args = self._parse_args(*([search] if search else []), long="", type=type, channel=channel, category=category, **exclude)
+			blank = self._call(args, priority=priority, relevant=relevant, operation="count_missing_attrib", pooled=True)
+			return blank.translate(INSTRUMENTATION.timed("count_missing_attrib", "parse", parse_match_count))
+		return self._native(fallback, "count_missing_attrib", blankattrib, search, type, channel, category, version)
+
+	def get_episodes(self, search=None, type="all", channel=".*", category=".*", version=".*", priority=PRIORITY_TREE, relevant=None, onseries=None):
+		'''
+		Series and their episodes matching the filters. When get_iplayer has to be run, onseries(series, episodes) is
+		called for each series as its output arrives, before the whole result. Anything else only comes with the result.
+		'''
+		def fallback():
+			fixed_filtering = self._fix_blank_search(type=type, channel=channel, category=category, version=version)
+			args = self._parse_args(*([search] if search else []), long="", tree="", listformat="<index>: (<episodenum>) <episode>", **fixed_filtering)
+			online = None if onseries is None else SeriesStream(onseries)
+			return self._query("episodes", args, lambda output: collect_episodes(parse_episodes(output)), priority, relevant, online, "get_episodes")
+		return self._native(fallback, "get_episodes", search, type, channel, category, version)
+
+	def get_programme_info(self, index, availableversions=None, priority=PRIORITY_INTERACTIVE, relevant=None):
 		'''
 		Need one or more of availableversions to be available for this programme or we get incomplete info.
 		If they are not provided then we fetch them first.
 		'''
 		if availableversions is None:
-			return self._version_result.then(lambda vs: self.get_programme_info(index, vs))
+			return self._version_result.then(lambda vs: self.get_programme_info(index, vs, priority, relevant))
 		args = self._parse_args(index, info="", versions=",".join(availableversions))
-		info = self._call(args)
-		return info.translate(lambda i: parse_info(i, availableversions))
+		return self._query("info", args, lambda i: parse_info(i, availableversions), priority, relevant, operation="get_programme_info")
 
-	def get_stream_info(self, index, version):
+	def get_stream_info(self, index, version, priority=PRIORITY_INTERACTIVE, relevant=None):
 		args = self._parse_args(index, version=version, streaminfo="")
-		info = self._call(args)
-		return info.translate(parse_streaminfo)
+		return self._query("streaminfo", args, parse_streaminfo, priority, relevant, operation="get_stream_info")
 
-	def get_programme_info_and_streams(self, index, availableversions=None):
-		maininfo = self.get_programme_info(index, availableversions)
+	def get_programme_info_and_streams(self, index, availableversions=None, priority=PRIORITY_INTERACTIVE, relevant=None):
+		maininfo = self.get_programme_info(index, availableversions, priority, relevant)
 		def get_info_and_version_streams(info):
 			versions = info.get("versions", "").split(",")
 			versionstreams = {
-				version: self.get_stream_info(index, version)
+				version: self.get_stream_info(index, version, priority, relevant)
 				for version in versions
 				if version
 			}
 			return PendingResult.all(**versionstreams).translate(lambda vs: dict(info, streams=vs))
 		return maininfo.then(get_info_and_version_streams)
 
-	def record_programme(self, index, displayname=None, version="default", mode="best"):
+	def get_programme_info_batch(self, indices, availableversions=None, priority=PRIORITY_TREE, relevant=None):
+		'''
+		Info for many programmes from one get_iplayer run, as {index: info}. Each is put in the query cache as
+		get_programme_info() would, and those already there are not asked for again.
+		Any missing from the combined output are fetched one at a time.
+		'''
+		if availableversions is None:
+			return self._version_result.then(lambda vs: self.get_programme_info_batch(indices, vs, priority, relevant))
+		versions = ",".join(availableversions)
+		single_args = {index: self._parse_args(index, info="", versions=versions) for index in indices}
+		known = {}
+		for index, args in single_args.iteritems():
+			cached = self.query_cache.get("info", args)
+			if cached is not None:
+				known[index] = cached
+		wanted = [index for index in single_args if index not in known]
+		if not wanted:
+			return PendingResult.constant(known)
+		generation = self.query_cache.generation
+		batch = self._call(self._parse_args(*wanted, info="", versions=versions), priority=priority, relevant=relevant, operation="get_programme_info_batch", pooled=True)
+		def split(output):
+			infos = split_info(output, availableversions)
+			for index, info in infos.iteritems():
+				if index in single_args:
+					self.query_cache.put("info", single_args[index], info, generation)
+			return infos
+		def fill_in(infos):
+			found = dict(known)
+			found.update((index, infos[index]) for index in wanted if index in infos)
+			return self._fetch_each(found, [index for index in wanted if index not in infos],
+				lambda index: self.get_programme_info(index, availableversions, priority, relevant))
+		return batch.translate(INSTRUMENTATION.timed("get_programme_info_batch", "parse", split)).then(fill_in)
+
+	def get_stream_info_batch(self, indices, versions, priority=PRIORITY_TREE, relevant=None):
+		'''
+		Streams for every version of many programmes, as {index: {version: streams}}, each put in the query cache
+		as get_stream_info() would. One get_iplayer run covers them all if its output says which programme each
+		stream belongs to. Otherwise there is one run per programme, which still covers all of its versions.
+		'''
+		single_args = {(index, version): self._parse_args(index, version=version, streaminfo="") for index in indices for version in versions}
+		known = {}
+		for (index, version), args in single_args.iteritems():
+			cached = self.query_cache.get("streaminfo", args)
+			if cached is not None:
+				known.setdefault(index, {})[version] = cached
+		wanted = [index for index in indices if len(known.get(index, {})) < len(versions)]
+		if not wanted:
+			return PendingResult.constant(known)
+		generation = self.query_cache.generation
+		batch = self._call(self._parse_args(*wanted, versions=",".join(versions), streaminfo=""), priority=priority, relevant=relevant, operation="get_stream_info_batch", pooled=True)
+		def split(output):
+			sections = {wanted[0]: output} if len(wanted) == 1 else split_streaminfo_by_programme(output, wanted)
+			streams = {}
+			for index, section in (sections or {}).iteritems():
+				byversion = split_streaminfo_by_version(section, versions)
+				if byversion is None:
+					continue
+				streams[index] = byversion
+				for version, versionstreams in byversion.iteritems():
+					if versionstreams: # Versions the programme does not have are left for get_stream_info() to report
+						self.query_cache.put("streaminfo", single_args[(index, version)], versionstreams, generation)
+			return streams
+		def fill_in(streams):
+			found = dict(known)
+			found.update((index, streams[index]) for index in wanted if index in streams)
+			missing = [index for index in wanted if index not in streams]
+			if len(wanted) > 1:
+				fetch = lambda index: self.get_stream_info_batch([index], versions, priority, relevant)
+				return self._fetch_each(found, missing, lambda index: fetch(index).translate(lambda each: each[index]))
+			# Streams that do not say their version have to be asked for one version at a time
+			fetch = lambda index: PendingResult.all(**{version: self.get_stream_info(index, version, priority, relevant) for version in versions})
+			return self._fetch_each(found, missing, fetch)
+		return batch.translate(INSTRUMENTATION.timed("get_stream_info_batch", "parse", split)).then(fill_in)
+
+	def get_programme_info_and_streams_batch(self, indices, availableversions=None, priority=PRIORITY_TREE, relevant=None):
+		'''As get_programme_info_and_streams() for many programmes, as {index: info}, in two get_iplayer runs where possible.'''
+		def get_streams(infos):
+			versions = parse_versions(info.get("versions", "") for info in infos.itervalues())
+			if not versions:
+				return PendingResult.constant({index: dict(info, streams={}) for index, info in infos.iteritems()})
+			def combine(streams):
+				return {
+					index: dict(info, streams={
+						version: streams.get(index, {}).get(version, {}) for version in info.get("versions", "").split(",") if version
+					})
+					for index, info in infos.iteritems()
+				}
+			return self.get_stream_info_batch(list(infos), versions, priority, relevant).translate(combine)
+		return self.get_programme_info_batch(indices, availableversions, priority, relevant).then(get_streams)
+
+	def _fetch_each(self, found, missing, fetch):
+		'''Add fetch(index) for each missing index to what was found, once they have all arrived.'''
+		if not missing:
+			return PendingResult.constant(found)
+		def combine(fetched):
+			combined = dict(found)
+			combined.update((int(index), result) for index, result in fetched.iteritems())
+			return combined
+		return PendingResult.all(**{str(index): fetch(index) for index in missing}).translate(combine)
+
+	def record_programme(self, index, displayname=None, version="default", mode="best", onprocess=None):
+		'''Start recording straight away, RecordingQueue decides when to call this for the plugin.'''
 		if displayname is None:
 			displayname = "Programme %s" % index
 		self.recordings[index] = (displayname, version, mode)
+		progress = RecordingProgress()
+		self._recording_progress[(index, version)] = progress
 		args = self._parse_args(index, output=self.output_location, get="", versions=version, modes=mode)
-		recording = self._call(args, longoutput=True)
-		recording.on_complete(lambda _: self.recordings.pop(index, None))
+		recording = self._call(args, longoutput=True, priority=None, operation="record_programme", onprocess=onprocess, progress=progress)
+		def finished():
+			self.recordings.pop(index, None)
+			if self._recording_progress.get((index, version)) is progress:
+				del self._recording_progress[(index, version)]
+		recording.on_complete(always=lambda res, errs: finished(), oncancel=finished)
 		return recording
 
+	def get_recording_progress(self, index, version="default"):
+		'''How far the recording of a version of a programme has got, as a RecordingProgress snapshot, or None if it is not recording.'''
+		progress = self._recording_progress.get((index, version))
+		return None if progress is None else progress.snapshot()
+
 	def get_history(self, guess_version=True):
+		if self.history_index is not None and self.history_index.available():
+			read = INSTRUMENTATION.timed("get_history", "native", self.history_index.get_history)
+			return PendingResult.constant(self._index_local_copies(read(guess_version)))
 		args = self._parse_args(
 			history="",
 			skipdeleted="",
 			listformat="(<index>):(<name>):(<episode>):(<versions>):(<mode>):(<filename>)"
 		)
-		history = self._call(args)
-		return history.translate(lambda h: list(parse_history(h, guess_version)))
+		history = self._call(args, operation="get_history")
+		parse = INSTRUMENTATION.timed("get_history", "parse", lambda h: list(parse_history(h, guess_version)))
+		return history.translate(lambda h: self._index_local_copies(parse(h)))
+
+	def _index_local_copies(self, history):
+		'''Remember where each programme and version has been recorded to, then give back the history unchanged.'''
+		local_copies = {}
+		for index, name, episode, version, mode, location in history:
+			if index != -1:
+				local_copies[(index, version)] = (location, name, episode)
+		self._local_copies = local_copies
+		return history
+
+	def find_local_copy(self, index, version=None, preferred_version=None):
+		'''
+		A finished recording of a programme that can be played instead of streaming it, as (location, name, episode).
+		Without a version, the preferred version is chosen if it has been recorded, otherwise any that has.
+		Only knows of recordings in the history as last read by get_history(), or recorded since. None if there are none.
+		'''
+		if version is not None:
+			candidates = [version]
+		else:
+			candidates = [preferred_version] + sorted(v for i, v in self._local_copies if i == index and v != preferred_version)
+		for candidate in candidates:
+			local = self._local_copies.get((index, candidate))
+			if local is not None and os.path.isfile(local[0]):
+				return local
+		return None
+
+	def recording_deleted(self, location):
+		'''Tell the history a recording's file has been removed, so it is left out straight away.'''
+		if self.history_index is not None:
+			self.history_index.forget(location)
+		self._local_copies = {key: local for key, local in self._local_copies.iteritems() if local[0] != location}
 
 	def stream_programme_to_external(self, index, version="default", mode="best", stream_cmd="totem fd://0 --no-existing-session"):
 		'''Stream a program to an external program's stdin.'''
 		args = self._parse_args(index, versions=version, modes=mode, stream="", player=stream_cmd, q="")
-		return self._call(args)
+		return self._call(args, priority=None, operation="stream_programme_to_external")
 
-	def stream_programme_to_pipe(self, index, version="default", mode="best"):
-		'''Stream a program to a pipe, and return Totem's file descriptor for it.'''
+	def stream_programme_to_pipe(self, index, version="default", mode="best", buffer_bytes=0):
+		'''
+		Stream a program to a pipe, and return Totem's file descriptor for it.
+		Given buffer_bytes, the stream goes through a StreamRelay with that much read-ahead rather than straight into the pipe.
+		'''
 		rfd, wfd = os.pipe()
 		args = self._parse_args(index, versions=version, modes=mode, stream="")
-		streamresult = self._call_stream(wfd, args)
-		streamresult.on_complete(lambda _: os.close(wfd))
-		streamresult.on_complete(lambda _: os.close(rfd))
+		if not buffer_bytes:
+			streamresult = self._call_stream(wfd, args, operation="stream_programme_to_pipe")
+			streamresult.on_complete(lambda _: os.close(wfd), oncancel=lambda: os.close(wfd))
+			streamresult.on_complete(lambda _: os.close(rfd), oncancel=lambda: os.close(rfd))
+			return rfd, streamresult
+
+		self._abort_main_relay() # Whatever it was playing has been replaced
+		source, sourcewrite = os.pipe()
+		try:
+			streamresult = self._call_stream(sourcewrite, args, operation="stream_programme_to_pipe")
+		except OSError:
+			for fd in (source, rfd, wfd):
+				os.close(fd)
+			raise
+		finally:
+			os.close(sourcewrite) # get_iplayer has its own copy
+		relay = StreamRelay(source, wfd, rfd, buffer_bytes, IO_REACTOR, mode)
+		self._main_relay = relay
+		streamresult.on_complete(oncancel=relay.abort)
 		return rfd, streamresult
 
+	def stream_programme_to_http(self, index, version="default", mode="best"):
+		'''
+		Stream a program into a spool file served over HTTP on the loopback interface, returning the url for Totem.
+		Totem can seek back within what has already arrived without it being fetched again.
+		'''
+		self._close_main_spool() # Whatever it was playing has been replaced
+		if not os.path.isdir(self.spool_location):
+			os.makedirs(self.spool_location)
+		args = self._parse_args(index, versions=version, modes=mode, stream="")
+		source, sink = os.pipe()
+		try:
+			streamresult = self._call_stream(sink, args, operation="stream_programme_to_http")
+		except OSError:
+			os.close(source)
+			raise
+		finally:
+			os.close(sink) # get_iplayer has its own copy
+		if self._stream_proxy is None:
+			self._stream_proxy = StreamProxy()
+		url = self._stream_proxy.add(Spool(source, IO_REACTOR, self.spool_location))
+		self._main_spool_url = url
+		self._main_spool_recording = False
+		streamresult.on_complete(oncancel=lambda: self._stream_proxy.remove(url))
+		return url, streamresult
+
+	def stream_and_record_programme(self, index, displayname=None, version="default", mode="best", http=False):
+		'''
+		Stream a program to Totem while saving it, from a single download. The stream is spooled into output_location,
+		and Totem follows the spool either through a pipe or, with http, over the loopback StreamProxy.
+		Playback can be stopped without stopping the recording. Returns Totem's url and a pending result for
+		where the recording was saved, which is added to the download history once the stream has all arrived.
+		'''
+		self.close_main_stream() # Whatever it was playing has been replaced
+		if displayname is None:
+			displayname = "Programme %s" % index
+		if not os.path.isdir(self.output_location):
+			os.makedirs(self.output_location)
+		prog = self.programme_cache.get_programme(index) if self.programme_cache is not None else None
+		info = None if prog is not None else self.get_programme_info(index, priority=PRIORITY_BACKGROUND)
+		args = self._parse_args(index, versions=version, modes=mode, stream="")
+		source, sink = os.pipe()
+		try:
+			streamresult = self._call_stream(sink, args, operation="stream_and_record_programme", limit=False)
+		except OSError:
+			os.close(source)
+			raise
+		finally:
+			os.close(sink) # get_iplayer has its own copy
+		spool = Spool(source, IO_REACTOR, directory=self.output_location) # Same filesystem, so saving it is a rename
+		self.recordings[index] = (displayname, version, mode)
+
+		if http:
+			if self._stream_proxy is None:
+				self._stream_proxy = StreamProxy()
+			url = self._stream_proxy.add(spool)
+			self._main_spool_url = url
+			self._main_spool_recording = True
+		else:
+			rfd, wfd = os.pipe()
+			self._main_feed = SpoolFeeder(spool, wfd, rfd)
+			url = "fd://%s" % (rfd,)
+
+		def save(_):
+			if streamresult.get_errors() or not spool.wait_finished():
+				return None # The spool is thrown away when finished
+			entry = {}
+			if prog is not None:
+				entry = dict(prog)
+			else:
+				try:
+					if not info.get_errors(): # Long since fetched, the stream having all arrived
+						entry = {
+							field: value.get(version, "") if isinstance(value, dict) else value
+							for field, value in info.get_result().iteritems()
+						}
+				except CancelledError:
+					pass
+			entry.setdefault("name", displayname)
+			prefix = " ".join(str(part) for part in (entry.get("name"), entry.get("episode"), entry.get("pid"), version) if part)
+			location = os.path.join(self.output_location, re.sub(r"[^\w\-]+", "_", prefix) + container_extension(spool.filename))
+			if os.path.exists(location):
+				sys.stderr.write("Not saving %s, it has already been recorded to %s\n" % (displayname, location))
+				return None
+			spool.keep(location)
+			entry.update(mode=mode, filename=location, versions=version, timeadded=int(time.time()))
+			append_history(self.history_file, entry)
+			self._local_copies[(index, version)] = (location, entry["name"], entry.get("episode", ""))
+			return location
+		recorded = streamresult.translate(save)
+		def finished():
+			self.recordings.pop(index, None)
+			spool.close() # Deletes it unless it was saved, anything still playing it carries on from the saved file
+		recorded.on_complete(always=lambda res, errs: finished(), oncancel=finished)
+		return url, recorded
+
+	def _close_main_spool(self):
+		if self._main_spool_url is not None:
+			# A recording's spool is closed once it is saved, not when Totem stops playing it
+			self._stream_proxy.remove(self._main_spool_url, close=not self._main_spool_recording)
+			self._main_spool_url = None
+
+	def _stop_main_feed(self):
+		if self._main_feed is not None:
+			self._main_feed.stop()
+			self._main_feed = None
+
+	def _abort_main_relay(self):
+		if self._main_relay is not None:
+			self._main_relay.abort()
+			self._main_relay = None
+
+	def stream_stats(self):
+		'''Buffering statistics for the main stream if it is being relayed, see StreamRelay.stats().'''
+		relay = self._main_relay
+		return None if relay is None else relay.stats()
+
 	def get_subtitles(self, index, version="default"):
 		'''Download subtitles for a program, returning a pending result for the output location or None if there were no subtitles.'''
 		args = self._parse_args(index, output=self.output_location, get="", **{"subtitles-only": ""})
-		st = self._call(args)
-		return st.translate(parse_subtitles)
+		st = self._call(args, priority=PRIORITY_INTERACTIVE, operation="get_subtitles")
+		return st.translate(INSTRUMENTATION.timed("get_subtitles", "parse", parse_subtitles))
 
 	def refresh_cache(self, full, *types):
 		'''Complete refresh of the cache for every type given, or all if no types given.'''
@@ -535,9 +1711,12 @@ class GetIPlayer(object):
 			kwargs["refresh"] = ""
 		# Localfiles does not get refreshed properly unless we do full
 		separate_localfile_refresh = not full and ("all" in types or "localfiles" in types)
-		localrefresh = self._call(self._parse_args(q="", type="localfiles", refresh=""), norefresh=False) if separate_localfile_refresh else PendingResult.constant("")
+		localrefresh = self._call(self._parse_args(q="", type="localfiles", refresh=""), norefresh=False, priority=PRIORITY_BACKGROUND, operation="refresh_cache") if separate_localfile_refresh else PendingResult.constant("")
 		args = self._parse_args(list="categories", q="", type=typestr, **kwargs)
-		return localrefresh.then(lambda _: self._call(args, norefresh=False))
+		self.query_cache.invalidate()
+		refreshed = localrefresh.then(lambda _: self._call(args, norefresh=False, priority=PRIORITY_BACKGROUND, operation="refresh_cache"))
+		refreshed.on_complete(always=lambda res, errs: self.query_cache.invalidate())
+		return refreshed
 
 class ProcessLimiter(object):
 	'''Limits the number of concurrent processes by killing old ones.'''
@@ -573,69 +1752,119 @@ class ProcessLimiter(object):
 MAIN_STREAM_LIMITER = ProcessLimiter(1)
 
 class ProcessMonitor(object):
-	'''Monitors the input and output streams of a process to detect when an error occurs and stop it.'''
+	'''
+	Monitors the input and output streams of a process to detect when an error occurs and stop it.
+	The streams are read by the I/O reactor as output arrives, so no thread waits on them.
+	If onoutput is given it is called with each normal line from stdout as soon as it is read, and onerroutput
+	with each normal line from stderr. With splitcr carriage returns end lines too, and with maxlines only
+	that many of the latest lines of each kind are kept from each stream.
+	'''
 
-	def __init__(self, proc, listenstd=False, listenerr=True, filterstd=None, filtererr=None, haltonerror=False):
+	def __init__(self, proc, listenstd=False, listenerr=True, filterstd=None, filtererr=None, haltonerror=False, strip=True, reactor=None, onoutput=None, onerroutput=None, splitcr=False, maxlines=None):
 		self._proc = proc
-		self._stdout = []
-		self._stderr = []
 		self._haltonerror = haltonerror
 		self._terminated = False
-		self._threads = []
+		self._strip = strip
+		self._lock = threading.Lock()
+		self._open = 0
+		self._finished = threading.Event()
+		self._streams = [] # (normal lines, error lines) for each stream, in the order they were listened to
+		self.first_output_time = None # When anything was first read from the streams
+		self.finished_time = None # When every stream had ended
 
 		if filterstd is None:
 			filterstd = lambda _: False
 		if filtererr is None:
 			filtererr = lambda _: True
 
+		listening = []
 		if listenstd:
-			self._threads.append(threading.Thread(target=self._readstream, args=(proc.stdout, self._stdout, filterstd)))
+			listening.append((proc.stdout, filterstd, onoutput))
 		if listenerr:
-			self._threads.append(threading.Thread(target=self._readstream, args=(proc.stderr, self._stderr, filtererr)))
-		for thread in self._threads:
-			thread.start()
-
-	def _readstream(self, stream, defaultstream, filter_iserror):
-		'''Reads a stream, optionally filters into error and standard streams and can specify that any output is and error when not filtered. Will block.'''
-		so = self._stdout.append
-		se = self._stderr.append
-		if self._haltonerror:
-			def se(line):
-				self._stderr.append(line)
-				self._forceterminate()
-
-		def addtostream(line):
-			(se if filter_iserror(line) else so)(line)
-			
-		line = stream.readline()
-		while line and not self._terminated:
-			addtostream(line.strip())
-			line = stream.readline()
+			listening.append((proc.stderr, filtererr, onerroutput))
+		self._open = len(listening)
+		if not listening:
+			self._finished.set()
+		reactor = reactor or IO_REACTOR
+		for stream, filter_iserror, online in listening:
+			lines = (deque(maxlen=maxlines), deque(maxlen=maxlines))
+			self._streams.append(lines)
+			reader = LineReader(self._classifier(lines, filter_iserror, online), lambda stream=stream: self._stream_ended(stream), splitcr)
+			reactor.add_reader(stream.fileno(), reader)
+
+	def _classifier(self, lines, filter_iserror, online):
+		'''
+		Create a function that files each line as normal output or an error, optionally halting on errors.
+		Normal lines are also passed to online, if given.
+		'''
+		normal, errors = lines
+		def classify(line):
+			if self.first_output_time is None:
+				self.first_output_time = time.time()
+			if self._terminated:
+				return # Drain what is left but ignore it
+			line = line.strip() if self._strip else line.rstrip("\r")
+			if filter_iserror(line):
+				errors.append(line)
+				if self._haltonerror:
+					self._forceterminate()
+			else:
+				normal.append(line)
+				if online is not None:
+					online(line)
+		return classify
+
+	def _stream_ended(self, stream):
+		stream.close()
+		with self._lock:
+			self._open -= 1
+			finished = self._open == 0
+		if finished:
+			self.finished_time = time.time()
+			self._finished.set()
+			COMPLETION_DISPATCHER.wake()
 
 	def _forceterminate(self):
-		self._proc.terminate()
+		'''Ask the process and anything it started to stop, as its children would otherwise keep its pipes open.'''
 		self._terminated = True
+		if self._proc.poll() is None:
+			try:
+				os.killpg(self._proc.pid, signal.SIGTERM) # Started in a session of its own, see __call()
+			except OSError:
+				sys.stderr.write("Could not terminate process %s" % (self._proc.pid,))
+
+	def kill(self):
+		'''Kill the process and anything it started.'''
+		self._terminated = True
+		if self._proc.poll() is None:
+			try:
+				os.killpg(self._proc.pid, signal.SIGKILL)
+			except OSError:
+				sys.stderr.write("Could not terminate process %s" % (self._proc.pid,))
 
 	def stdout(self, splitlines=True):
-		'''Get the current set of lines in stdout.'''
+		'''Get the current set of lines in stdout, output classified as normal from every stream.'''
+		lines = [line for normal, _ in self._streams for line in normal]
 		if splitlines:
-			return self._stdout
+			return lines
 		else:
-			return "\n".join(self._stdout)
+			return "\n".join(lines)
 
 	def stderr(self, splitlines=True):
-		'''Get the current set of lines in stderr.'''
+		'''Get the current set of lines in stderr, output classified as errors from every stream.'''
+		lines = [line for _, errors in self._streams for line in errors]
 		if splitlines:
-			return self._stderr
+			return lines
 		else:
-			return "\n".join(self._stderr)
+			return "\n".join(lines)
 
 	def get_pending_result(self):
 		def blocking_result():
-			for thread in self._threads:
-				thread.join()
+			self._finished.wait()
+			self._proc.wait()
 			return self.stdout(False), self.stderr(True)
 		return PendingResult(
-			lambda: not any(thread.is_alive() for thread in self._threads) and self._proc.poll() is not None,
+			self._finished.is_set, # The process is reaped once the result is taken, its streams having ended
 			blocking_result,
-			True)
+			True,
+			self.kill)
@@ -0,0 +1,104 @@
+'''
+Profiles the callbacks the plugin queues on the GTK main loop, to find anything that stalls Totem's interface.
+'''
+
+# totem-get-iplayer
+# Copyright (C) 2013  Andy Gurden
+#
+#     This file is part of totem-get-iplayer.
+#
+#     totem-get-iplayer is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     totem-get-iplayer is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with totem-get-iplayer.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import time
+from collections import deque
+import gobject
+from getiplayer_instrumentation import Instrumentation
+
+def callback_name(callback):
+	'''A name to group a callback's timings under, with where it was defined so closures and lambdas can be told apart.'''
+	function = getattr(callback, "im_func", callback)
+	code = getattr(function, "func_code", None)
+	name = getattr(function, "__name__", repr(callback))
+	owner = getattr(callback, "im_class", None)
+	if owner is not None:
+		name = "%s.%s" % (owner.__name__, name)
+	if code is not None:
+		name = "%s@%s:%d" % (name, os.path.basename(code.co_filename), code.co_firstlineno)
+	return name
+
+class MainLoopProfiler(object):
+	'''
+	Stands in for gobject.idle_add and gobject.timeout_add. When enabled, it records how long each callback waited
+	in the main loop's queue and how long it ran, grouped by callback, and logs any run longer than the stall threshold.
+	When disabled, it hands straight over to gobject.
+	'''
+
+	def __init__(self):
+		self.enabled = False
+		self.stall_threshold = 0.1
+		self.timings = Instrumentation() # Operations are callback names, metrics queue_wait and runtime
+		self.stalls = deque(maxlen=100) # (when, seconds, callback name) of recent stalls
+		self.write = sys.stderr.write
+
+	def enable(self, stall_threshold=0.1, dump_interval=None, reactor=None):
+		'''Start profiling, logging callbacks that run for longer than stall_threshold seconds.'''
+		self.stall_threshold = stall_threshold
+		self.enabled = True
+		self.timings.enable(dump_interval, reactor, self.write)
+
+	def disable(self):
+		self.enabled = False
+		self.timings.disable()
+
+	def _wrap(self, callback, queued, interval=0):
+		name = callback_name(callback)
+		ready = [queued] # When the callback was due to run, updated each time it asks to run again
+		def profiled(*args, **kwargs):
+			started = time.time()
+			try:
+				return callback(*args, **kwargs)
+			finally:
+				finished = time.time()
+				runtime = finished - started
+				self.timings.record(name, "queue_wait", started - ready[0])
+				self.timings.record(name, "runtime", runtime)
+				ready[0] = finished + interval # A repeating timeout is next due an interval after this run
+				if runtime > self.stall_threshold:
+					self.stalls.append((started, runtime, name))
+					self.write("Main loop stalled for %.0fms by %s\n" % (runtime * 1000, name))
+		return profiled
+
+	def idle_add(self, callback, *args, **kwargs):
+		if not self.enabled:
+			return gobject.idle_add(callback, *args, **kwargs)
+		return gobject.idle_add(self._wrap(callback, time.time()), *args, **kwargs)
+
+	def timeout_add(self, interval, callback, *args, **kwargs):
+		if not self.enabled:
+			return gobject.timeout_add(interval, callback, *args, **kwargs)
+		# Waiting only counts from when the timeout was due
+		return gobject.timeout_add(interval, self._wrap(callback, time.time() + interval / 1000.0, interval / 1000.0), *args, **kwargs)
+
+	def snapshot(self):
+		'''Summaries of queue_wait and runtime for each callback.'''
+		return self.timings.snapshot()
+
+	def dump(self):
+		return self.timings.dump()
+
+MAIN_LOOP = MainLoopProfiler()
+idle_add = MAIN_LOOP.idle_add
+timeout_add = MAIN_LOOP.timeout_add
@@ -0,0 +1,120 @@
+'''
+Looks up programmes the user is likely to click next before they do, so the info panel can be filled from memory.
+'''
+
+# totem-get-iplayer
+# Copyright (C) 2013  Andy Gurden
+#
+#     This file is part of totem-get-iplayer.
+#
+#     totem-get-iplayer is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     totem-get-iplayer is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with totem-get-iplayer.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+from collections import defaultdict, deque
+from getiplayer_interface import PRIORITY_BACKGROUND
+
+class Prefetcher(object):
+	'''
+	Warms the query cache with the info and stream info of programmes, and the thumbnail cache with their
+	thumbnails, at background priority. Programmes are looked up batch_size at a time with the batch queries,
+	with at most max_running batches under way. Each call to prefetch() replaces whatever was asked for before,
+	cancelling what has not finished, and cancel() stops everything.
+	'''
+
+	def __init__(self, gip, thumbnails=None, thumbnail_size=None, max_running=1, batch_size=8):
+		self.gip = gip
+		self.thumbnails = thumbnails # A ThumbnailCache, or None to leave thumbnails alone
+		self.thumbnail_size = thumbnail_size # (width, height) thumbnails are shown at
+		self.max_running = max_running
+		self.batch_size = batch_size
+		self._lock = threading.Lock()
+		self._generation = 0
+		self._version = None
+		self._wanted = None # What was last asked for, so asking again does not start it over
+		self._queued = deque() # Batches of indices waiting to be looked up
+		self._running = [] # Pending results of the batches being looked up
+		self._stats = defaultdict(int)
+
+	def prefetch(self, indices, version):
+		'''Look up the programmes, along with the streams of the given version, in place of anything asked for before.'''
+		indices = list(indices)
+		if (indices, version) == self._wanted:
+			return
+		self.cancel()
+		with self._lock:
+			self._wanted = (indices, version)
+			self._version = version
+			for start in xrange(0, len(indices), self.batch_size):
+				self._queued.append(indices[start:start + self.batch_size])
+			self._stats["requested"] += len(indices)
+		self._start_queued()
+
+	def cancel(self):
+		with self._lock:
+			self._generation += 1
+			self._wanted = None
+			self._queued.clear()
+			running, self._running = self._running, []
+		cancelled = sum(1 for result in running if result.cancel())
+		with self._lock:
+			self._stats["cancelled"] += cancelled
+
+	def _relevance(self):
+		generation = self._generation
+		return lambda: generation == self._generation
+
+	def _start_queued(self):
+		while True:
+			with self._lock:
+				if len(self._running) >= self.max_running or not self._queued:
+					return
+				batch = self._queued.popleft()
+				version = self._version
+				relevant = self._relevance()
+				self._stats["batches"] += 1
+			def got_infos(infos, relevant=relevant, version=version):
+				self._prefetch_thumbnails(infos, relevant)
+				having_version = [index for index, info in infos.iteritems() if version in info.get("versions", "").split(",")]
+				return self.gip.get_stream_info_batch(having_version, [version], PRIORITY_BACKGROUND, relevant)
+			result = self.gip.get_programme_info_batch(batch, priority=PRIORITY_BACKGROUND, relevant=relevant).then(got_infos)
+			with self._lock:
+				if not relevant():
+					result.cancel() # Replaced while it was being started
+					continue
+				self._running.append(result)
+			result.on_complete(always=lambda res, errs, result=result: self._finished(result), oncancel=lambda result=result: self._finished(result))
+
+	def _prefetch_thumbnails(self, infos, relevant):
+		if self.thumbnails is None or self.thumbnail_size is None:
+			return
+		width, height = self.thumbnail_size
+		for info in infos.itervalues():
+			thumbnail = info.get("thumbnail")
+			if thumbnail:
+				self.thumbnails.prefetch(thumbnail, width, height, cancelcheck=lambda: not relevant())
+
+	def _finished(self, result):
+		with self._lock:
+			if result not in self._running:
+				return # Cancelled
+			self._running.remove(result)
+			self._stats["completed"] += 1
+		self._start_queued()
+
+	def stats(self):
+		with self._lock:
+			stats = dict(self._stats)
+			stats["queued"] = sum(len(batch) for batch in self._queued)
+			stats["running"] = len(self._running)
+		return stats
@@ -0,0 +1,245 @@
+'''
+A single thread that waits on the pipes of every running process at once, instead of a thread per pipe.
+'''
+
+# totem-get-iplayer
+# Copyright (C) 2013  Andy Gurden
+#
+#     This file is part of totem-get-iplayer.
+#
+#     totem-get-iplayer is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     totem-get-iplayer is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with totem-get-iplayer.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+import errno
+import fcntl
+import heapq
+import select
+import threading
+import traceback
+
+READ_SIZE = 65536
+
+def set_nonblocking(fd):
+	flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+	fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+class _EpollPoller(object):
+	def __init__(self):
+		self._epoll = select.epoll()
+
+	def register(self, fd, writable=False):
+		self._epoll.register(fd, select.EPOLLOUT if writable else select.EPOLLIN)
+
+	def unregister(self, fd):
+		self._epoll.unregister(fd)
+
+	def poll(self, timeout):
+		return [fd for fd, _ in self._epoll.poll(-1 if timeout is None else timeout)]
+
+class _SelectPoller(object):
+	'''For platforms without epoll.'''
+	def __init__(self):
+		self._readers = set()
+		self._writers = set()
+
+	def register(self, fd, writable=False):
+		(self._writers if writable else self._readers).add(fd)
+
+	def unregister(self, fd):
+		self._readers.discard(fd)
+		self._writers.discard(fd)
+
+	def poll(self, timeout):
+		readable, writable, _ = select.select(list(self._readers), list(self._writers), [], timeout)
+		return readable + writable
+
+class IOReactor(object):
+	'''
+	Watches file descriptors and runs callbacks as they become ready, all from one thread which is started on first use.
+	Callbacks run on the reactor's thread so must be quick, anything slow should be handed off elsewhere.
+	'''
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._poller = _EpollPoller() if hasattr(select, "epoll") else _SelectPoller()
+		self._handlers = {} # fd : callback
+		self._timers = [] # Heap of (when, sequence, callback)
+		self._timer_sequence = 0
+		self._cancelled_timers = set()
+		self._thread = None
+		self._wakeread, self._wakewrite = os.pipe()
+		set_nonblocking(self._wakeread)
+		set_nonblocking(self._wakewrite)
+		self._poller.register(self._wakeread)
+		self._iterations = 0
+		self._bytes_read = 0
+
+	def _ensure_running(self):
+		if self._thread is None:
+			self._thread = threading.Thread(target=self._run)
+			self._thread.daemon = True
+			self._thread.start()
+
+	def _wake(self):
+		try:
+			os.write(self._wakewrite, "x")
+		except OSError as exc:
+			if exc.errno != errno.EAGAIN:
+				raise # A full wake pipe means a wake up is already on its way
+
+	def add_reader(self, fd, ondata):
+		'''
+		Call ondata(data) with whatever can be read from fd, and ondata("") once it reaches the end.
+		The descriptor is made non-blocking and stops being watched at the end, but is not closed.
+		'''
+		self.add_handler(fd, lambda: self._read(fd, ondata))
+
+	def add_writer(self, fd, onwritable):
+		'''Call onwritable() whenever fd can be written to, until it is removed.'''
+		self.add_handler(fd, onwritable, writable=True)
+
+	def add_handler(self, fd, onready, writable=False):
+		'''Call onready() whenever fd is ready, until it is removed.'''
+		set_nonblocking(fd)
+		with self._lock:
+			self._handlers[fd] = onready
+			self._poller.register(fd, writable)
+			self._ensure_running()
+		self._wake()
+
+	def remove(self, fd):
+		'''Stop watching fd.'''
+		with self._lock:
+			if self._handlers.pop(fd, None) is not None:
+				self._poller.unregister(fd)
+
+	def call_later(self, delay, callback):
+		'''Call callback() on the reactor thread after delay seconds. Returns a function to cancel the call.'''
+		with self._lock:
+			self._timer_sequence += 1
+			sequence = self._timer_sequence
+			heapq.heappush(self._timers, (time.time() + delay, sequence, callback))
+			self._ensure_running()
+		self._wake()
+		def cancel():
+			with self._lock:
+				if any(pending == sequence for _, pending, _ in self._timers):
+					self._cancelled_timers.add(sequence)
+		return cancel
+
+	def call_soon(self, callback):
+		'''Call callback() on the reactor thread as soon as possible.'''
+		return self.call_later(0, callback)
+
+	def _read(self, fd, ondata):
+		try:
+			data = os.read(fd, READ_SIZE)
+		except OSError as exc:
+			if exc.errno in (errno.EAGAIN, errno.EINTR):
+				return
+			data = "" # Treat a broken descriptor as having ended
+		self._bytes_read += len(data)
+		if not data:
+			self.remove(fd)
+		ondata(data)
+
+	def _due_timers(self):
+		'''Pop timers that are due, returns them and the seconds until the next one.'''
+		now = time.time()
+		due = []
+		with self._lock:
+			while self._timers and self._timers[0][0] <= now:
+				_, sequence, callback = heapq.heappop(self._timers)
+				if sequence in self._cancelled_timers:
+					self._cancelled_timers.discard(sequence)
+				else:
+					due.append(callback)
+			timeout = max(0, self._timers[0][0] - now) if self._timers else None
+		return due, timeout
+
+	def _run(self):
+		while True:
+			due, timeout = self._due_timers()
+			for callback in due:
+				self._call(callback)
+			if due:
+				continue # Timers may have added more work
+			try:
+				ready = self._poller.poll(timeout)
+			except (IOError, OSError, select.error) as exc:
+				if exc.args[0] == errno.EINTR:
+					continue
+				raise
+			self._iterations += 1
+			for fd in ready:
+				if fd == self._wakeread:
+					try:
+						while os.read(self._wakeread, 4096):
+							pass
+					except OSError:
+						pass
+					continue
+				with self._lock:
+					handler = self._handlers.get(fd)
+				if handler is not None:
+					self._call(handler)
+
+	def _call(self, callback):
+		try:
+			callback()
+		except Exception:
+			traceback.print_exc()
+
+	def stats(self):
+		'''Descriptors being watched, timers waiting and how much work the reactor has done.'''
+		with self._lock:
+			return {
+				"watching": len(self._handlers),
+				"timers": len(self._timers) - len(self._cancelled_timers),
+				"iterations": self._iterations,
+				"bytes_read": self._bytes_read,
+			}
+
+class LineReader(object):
+	'''
+	Splits data from add_reader into lines, calling online(line) for each without its line ending and onend() at the end.
+	With splitcr a carriage return also ends a line, for progress output that redraws itself in place. A carriage return
+	at the end of a chunk is held back until the next, in case that starts with the newline of a \r\n.
+	'''
+
+	def __init__(self, online, onend=None, splitcr=False):
+		self._online = online
+		self._onend = onend
+		self._splitcr = splitcr
+		self._partial = ""
+
+	def __call__(self, data):
+		if not data:
+			if self._partial:
+				self._online(self._partial[:-1] if self._splitcr and self._partial.endswith("\r") else self._partial)
+				self._partial = ""
+			if self._onend is not None:
+				self._onend()
+			return
+		data = self._partial + data
+		held = ""
+		if self._splitcr:
+			if data.endswith("\r"):
+				data, held = data[:-1], "\r"
+			data = data.replace("\r\n", "\n").replace("\r", "\n")
+		lines = data.split("\n")
+		self._partial = lines.pop() + held
+		for line in lines:
+			self._online(line)
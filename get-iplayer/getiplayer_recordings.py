@@ -0,0 +1,387 @@
+'''
+Queues recordings so only a few download at once, remembering them across restarts.
+'''
+
+# totem-get-iplayer
+# Copyright (C) 2013  Andy Gurden
+#
+#     This file is part of totem-get-iplayer.
+#
+#     totem-get-iplayer is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     totem-get-iplayer is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with totem-get-iplayer.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import json
+import time
+import errno
+import signal
+import tempfile
+import threading
+from getiplayer_interface import IO_REACTOR
+
+# Fields of a job that are saved, everything else only lasts as long as the process
+SAVED_FIELDS = ["id", "index", "pid", "name", "version", "mode", "priority", "state", "added", "attempts"]
+
+BANDWIDTH_TICK = 0.5 # Seconds between checks of how fast recordings are downloading
+MAX_PAUSE = 5 # Longest a recording is paused for in one go when over the bandwidth cap
+
+GROUP_RESCAN = 10 # Ticks between looking for processes that have joined a recording's process group
+
+# Whether the kernel lists each task's children, so a process tree can be found without reading all of /proc
+CHILDREN_LISTED = os.path.exists("/proc/self/task/%d/children" % (os.getpid(),))
+
+def process_group_of(pid):
+	'''The process group of a process from /proc, or None if it has gone.'''
+	try:
+		with open("/proc/%s/stat" % pid) as stat:
+			return int(stat.read().rsplit(")", 1)[1].split()[2])
+	except (IOError, OSError, IndexError, ValueError):
+		return None
+
+def process_group_members(pgid):
+	'''
+	The pids in a process group whose leader is pgid. Where the kernel lists children they are followed down
+	from the leader, otherwise every process in /proc has to be looked at.
+	'''
+	if CHILDREN_LISTED:
+		members = []
+		pending = [pgid]
+		while pending:
+			pid = pending.pop()
+			members.append(pid)
+			try:
+				for task in os.listdir("/proc/%d/task" % (pid,)):
+					with open("/proc/%d/task/%s/children" % (pid, task)) as children:
+						pending.extend(int(child) for child in children.read().split())
+			except (IOError, OSError, ValueError):
+				continue # Finished while we were looking
+	else:
+		try:
+			members = [int(name) for name in os.listdir("/proc") if name.isdigit()]
+		except OSError:
+			return []
+	return [pid for pid in members if process_group_of(pid) == pgid]
+
+def process_group_written_bytes(pgid, pids):
+	'''
+	Bytes written so far by those of pids still in the process group, from /proc, along with those pids.
+	The bytes are None if that cannot be found out.
+	'''
+	total = 0
+	found = []
+	for pid in pids:
+		if process_group_of(pid) != pgid:
+			continue # Finished, and the pid possibly reused
+		try:
+			with open("/proc/%d/io" % (pid,)) as io:
+				for line in io:
+					if line.startswith("wchar:"):
+						total += int(line.split()[1])
+						found.append(pid)
+		except (IOError, OSError, IndexError, ValueError):
+			continue # Finished while we were looking, or not ours to read
+	return (total if found else None), found
+
+class RecordingQueue(object):
+	'''
+	Runs recordings through get_iplayer, at most max_running at once. Waiting jobs start in priority order,
+	lowest first as with CallScheduler, then in the order they were added.
+
+	Queued and running jobs are saved to state_file, so they carry on after a restart. An interrupted recording
+	is simply run again, and get_iplayer carries on from the partial file it left behind.
+
+	If bandwidth is set (bytes per second, shared between running jobs) recordings that go over it are paused
+	with SIGSTOP for long enough to bring them back under, judged by how much their processes have written.
+	'''
+
+	def __init__(self, state_file=None, max_running=1, bandwidth=None, onchange=None, reactor=IO_REACTOR):
+		self.state_file = state_file
+		self.max_running = max_running
+		self.bandwidth = bandwidth
+		self.onchange = onchange # Called with a job whenever its state changes, from any thread
+		self._reactor = reactor
+		self._lock = threading.RLock()
+		self._jobs = [] # Every queued and running job, in the order they were added
+		self._next_id = 1
+		self._gip = None
+		self._closing = False
+		self._cancel_tick = None
+		self._load()
+
+	def _load(self):
+		if self.state_file is None:
+			return
+		try:
+			with open(self.state_file) as state:
+				saved = json.load(state)
+		except IOError as exc:
+			if exc.errno != errno.ENOENT:
+				sys.stderr.write("Could not read recording queue %s: %s\n" % (self.state_file, exc))
+			return
+		except ValueError as exc:
+			sys.stderr.write("Recording queue %s is corrupt, starting afresh: %s\n" % (self.state_file, exc))
+			return
+		for job in saved.get("jobs", []):
+			job["state"] = "queued" # Anything running was interrupted, so goes again
+			self._jobs.append(job)
+		self._next_id = max([saved.get("next_id", 1)] + [job["id"] + 1 for job in self._jobs])
+
+	def _save(self):
+		'''Write out the queue, replacing the file in one go so a crash cannot leave half of it.'''
+		if self.state_file is None:
+			return
+		with self._lock:
+			saved = {
+				"next_id": self._next_id,
+				"jobs": [{field: job.get(field) for field in SAVED_FIELDS} for job in self._jobs],
+			}
+		directory = os.path.dirname(self.state_file)
+		try:
+			if not os.path.isdir(directory):
+				os.makedirs(directory)
+			fd, temp = tempfile.mkstemp(dir=directory)
+			with os.fdopen(fd, "w") as out:
+				json.dump(saved, out)
+			os.rename(temp, self.state_file)
+		except (IOError, OSError) as exc:
+			sys.stderr.write("Could not save recording queue %s: %s\n" % (self.state_file, exc))
+
+	def _changed(self, job):
+		self._save()
+		if self.onchange is not None:
+			self.onchange(job)
+
+	def attach(self, gip):
+		'''Start running jobs with a GetIPlayer, including any left from last time.'''
+		with self._lock:
+			self._gip = gip
+			self._closing = False
+			if gip.programme_cache is not None:
+				gip.programme_cache.available() # Checked for changes once, not for every job
+			for job in self._jobs:
+				if job.get("pid") and gip.programme_cache is not None:
+					index = gip.programme_cache.get_index(job["pid"], refresh=False)
+					if index is not None:
+						job["index"] = index # Indexes can change when the cache is refreshed, pids do not
+		self._start_queued()
+
+	def close(self):
+		'''Stop watching the running jobs, which stay saved as running so they start again next time.'''
+		with self._lock:
+			self._closing = True
+			self._gip = None
+			for job in self._jobs:
+				self._resume(job)
+			if self._cancel_tick is not None:
+				self._cancel_tick()
+				self._cancel_tick = None
+
+	def add(self, index, name=None, version="default", mode="best", priority=0):
+		'''Queue a recording, returning its job id.'''
+		with self._lock:
+			job = {
+				"id": self._next_id, "index": index, "pid": None, "name": name or "Programme %s" % (index,),
+				"version": version, "mode": mode, "priority": priority, "state": "queued", "added": time.time(), "attempts": 0,
+			}
+			self._next_id += 1
+			if self._gip is not None and self._gip.programme_cache is not None:
+				prog = self._gip.programme_cache.get_programme(index)
+				if prog is not None:
+					job["pid"] = prog.get("pid") or None
+			self._jobs.append(job)
+		self._changed(job)
+		self._start_queued()
+		return job["id"]
+
+	def track(self, index, name, version, mode, result):
+		'''
+		Show a recording started some other way, such as one being watched while it downloads, as a running job
+		until result completes. It counts towards max_running and is saved like any other job, so if it is
+		interrupted it is recorded again next time. It is never paused for the bandwidth cap, as it is being watched.
+		Returns its job id.
+		'''
+		with self._lock:
+			job = {
+				"id": self._next_id, "index": index, "pid": None, "name": name or "Programme %s" % (index,),
+				"version": version, "mode": mode, "priority": 0, "state": "running", "added": time.time(), "attempts": 1,
+				"started": time.time(), "result": result,
+			}
+			self._next_id += 1
+			if self._gip is not None and self._gip.programme_cache is not None:
+				prog = self._gip.programme_cache.get_programme(index)
+				if prog is not None:
+					job["pid"] = prog.get("pid") or None
+			self._jobs.append(job)
+		self._changed(job)
+		result.on_complete(always=lambda res, errs: self._finished(job, errs), oncancel=lambda: self.cancel(job["id"]))
+		return job["id"]
+
+	def _job(self, job_id):
+		for job in self._jobs:
+			if job["id"] == job_id:
+				return job
+		return None
+
+	def set_priority(self, job_id, priority):
+		with self._lock:
+			job = self._job(job_id)
+			if job is None:
+				return
+			job["priority"] = priority
+		self._changed(job)
+
+	def cancel(self, job_id):
+		'''Remove a job from the queue, stopping it if it is already recording.'''
+		with self._lock:
+			job = self._job(job_id)
+			if job is None:
+				return
+			self._jobs.remove(job)
+			job["state"] = "cancelled"
+			result = job.get("result")
+		if result is not None:
+			result.cancel()
+		self._changed(job)
+		self._start_queued()
+
+	def jobs(self):
+		'''
+		Copies of every queued and running job, in the order they will run.
+		Running jobs include their progress, as given by GetIPlayer.get_recording_progress().
+		'''
+		with self._lock:
+			ordered = sorted(self._jobs, key=lambda job: (job["state"] != "running", job["priority"], job["added"]))
+			jobs = [{field: value for field, value in job.iteritems() if field not in ("result", "proc", "group")} for job in ordered]
+			for job in jobs:
+				if job["state"] == "running" and self._gip is not None:
+					job["progress"] = self._gip.get_recording_progress(job["index"], job["version"])
+			return jobs
+
+	def _start_queued(self):
+		while True:
+			with self._lock:
+				if self._gip is None or self._closing:
+					return
+				running = [job for job in self._jobs if job["state"] == "running"]
+				queued = [job for job in self._jobs if job["state"] == "queued"]
+				if len(running) >= self.max_running or not queued:
+					return
+				job = min(queued, key=lambda job: (job["priority"], job["added"]))
+				job["state"] = "running"
+				job["attempts"] += 1
+				job["started"] = time.time()
+				gip = self._gip
+			def got_process(proc, job=job):
+				job["proc"] = proc
+				job["written_bytes"] = 0 # A new process group, so everything it writes counts
+				job["debt"] = 0
+				job["group"] = None # Pids in the process group, found on the first tick
+				job["ticks"] = 0
+				self._ensure_ticking()
+			try:
+				result = gip.record_programme(job["index"], job["name"], job["version"], job["mode"], onprocess=got_process)
+			except OSError as exc:
+				self._finished(job, ["Could not start recording: %s" % (exc,)])
+				continue
+			with self._lock:
+				job["result"] = result
+				cancelled = job not in self._jobs
+			if cancelled:
+				result.cancel() # Cancelled while it was starting, when there was no result for cancel() to stop
+				continue
+			self._changed(job)
+			result.on_complete(always=lambda res, errs, job=job: self._finished(job, errs))
+
+	def _finished(self, job, errors):
+		with self._lock:
+			if self._closing or job not in self._jobs:
+				return # Cancelled, or killed because we are shutting down and should run again next time
+			self._jobs.remove(job)
+			job["state"] = "failed" if errors else "done"
+			job["errors"] = errors
+			job.pop("proc", None)
+			job.pop("result", None)
+		self._changed(job)
+		self._start_queued()
+
+	def _ensure_ticking(self):
+		with self._lock:
+			if self.bandwidth and self._cancel_tick is None and not self._closing:
+				self._cancel_tick = self._reactor.call_later(BANDWIDTH_TICK, self._tick)
+
+	def _tick(self):
+		'''
+		Pause any recording that has used more than its share of the bandwidth since the last tick.
+		Each recording's process group is remembered between ticks, and only looked for again every GROUP_RESCAN ticks.
+		'''
+		with self._lock:
+			self._cancel_tick = None
+			running = [job for job in self._jobs if job.get("proc") is not None and job["proc"].poll() is None]
+			if not self.bandwidth or not running:
+				for job in running:
+					self._resume(job)
+				return
+			groups = [(job, job["proc"].pid, job.get("group"), job.get("ticks", 0)) for job in running]
+		measured = [] # /proc is read without holding the lock
+		for job, pgid, group, ticks in groups:
+			if group is None or ticks % GROUP_RESCAN == 0:
+				group = process_group_members(pgid)
+			measured.append((job, ticks + 1) + process_group_written_bytes(pgid, group))
+		with self._lock:
+			if self._closing:
+				return
+			share = float(self.bandwidth) / len(running)
+			for job, ticks, written, group in measured:
+				job["ticks"] = ticks
+				job["group"] = group
+				if written is None:
+					continue
+				last = job.get("written_bytes", written)
+				job["written_bytes"] = written
+				if job.get("paused"):
+					continue
+				# Allow for one tick of saving up, so a burst after a quiet spell is not punished
+				job["debt"] = max(-share * BANDWIDTH_TICK, job.get("debt", 0) + (written - last) - share * BANDWIDTH_TICK)
+				if job["debt"] > 0:
+					self._pause(job, min(MAX_PAUSE, job["debt"] / share))
+			self._cancel_tick = self._reactor.call_later(BANDWIDTH_TICK, self._tick)
+
+	def _pause(self, job, seconds):
+		try:
+			os.killpg(job["proc"].pid, signal.SIGSTOP)
+		except OSError:
+			return
+		job["paused"] = True
+		job["debt"] = 0
+		self._reactor.call_later(seconds, lambda: self._resume(job))
+
+	def _resume(self, job):
+		with self._lock:
+			if not job.get("paused"):
+				return
+			job["paused"] = False
+			try:
+				os.killpg(job["proc"].pid, signal.SIGCONT)
+			except OSError:
+				pass # Already gone
+
+	def stats(self):
+		with self._lock:
+			return {
+				"queued": sum(1 for job in self._jobs if job["state"] == "queued"),
+				"running": sum(1 for job in self._jobs if job["state"] == "running"),
+				"paused": sum(1 for job in self._jobs if job.get("paused")),
+				"max_running": self.max_running,
+				"bandwidth": self.bandwidth,
+			}
@@ -0,0 +1,533 @@
+'''
+Getting streams from get_iplayer to Totem: read-ahead buffering with statistics on how well it keeps up,
+and a local HTTP server that lets Totem seek within what has arrived.
+'''
+
+# totem-get-iplayer
+# Copyright (C) 2013  Andy Gurden
+#
+#     This file is part of totem-get-iplayer.
+#
+#     totem-get-iplayer is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     totem-get-iplayer is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with totem-get-iplayer.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import re
+import sys
+import time
+import errno
+import fcntl
+import socket
+import struct
+import termios
+import binascii
+import glob
+import tempfile
+import threading
+import SocketServer
+import BaseHTTPServer
+from collections import deque
+from getiplayer_instrumentation import INSTRUMENTATION
+
+# Linux fcntls for pipe capacity, which the fcntl module does not name
+F_SETPIPE_SZ = 1031
+F_GETPIPE_SZ = 1032
+
+SAMPLE_INTERVAL = 0.25 # Seconds between samples of how full the buffer is
+WRITE_SIZE = 64 * 1024 # Most written to Totem's pipe in one go
+SERVE_SIZE = 64 * 1024 # Most sent to Totem in one go over HTTP
+
+SPOOL_PREFIX = "totem-get-iplayer-"
+SPOOL_SUFFIX = ".spool"
+
+RE_BYTE_RANGE = re.compile(r"^bytes=(\d*)-(\d*)")
+
+def pipe_max_size():
+	'''The largest pipe an unprivileged process may ask for.'''
+	try:
+		with open("/proc/sys/fs/pipe-max-size") as limit:
+			return int(limit.read())
+	except (IOError, ValueError):
+		return 1024 * 1024
+
+def set_pipe_size(fd, size):
+	'''Ask for a pipe to hold size bytes, as far as the system allows. Returns the size it ended up, or None if unknown.'''
+	try:
+		return fcntl.fcntl(fd, F_SETPIPE_SZ, min(size, pipe_max_size()))
+	except (IOError, OSError):
+		try:
+			return fcntl.fcntl(fd, F_GETPIPE_SZ)
+		except (IOError, OSError):
+			return None
+
+def pipe_pending(fd):
+	'''Bytes waiting to be read from a pipe.'''
+	try:
+		return struct.unpack("i", fcntl.ioctl(fd, termios.FIONREAD, "\0" * 4))[0]
+	except (IOError, OSError):
+		return 0
+
+class StreamRelay(object):
+	'''
+	Copies a stream from get_iplayer's pipe into Totem's through a buffer of up to capacity bytes, on the I/O reactor.
+	Reading stops while the buffer is full, so get_iplayer is held back rather than using more memory.
+	Totem's pipe is enlarged as far as allowed, and the rest of the capacity is held here.
+	The relay owns every descriptor it is given and closes them when it is done.
+
+	The relay samples how full it is, and counts underruns: times Totem had nothing left to read while the stream
+	was still going. Those and the throughput are recorded with the instrumentation under "stream:<mode>".
+	'''
+
+	def __init__(self, source, sink, reader, capacity, reactor, mode="best", onfinished=None):
+		self._source = source
+		self._sink = sink
+		self._reader = reader # Totem's end of the sink, to see how much it has still to read
+		self._reactor = reactor
+		self._operation = "stream:" + mode
+		self._onfinished = onfinished
+		self._lock = threading.Lock()
+		self._chunks = deque()
+		self._buffered = 0
+		self._reading = True
+		self._writing = False
+		self._source_ended = False
+		self._finished = False
+		self.pipe_size = set_pipe_size(sink, capacity) or 0
+		self.capacity = max(capacity - self.pipe_size, WRITE_SIZE)
+		self.started = time.time()
+		self.first_byte_time = None
+		self.bytes_in = 0
+		self.bytes_out = 0
+		self.underruns = 0
+		self.underrun_seconds = 0.0
+		self._underrun_since = None
+		self._fill_total = 0
+		self._samples = 0
+		self._last_sample = (self.started, 0)
+		reactor.add_reader(source, self._read)
+		self._cancel_sample = reactor.call_later(SAMPLE_INTERVAL, self._sample)
+
+	def _read(self, data):
+		with self._lock:
+			if self._finished:
+				return
+			if not data:
+				self._source_ended = True
+			else:
+				if self.first_byte_time is None:
+					self.first_byte_time = time.time()
+				self._chunks.append(data)
+				self._buffered += len(data)
+				self.bytes_in += len(data)
+				if self._buffered >= self.capacity:
+					self._reading = False
+					self._reactor.remove(self._source) # Resumed once Totem has caught up
+			if not self._writing:
+				self._writing = True
+				self._reactor.add_writer(self._sink, self._write)
+
+	def _write(self):
+		with self._lock:
+			if self._finished:
+				return
+			while self._chunks:
+				chunk = self._chunks[0]
+				try:
+					written = os.write(self._sink, chunk[:WRITE_SIZE])
+				except OSError as exc:
+					if exc.errno in (errno.EAGAIN, errno.EINTR):
+						return
+					self._finish(drain=False) # Totem has gone
+					return
+				self.bytes_out += written
+				self._buffered -= written
+				if written == len(chunk):
+					self._chunks.popleft()
+				else:
+					self._chunks[0] = chunk[written:]
+			self._writing = False
+			self._reactor.remove(self._sink)
+			if self._source_ended:
+				self._finish()
+			elif not self._reading:
+				self._reading = True
+				self._reactor.add_reader(self._source, self._read)
+
+	def _finish(self, drain=True):
+		'''
+		Stop relaying, closing our ends. Totem's end is closed once it has read everything left in its pipe,
+		or straight away if not draining.
+		'''
+		if self._finished:
+			return
+		self._finished = True
+		self._reactor.remove(self._source)
+		self._reactor.remove(self._sink)
+		self._chunks.clear()
+		self._buffered = 0
+		for fd in (self._source, self._sink):
+			try:
+				os.close(fd)
+			except OSError:
+				pass
+		if drain:
+			self._close_reader_when_drained()
+		else:
+			self._close_reader()
+		if self._onfinished is not None:
+			self._reactor.call_soon(self._onfinished)
+
+	def _close_reader_when_drained(self):
+		if self._reader is None:
+			return
+		if pipe_pending(self._reader) > 0:
+			self._reactor.call_later(SAMPLE_INTERVAL, lambda: self._with_lock(self._close_reader_when_drained))
+		else:
+			self._close_reader()
+
+	def _with_lock(self, function):
+		with self._lock:
+			function()
+
+	def _close_reader(self):
+		if self._reader is not None:
+			try:
+				os.close(self._reader)
+			except OSError:
+				pass
+			self._reader = None
+
+	def abort(self):
+		'''Stop straight away, throwing away anything buffered.'''
+		with self._lock:
+			self._cancel_sample()
+			self._finish(drain=False)
+			self._close_reader()
+
+	def is_finished(self):
+		return self._finished
+
+	def pending(self):
+		'''Bytes Totem has not yet read, in the buffer and its pipe.'''
+		return self._buffered + (0 if self._reader is None else pipe_pending(self._reader))
+
+	def _sample(self):
+		with self._lock:
+			if self._finished:
+				return
+			now = time.time()
+			fill = self._buffered + pipe_pending(self._reader)
+			self._fill_total += fill
+			self._samples += 1
+			INSTRUMENTATION.record(self._operation, "buffer_fill_bytes", fill)
+			if fill == 0 and self.first_byte_time is not None and not self._source_ended:
+				if self._underrun_since is None:
+					self._underrun_since = now
+					self.underruns += 1
+			elif self._underrun_since is not None:
+				self.underrun_seconds += now - self._underrun_since
+				INSTRUMENTATION.record(self._operation, "underrun", now - self._underrun_since)
+				self._underrun_since = None
+			last_time, last_out = self._last_sample
+			if now - last_time >= 1:
+				INSTRUMENTATION.record(self._operation, "throughput_bytes", (self.bytes_out - last_out) / (now - last_time))
+				self._last_sample = (now, self.bytes_out)
+			self._cancel_sample = self._reactor.call_later(SAMPLE_INTERVAL, self._sample)
+
+	def stats(self):
+		with self._lock:
+			elapsed = max(time.time() - self.started, 0.001)
+			return {
+				"capacity": self.capacity + self.pipe_size,
+				"pipe_size": self.pipe_size,
+				"buffered": self._buffered,
+				"mean_fill": self._fill_total / self._samples if self._samples else None,
+				"bytes_in": self.bytes_in,
+				"bytes_out": self.bytes_out,
+				"throughput": self.bytes_out / elapsed,
+				"first_byte": None if self.first_byte_time is None else self.first_byte_time - self.started,
+				"underruns": self.underruns,
+				"underrun_seconds": self.underrun_seconds,
+				"finished": self._finished,
+			}
+
+class Spool(object):
+	'''
+	Writes a stream to a temporary file as it arrives, on the I/O reactor, for any number of readers to follow.
+	Whatever has arrived can be read again as often as wanted without fetching it again.
+	'''
+
+	def __init__(self, source, reactor, directory=None):
+		self._source = source
+		self._reactor = reactor
+		fd, self.filename = tempfile.mkstemp(prefix=SPOOL_PREFIX, suffix=SPOOL_SUFFIX, dir=directory)
+		fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB) # Held while spooling, so remove_stale_spools() leaves it alone
+		self._file = fd
+		self._changed = threading.Condition()
+		self.length = 0
+		self.complete = False
+		self.closed = False
+		self.kept = False
+		reactor.add_reader(source, self._read)
+
+	def _read(self, data):
+		if self.closed:
+			return
+		if not data:
+			os.close(self._source)
+			with self._changed:
+				self.complete = True
+				self._changed.notify_all()
+			return
+		try:
+			while data:
+				with self._changed: # So the file cannot be closed under us
+					if self.closed:
+						return
+					written = os.write(self._file, data)
+					self.length += written
+					self._changed.notify_all()
+				data = data[written:]
+		except OSError as exc:
+			sys.stderr.write("Could not spool stream to %s: %s\n" % (self.filename, exc))
+			self.close()
+
+	def keep(self, filename):
+		'''Move the completed spool file to filename, so it stays when the spool is closed. Readers carry on as before.'''
+		with self._changed:
+			os.rename(self.filename, filename)
+			self.filename = filename
+			self.kept = True
+
+	def wait_for(self, offset, timeout=None):
+		'''Wait until there is data at offset or the stream has ended, returning how much there is now.'''
+		with self._changed:
+			if offset >= self.length and not self.complete and not self.closed:
+				self._changed.wait(timeout)
+			return self.length
+
+	def finished(self):
+		'''Whether no more data will arrive.'''
+		return self.complete or self.closed
+
+	def wait_finished(self):
+		'''Wait for everything to arrive, returning whether it has.'''
+		with self._changed:
+			while not self.finished():
+				self._changed.wait()
+			return self.complete
+
+	def close(self):
+		'''Stop spooling and delete the file unless it has been kept, readers that are following it stop at once.'''
+		with self._changed:
+			if self.closed:
+				return
+			self.closed = True
+			self._changed.notify_all()
+		self._reactor.remove(self._source)
+		for fd in ([self._file] if self.complete else [self._file, self._source]):
+			try:
+				os.close(fd)
+			except OSError:
+				pass
+		if self.kept:
+			return
+		try:
+			os.unlink(self.filename)
+		except OSError:
+			pass
+
+def remove_stale_spools(directory):
+	'''
+	Delete spool files left in directory by a Totem that did not get to close them, such as after a crash.
+	Spools still being written by another Totem are locked, so are left alone.
+	'''
+	for filename in glob.glob(os.path.join(directory, SPOOL_PREFIX + "*" + SPOOL_SUFFIX)):
+		try:
+			fd = os.open(filename, os.O_RDWR)
+		except OSError:
+			continue # Gone already
+		try:
+			fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+			os.unlink(filename)
+		except (IOError, OSError):
+			pass # In use
+		finally:
+			os.close(fd)
+
+class SpoolFeeder(object):
+	'''
+	Copies a spool into Totem's pipe on a thread of its own, following it as it grows.
+	The pipe's writing end is closed once everything has been copied, the reading end only when stopped,
+	so Totem can finish what is left in the pipe.
+	'''
+
+	def __init__(self, spool, sink, reader):
+		self._spool = spool
+		self._sink = sink
+		self._reader = reader
+		self._lock = threading.Lock()
+		self._stopped = False
+		thread = threading.Thread(target=self._feed)
+		thread.daemon = True
+		thread.start()
+
+	def _feed(self):
+		position = 0
+		try:
+			with open(self._spool.filename, "rb") as spooled:
+				while not self._stopped:
+					available = self._spool.wait_for(position, 1)
+					if position >= available:
+						if self._spool.finished():
+							break
+						continue
+					spooled.seek(position)
+					data = spooled.read(min(WRITE_SIZE, available - position))
+					if not data:
+						break
+					while data and not self._stopped:
+						written = os.write(self._sink, data)
+						position += written
+						data = data[written:]
+		except (IOError, OSError):
+			pass # Totem stopped reading, or the spool went away
+		finally:
+			os.close(self._sink)
+
+	def stop(self):
+		'''Stop feeding Totem, leaving the spool as it is. Closing the reading end breaks off a write that is waiting.'''
+		with self._lock:
+			if self._stopped:
+				return
+			self._stopped = True
+			os.close(self._reader)
+
+def container_extension(filename):
+	'''The file extension for a stream, judged by how it starts, as the stream modes do not all give the same container.'''
+	try:
+		with open(filename, "rb") as stream:
+			header = stream.read(8)
+	except IOError:
+		header = ""
+	if header.startswith("FLV"):
+		return ".flv"
+	if header[4:8] == "ftyp":
+		return ".mp4"
+	return ".ts" # Transport streams start with a sync byte, and are what get_iplayer streams otherwise
+
+def parse_range(header):
+	'''The first byte range of a Range header as (start, end or None), or None if there is no usable range.'''
+	match = RE_BYTE_RANGE.match(header or "")
+	if not match or not match.group(1):
+		return None # Suffix ranges are no use while the end is unknown
+	return int(match.group(1)), int(match.group(2)) if match.group(2) else None
+
+class _SpoolRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	'''Serves a spool, including byte ranges, waiting for data that has not arrived yet.'''
+
+	def do_HEAD(self):
+		self._serve(False)
+
+	def do_GET(self):
+		self._serve(True)
+
+	def _serve(self, withbody):
+		spool = self.server.spools.get(self.path.lstrip("/"))
+		if spool is None:
+			self.send_error(404)
+			return
+		requested = parse_range(self.headers.get("Range"))
+		start, end = requested or (0, None)
+		if requested and end is None and not spool.complete:
+			# Open ranges on a growing spool follow it until it ends, so players do not take what has arrived for all of it
+			while spool.wait_for(start, 1) <= start and not spool.finished():
+				pass
+			if not spool.complete and start >= spool.length:
+				self.send_error(404) # Closed before anything arrived there
+				return
+		if spool.complete:
+			end = spool.length - 1 if end is None else min(end, spool.length - 1)
+			if start > end and spool.length:
+				self.send_response(416)
+				self.send_header("Content-Range", "bytes */%d" % (spool.length,))
+				self.end_headers()
+				return
+		self.send_response(206 if requested else 200)
+		self.send_header("Content-Type", "application/octet-stream")
+		self.send_header("Accept-Ranges", "bytes")
+		if spool.complete:
+			self.send_header("Content-Length", str(end - start + 1))
+			if requested:
+				self.send_header("Content-Range", "bytes %d-%d/%d" % (start, end, spool.length))
+		elif requested and end is not None:
+			self.send_header("Content-Length", str(end - start + 1))
+			self.send_header("Content-Range", "bytes %d-%d/*" % (start, end))
+		# Otherwise the end is not known yet, so there is no length or range to give and the body ends when the connection does
+		self.end_headers()
+		if withbody:
+			self._copy(spool, start, end)
+
+	def _copy(self, spool, position, end):
+		try:
+			with open(spool.filename, "rb") as spooled:
+				while end is None or position <= end:
+					available = spool.wait_for(position, 1)
+					if position >= available:
+						if spool.finished():
+							return
+						continue
+					spooled.seek(position)
+					limit = available if end is None else min(available, end + 1)
+					data = spooled.read(min(SERVE_SIZE, limit - position))
+					if not data:
+						return # Deleted while we were reading
+					self.wfile.write(data)
+					position += len(data)
+		except (IOError, OSError, socket.error):
+			pass # Totem went away, or the spool was closed
+
+	def log_message(self, format, *args):
+		pass # Every range request would be logged otherwise
+
+class StreamProxy(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	'''
+	An HTTP server on the loopback interface that serves spools to Totem, so it can seek within what has arrived.
+	Until a stream has all arrived its length is unknown, so open ranges follow it as it grows until it ends.
+	'''
+	daemon_threads = True
+
+	def __init__(self):
+		BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), _SpoolRequestHandler)
+		self.spools = {} # Token : spool
+		self._thread = threading.Thread(target=self.serve_forever)
+		self._thread.daemon = True
+		self._thread.start()
+
+	def add(self, spool):
+		'''Serve a spool, returning the url to fetch it from.'''
+		token = binascii.hexlify(os.urandom(16)) # So other local users cannot guess it
+		self.spools[token] = spool
+		return "http://127.0.0.1:%d/%s" % (self.server_address[1], token)
+
+	def remove(self, url, close=True):
+		'''Stop serving a spool, and close it unless something else is still using it.'''
+		spool = self.spools.pop(url.rsplit("/", 1)[-1], None)
+		if spool is not None and close:
+			spool.close()
+
+	def close(self):
+		for url in list(self.spools):
+			self.remove(url)
+		self.shutdown()
+		self.server_close()
@@ -0,0 +1,339 @@
+'''
+Programme thumbnails, kept on disk and in memory so a programme we have already seen shows its image straight away.
+'''
+
+# totem-get-iplayer
+# Copyright (C) 2013  Andy Gurden
+#
+#     This file is part of totem-get-iplayer.
+#
+#     totem-get-iplayer is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     totem-get-iplayer is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with totem-get-iplayer.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import errno
+import hashlib
+import httplib
+import tempfile
+import threading
+import urlparse
+from collections import OrderedDict, defaultdict
+import gtk
+import gobject
+from getiplayer_interface import TaskPool
+from getiplayer_mainloop import idle_add
+
+READ_SIZE = 8192
+MAX_REDIRECTS = 3
+
+def fit_size(width, height, max_width, max_height):
+	'''The size to show an image at so it fits in the box, keeping its shape. Images are never made bigger.'''
+	if width > max_width:
+		height = int(height * float(max_width) / float(width))
+		width = max_width
+	if height > max_height:
+		width = int(width * float(max_height) / float(height))
+		height = max_height
+	return max(width, 1), max(height, 1)
+
+class FetchCancelled(Exception):
+	pass
+
+class ConnectionPool(object):
+	'''Keeps HTTP connections open between requests so fetching several images from the same host skips the handshakes.'''
+
+	def __init__(self, per_host=2, timeout=20):
+		self.per_host = per_host
+		self.timeout = timeout
+		self._lock = threading.Lock()
+		self._idle = defaultdict(list) # (scheme, host, port) : idle connections
+		self.opened = 0
+		self.reused = 0
+
+	def _connection(self, key):
+		with self._lock:
+			if self._idle[key]:
+				self.reused += 1
+				return self._idle[key].pop()
+			self.opened += 1
+		scheme, host, port = key
+		connection_type = httplib.HTTPSConnection if scheme == "https" else httplib.HTTPConnection
+		return connection_type(host, port, timeout=self.timeout)
+
+	def _release(self, key, connection):
+		with self._lock:
+			if len(self._idle[key]) < self.per_host:
+				self._idle[key].append(connection)
+				return
+		connection.close()
+
+	def fetch(self, url, cancelled=None):
+		'''Get the body of a url, following redirects. Raises IOError when it cannot and FetchCancelled if cancelled() becomes true.'''
+		for _ in xrange(MAX_REDIRECTS + 1):
+			parsed = urlparse.urlsplit(url)
+			if parsed.scheme not in ("http", "https"):
+				raise IOError("Cannot fetch %s" % (url,))
+			key = (parsed.scheme, parsed.hostname, parsed.port)
+			path = parsed.path or "/"
+			if parsed.query:
+				path += "?" + parsed.query
+			connection = self._connection(key)
+			try:
+				connection.request("GET", path, headers={"Connection": "keep-alive"})
+				response = connection.getresponse()
+				data = []
+				chunk = response.read(READ_SIZE)
+				while chunk:
+					if cancelled is not None and cancelled():
+						raise FetchCancelled()
+					data.append(chunk)
+					chunk = response.read(READ_SIZE)
+			except (httplib.HTTPException, EnvironmentError) as exc:
+				connection.close()
+				raise IOError("Could not fetch %s: %s" % (url, exc))
+			except FetchCancelled:
+				connection.close() # Part of the body is still waiting to be read so it cannot be reused
+				raise
+			if response.will_close:
+				connection.close()
+			else:
+				self._release(key, connection)
+			if response.status in (301, 302, 303, 307, 308) and response.getheader("location"):
+				url = urlparse.urljoin(url, response.getheader("location"))
+				continue
+			if response.status != 200:
+				raise IOError("Could not fetch %s: HTTP %s" % (url, response.status))
+			return "".join(data)
+		raise IOError("Too many redirects fetching %s" % (url,))
+
+	def close(self):
+		with self._lock:
+			idle, self._idle = self._idle, defaultdict(list)
+		for connections in idle.itervalues():
+			for connection in connections:
+				connection.close()
+
+class ThumbnailCache(object):
+	'''
+	Thumbnails by url and display size. Scaled pixbufs are kept in a small in-memory LRU, the original images on disk.
+	Files on disk are named by a hash of their content, with a small file per url pointing at its content,
+	so the same image behind different urls is stored once. Images are decoded straight to the size they are shown at.
+	'''
+
+	def __init__(self, directory, memory_entries=64, max_disk_bytes=32*1024*1024, fetchers=2):
+		self.directory = directory
+		self.memory_entries = memory_entries
+		self.max_disk_bytes = max_disk_bytes
+		self._lock = threading.Lock()
+		self._memory = OrderedDict() # (url, width, height) : pixbuf, least recently used first
+		self._connections = ConnectionPool()
+		self._pool = TaskPool(fetchers)
+		self._writes = 0
+		self._stats = defaultdict(int)
+
+	def _path(self, kind, name):
+		return os.path.join(self.directory, kind, name[:2], name)
+
+	def _url_path(self, url):
+		return self._path("urls", hashlib.sha1(url).hexdigest())
+
+	def _write_file(self, filename, data):
+		'''Write a whole file atomically, so a reader never sees half of it.'''
+		directory = os.path.dirname(filename)
+		try:
+			os.makedirs(directory)
+		except OSError as exc:
+			if exc.errno != errno.EEXIST:
+				raise
+		fd, temp = tempfile.mkstemp(dir=directory)
+		with os.fdopen(fd, "wb") as out:
+			out.write(data)
+		os.rename(temp, filename)
+
+	def _read_disk(self, url):
+		'''The image for a url if it is on disk, otherwise None.'''
+		try:
+			with open(self._url_path(url)) as pointer:
+				content = pointer.read().strip()
+			with open(self._path("content", content), "rb") as image:
+				data = image.read()
+		except IOError:
+			return None
+		os.utime(self._path("content", content), None) # Recently used, pruned last
+		return data
+
+	def _write_disk(self, url, data):
+		content = hashlib.sha1(data).hexdigest()
+		try:
+			if not os.path.exists(self._path("content", content)):
+				self._write_file(self._path("content", content), data)
+			self._write_file(self._url_path(url), content)
+		except EnvironmentError as exc:
+			sys.stderr.write("Could not cache thumbnail %s: %s\n" % (url, exc))
+			return
+		with self._lock:
+			self._writes += 1
+			due = self._writes % 50 == 0
+		if due:
+			self.prune()
+
+	def prune(self):
+		'''Remove the least recently used images until the cache is under max_disk_bytes, and urls pointing at them.'''
+		files = []
+		for root, _, names in os.walk(os.path.join(self.directory, "content")):
+			for name in names:
+				filename = os.path.join(root, name)
+				try:
+					st = os.stat(filename)
+				except OSError:
+					continue
+				files.append((st.st_mtime, st.st_size, filename))
+		total = sum(size for _, size, _ in files)
+		if total <= self.max_disk_bytes:
+			return
+		removed = set()
+		for _, size, filename in sorted(files):
+			if total <= self.max_disk_bytes:
+				break
+			try:
+				os.remove(filename)
+			except OSError:
+				continue
+			total -= size
+			removed.add(os.path.basename(filename))
+		for root, _, names in os.walk(os.path.join(self.directory, "urls")):
+			for name in names:
+				filename = os.path.join(root, name)
+				try:
+					with open(filename) as pointer:
+						if pointer.read().strip() in removed:
+							os.remove(filename)
+				except EnvironmentError:
+					pass
+
+	def _decode(self, data, max_width, max_height):
+		'''Decode image data straight to the size it should be shown at.'''
+		loader = gtk.gdk.PixbufLoader()
+		def size_prepared(loader, width, height):
+			scaled = fit_size(width, height, max_width, max_height)
+			if scaled != (width, height):
+				loader.set_size(*scaled)
+		loader.connect("size-prepared", size_prepared)
+		try:
+			loader.write(data)
+		finally:
+			loader.close()
+		return loader.get_pixbuf()
+
+	def _count(self, stat, amount=1):
+		'''Add to a statistic, from whichever thread.'''
+		with self._lock:
+			self._stats[stat] += amount
+
+	def _remember(self, key, pixbuf):
+		with self._lock:
+			self._memory.pop(key, None)
+			self._memory[key] = pixbuf
+			while len(self._memory) > self.memory_entries:
+				self._memory.popitem(last=False)
+
+	def cached(self, url, max_width, max_height):
+		'''The pixbuf for a url at a size if it is in memory, otherwise None.'''
+		key = (url, max_width, max_height)
+		with self._lock:
+			pixbuf = self._memory.pop(key, None)
+			if pixbuf is not None:
+				self._memory[key] = pixbuf # Now the most recently used
+				self._stats["memory_hits"] += 1
+			return pixbuf
+
+	def _load(self, url, max_width, max_height, cancelled):
+		'''Get a thumbnail from disk or the network, blocking. Returns None if it could not be loaded or was cancelled.'''
+		data = self._read_disk(url)
+		if data is not None:
+			self._count("disk_hits")
+		else:
+			if cancelled():
+				return None
+			try:
+				data = self._connections.fetch(url, cancelled)
+			except FetchCancelled:
+				return None
+			except IOError as exc:
+				self._count("failures")
+				sys.stderr.write("%s\n" % (exc,))
+				return None
+			self._count("fetches")
+			self._count("bytes_fetched", len(data))
+			self._write_disk(url, data)
+		if cancelled():
+			return None
+		try:
+			pixbuf = self._decode(data, max_width, max_height)
+		except gobject.GError:
+			self._count("failures")
+			return None
+		if pixbuf is not None:
+			self._remember((url, max_width, max_height), pixbuf)
+		return pixbuf
+
+	def load_into(self, image, url, max_width, max_height, cancelcheck=None):
+		'''
+		Show a thumbnail in a gtk.Image, scaled to fit in max_width by max_height. Must be called on the GTK thread.
+		A thumbnail in memory is shown immediately, anything else is loaded on another thread. Returns a function to cancel the load.
+		'''
+		pixbuf = self.cached(url, max_width, max_height)
+		if pixbuf is not None:
+			image.set_from_pixbuf(pixbuf)
+			return lambda: None
+
+		cancelled = threading.Event()
+		def is_cancelled():
+			return cancelled.is_set() or (cancelcheck is not None and cancelcheck())
+
+		def on_complete(pixbuf):
+			if pixbuf is not None and not is_cancelled():
+				image.set_from_pixbuf(pixbuf)
+			return False
+
+		def load():
+			pixbuf = self._load(url, max_width, max_height, is_cancelled)
+			idle_add(on_complete, pixbuf)
+		self._pool.submit(load)
+		return cancelled.set
+
+	def prefetch(self, url, max_width, max_height, cancelcheck=None):
+		'''Load a thumbnail into memory ahead of it being shown, on another thread. Returns a function to cancel the load.'''
+		if self.cached(url, max_width, max_height) is not None:
+			return lambda: None
+		cancelled = threading.Event()
+		def is_cancelled():
+			return cancelled.is_set() or (cancelcheck is not None and cancelcheck())
+		def load():
+			if self._load(url, max_width, max_height, is_cancelled) is not None:
+				self._count("prefetched")
+		self._pool.submit(load)
+		return cancelled.set
+
+	def stats(self):
+		'''Where thumbnails have been coming from.'''
+		with self._lock:
+			stats = dict(self._stats)
+			stats["memory_entries"] = len(self._memory)
+		stats["connections_opened"] = self._connections.opened
+		stats["connections_reused"] = self._connections.reused
+		return stats
+
+	def close(self):
+		self._connections.close()
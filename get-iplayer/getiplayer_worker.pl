@@ -0,0 +1,108 @@
+#!/usr/bin/perl
+
+# totem-get-iplayer
+# Copyright (C) 2013  Andy Gurden
+#
+#     This file is part of totem-get-iplayer.
+#
+#     totem-get-iplayer is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     totem-get-iplayer is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with totem-get-iplayer.  If not, see <http://www.gnu.org/licenses/>.
+
+# Keeps a perl interpreter warm for get_iplayer. Every module the script uses is loaded once up front,
+# then each request forks and runs the script in the child with its own arguments.
+#
+# Requests on stdin:
+#   PING                           -> PONG
+#   QUIT                           -> worker exits
+#   RUN <n> then n x "<len>\n<arg>" -> PID <pid>, OUT <len>\n<bytes>, ERR <len>\n<bytes>, EXIT <status>
+
+use strict;
+use warnings;
+use POSIX ();
+use File::Temp qw(tempfile);
+
+my $script = shift @ARGV or die "Usage: $0 get_iplayer-location\n";
+open(my $source_fh, '<', $script) or die "Cannot read $script: $!\n";
+my $source = do { local $/; <$source_fh> };
+close $source_fh;
+
+for my $module ($source =~ /^\s*use\s+([A-Z][\w:]*)/mg) {
+	eval "require $module; 1"; # Anything that fails to load will fail again, properly, in the child
+}
+
+binmode STDIN;
+binmode STDOUT;
+$| = 1;
+
+sub read_frame {
+	my $len = <STDIN>;
+	return undef unless defined $len;
+	chomp $len;
+	my $data = '';
+	read(STDIN, $data, $len) if $len;
+	return $data;
+}
+
+sub slurp {
+	my ($fh) = @_;
+	seek($fh, 0, 0);
+	local $/;
+	my $data = <$fh>;
+	return defined $data ? $data : '';
+}
+
+while (my $line = <STDIN>) {
+	chomp $line;
+	if ($line eq 'PING') {
+		print "PONG\n";
+		next;
+	}
+	last if $line eq 'QUIT';
+	next unless $line =~ /^RUN (\d+)$/;
+
+	my @args = map { read_frame() } 1..$1;
+	# Unlinked straight away, as workers are killed rather than left to clean up
+	my ($out_fh, $out_name) = tempfile();
+	my ($err_fh, $err_name) = tempfile();
+	unlink($out_name, $err_name);
+	binmode $out_fh;
+	binmode $err_fh;
+
+	my $pid = fork();
+	if (!defined $pid) {
+		my $err = "ERROR: Could not fork get_iplayer worker: $!\n";
+		print "PID 0\nOUT 0\nERR " . length($err) . "\n" . $err . "EXIT 255\n";
+		next;
+	}
+	if ($pid == 0) {
+		POSIX::setsid();
+		open(STDIN, '<', '/dev/null');
+		open(STDOUT, '>&', $out_fh);
+		open(STDERR, '>&', $err_fh);
+		$| = 1;
+		@ARGV = @args;
+		$0 = $script;
+		do $script;
+		print STDERR $@ if $@;
+		exit 0;
+	}
+
+	print "PID $pid\n";
+	waitpid($pid, 0);
+	my $status = $? >> 8;
+	my $out = slurp($out_fh);
+	my $err = slurp($err_fh);
+	close $out_fh;
+	close $err_fh;
+	print "OUT " . length($out) . "\n" . $out . "ERR " . length($err) . "\n" . $err . "EXIT $status\n";
+}
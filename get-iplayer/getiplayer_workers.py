@@ -0,0 +1,277 @@
+'''
+Pool of long-lived perl interpreters that run get_iplayer without paying its startup cost every time.
+'''
+
+# totem-get-iplayer
+# Copyright (C) 2013  Andy Gurden
+#
+#     This file is part of totem-get-iplayer.
+#
+#     totem-get-iplayer is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     totem-get-iplayer is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with totem-get-iplayer.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import time
+import select
+import signal
+import threading
+import subprocess
+import Queue
+from distutils.spawn import find_executable
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "getiplayer_worker.pl")
+
+class WorkerError(Exception):
+	'''A worker stopped responding or spoke out of turn.'''
+	pass
+
+def is_perl_script(location):
+	'''Whether a file looks like a perl script we can run inside a worker.'''
+	try:
+		with open(location) as script:
+			firstline = script.readline()
+	except IOError:
+		return False
+	return firstline.startswith("#!") and "perl" in firstline
+
+class Worker(object):
+	'''A single warm interpreter, runs one get_iplayer command at a time.'''
+
+	def __init__(self, perl, location):
+		self._proc = subprocess.Popen(
+			[perl, WORKER_SCRIPT, location],
+			stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+			preexec_fn=os.setsid, close_fds=True)
+		self.child_pid = None
+		self.last_used = time.time()
+
+	def is_alive(self):
+		return self._proc.poll() is None
+
+	def _readline(self, timeout=None):
+		if timeout is not None and not select.select([self._proc.stdout], [], [], timeout)[0]:
+			raise WorkerError("Worker %s timed out" % (self._proc.pid,))
+		line = self._proc.stdout.readline()
+		if not line:
+			raise WorkerError("Worker %s exited" % (self._proc.pid,))
+		return line.rstrip("\n")
+
+	def _readframe(self, name, onheader=None):
+		header = self._readline()
+		if not header.startswith(name + " "):
+			raise WorkerError("Expected %s frame from worker but got %r" % (name, header))
+		if onheader is not None:
+			onheader()
+		return self._proc.stdout.read(int(header[len(name)+1:]))
+
+	def ping(self, timeout=5):
+		'''Health check, whether the worker answers within the timeout.'''
+		try:
+			self._proc.stdin.write("PING\n")
+			self._proc.stdin.flush()
+			return self._readline(timeout) == "PONG"
+		except (IOError, WorkerError):
+			return False
+
+	def run(self, args, cancelled=None, onoutput=None):
+		'''
+		Run get_iplayer with args, blocking until it has finished. Returns (stdout, stderr, exit status).
+		If cancelled() is true once the run has started then it is killed straight away.
+		onoutput() is called as soon as the output starts arriving.
+		'''
+		self._proc.stdin.write("RUN %d\n" % (len(args),))
+		for arg in args:
+			self._proc.stdin.write("%d\n%s" % (len(arg), arg))
+		self._proc.stdin.flush()
+		header = self._readline()
+		if not header.startswith("PID "):
+			raise WorkerError("Expected PID frame from worker but got %r" % (header,))
+		self.child_pid = int(header[4:]) or None
+		if cancelled is not None and cancelled():
+			self.kill_child()
+		try:
+			stdout = self._readframe("OUT", onoutput)
+			stderr = self._readframe("ERR")
+			status = self._readline()
+			if not status.startswith("EXIT "):
+				raise WorkerError("Expected EXIT frame from worker but got %r" % (status,))
+		finally:
+			self.child_pid = None
+			self.last_used = time.time()
+		return stdout, stderr, int(status[5:])
+
+	def kill_child(self):
+		'''Kill the get_iplayer run in progress, if any.'''
+		pid = self.child_pid
+		if pid is not None:
+			try:
+				os.killpg(pid, signal.SIGKILL)
+			except OSError:
+				pass
+
+	def close(self):
+		self.kill_child()
+		if self.is_alive():
+			try:
+				os.killpg(self._proc.pid, signal.SIGKILL)
+			except OSError:
+				sys.stderr.write("Could not terminate worker %s" % (self._proc.pid,))
+		self._proc.wait()
+
+def abandoned(reason):
+	'''The outcome of a command that was killed or never ran, an error so it is not mistaken for empty output.'''
+	return ("", "ERROR: get_iplayer did not finish: %s\n" % (reason,), -signal.SIGKILL)
+
+class WorkerPool(object):
+	'''
+	Runs get_iplayer commands on a small pool of pre-warmed workers.
+	Each worker has a thread feeding it jobs, which shuts it down once it has been idle for idle_timeout seconds.
+	Workers that have not been used for health_interval seconds are pinged before use and replaced if they do not answer.
+	'''
+
+	def __init__(self, location, size=2, idle_timeout=300, health_interval=60, perl=None):
+		self.location = os.path.abspath(location)
+		self.perl = perl or find_executable("perl")
+		self.size = size
+		self.idle_timeout = idle_timeout
+		self.health_interval = health_interval
+		self._jobs = Queue.Queue()
+		self._lock = threading.Lock()
+		self._workers = set()
+		self._threads = 0
+		self._idle = 0
+		self._closed = False
+
+	def available(self):
+		'''Whether get_iplayer can run in a worker at all, if not then callers should start it directly.'''
+		return not self._closed and self.perl is not None and os.path.exists(WORKER_SCRIPT) and is_perl_script(self.location)
+
+	def prewarm(self):
+		'''Start every worker now rather than waiting for the first commands.'''
+		with self._lock:
+			while self._threads < self.size:
+				self._start_thread()
+
+	def _start_thread(self):
+		self._threads += 1
+		self._idle += 1
+		threading.Thread(target=self._serve).start()
+
+	def run(self, args, onfailure, ondone=None, onoutput=None):
+		'''
+		Queue a get_iplayer command (args excluding get_iplayer's location). Returns functions to check whether it
+		is done, block for its (stdout, stderr, status) and cancel it, which kills it if it is already running.
+		If the command cannot run in a worker then the outcome of onfailure() is used instead.
+		Commands that are cancelled, or that the pool is closed under, end with an error rather than running at all.
+		ondone() is called, from the worker's thread, as soon as the outcome is ready, and onoutput() once the
+		worker's output starts arriving, which is not called if it falls back to onfailure().
+		'''
+		done = threading.Event()
+		outcome = {}
+		with self._lock:
+			closed = self._closed
+			if not closed:
+				self._jobs.put((args, outcome, done, onfailure, ondone, onoutput))
+				if self._idle == 0 and self._threads < self.size:
+					self._start_thread()
+		if closed:
+			outcome["result"] = abandoned("Worker pool has been closed")
+			done.set()
+			if ondone is not None:
+				ondone()
+		def wait():
+			done.wait()
+			return outcome["result"]
+		def cancel():
+			outcome["cancelled"] = True
+			worker = outcome.get("worker")
+			if worker is not None:
+				worker.kill_child()
+		return done.is_set, wait, cancel
+
+	def _healthy_worker(self, worker):
+		if worker is not None and worker.is_alive():
+			if time.time() - worker.last_used < self.health_interval or worker.ping():
+				return worker
+		if worker is not None:
+			self._retire(worker)
+		worker = Worker(self.perl, self.location)
+		with self._lock:
+			self._workers.add(worker)
+		return worker
+
+	def _retire(self, worker):
+		with self._lock:
+			self._workers.discard(worker)
+		worker.close()
+
+	def _serve(self):
+		try:
+			worker = self._healthy_worker(None) # Warm up straight away, not when the first job arrives
+		except OSError:
+			worker = None
+		while True:
+			try:
+				job = self._jobs.get(timeout=self.idle_timeout)
+			except Queue.Empty:
+				job = None
+			if job is None:
+				with self._lock:
+					if self._jobs.empty() or self._closed:
+						self._threads -= 1
+						self._idle -= 1
+						break
+				continue
+			args, outcome, done, onfailure, ondone, onoutput = job
+			with self._lock:
+				self._idle -= 1
+			used = False # Whether the worker was given the job, after which it cannot be trusted if anything went wrong
+			try:
+				if self._closed:
+					raise WorkerError("Worker pool has been closed")
+				if outcome.get("cancelled"):
+					raise WorkerError("Cancelled before it started")
+				worker = self._healthy_worker(worker)
+				outcome["worker"] = worker
+				used = True
+				outcome["result"] = worker.run(args, lambda: outcome.get("cancelled"), onoutput)
+				if outcome.get("cancelled"):
+					outcome["result"] = abandoned("Cancelled while it was running") # Whatever it wrote before being killed is incomplete
+			except (OSError, IOError, WorkerError) as exc:
+				if worker is not None and (used or not worker.is_alive()):
+					self._retire(worker) # Its output may be out of step with the frames we expect
+					worker = None
+				if self._closed or outcome.get("cancelled"):
+					outcome["result"] = abandoned(exc)
+				else:
+					sys.stderr.write("get_iplayer worker failed, running directly instead: %s\n" % (exc,))
+					outcome["result"] = onfailure()
+			done.set()
+			if ondone is not None:
+				ondone()
+			with self._lock:
+				self._idle += 1
+		if worker is not None:
+			self._retire(worker)
+
+	def close(self):
+		'''Kill every worker and anything they are running. Queued commands end with an error, as do any run later.'''
+		with self._lock:
+			self._closed = True
+			workers = list(self._workers)
+			for _ in xrange(self._threads):
+				self._jobs.put(None) # Wake idle threads so they can exit
+		for worker in workers:
+			worker.kill_child()
+			worker.close()
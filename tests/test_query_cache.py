@@ -0,0 +1,71 @@
+'''
+Queries answered by get_iplayer are cached, so asking the same thing again does not run it again.
+
+	python2 -m unittest discover tests
+'''
+
+# totem-get-iplayer
+# Copyright (C) 2013  Andy Gurden
+#
+#     This file is part of totem-get-iplayer.
+#
+#     totem-get-iplayer is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     totem-get-iplayer is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with totem-get-iplayer.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+TOOLS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "tools")
+sys.path.insert(0, TOOLS_DIR)
+import latency_harness
+import getiplayer_interface as gip
+
+class QueryCacheTest(unittest.TestCase):
+	def setUp(self):
+		self.workdir = tempfile.mkdtemp()
+		profile = os.path.join(self.workdir, "profile")
+		latency_harness.make_fixture(profile, 30)
+		os.environ["PERL5LIB"] = TOOLS_DIR
+		self.gip = gip.GetIPlayer(
+			latency_harness.FAKE_GETIPLAYER, output_location=os.path.join(self.workdir, "recordings"),
+			profile_dir=profile, native_cache=False, execution="popen")
+		self.runs = []
+		start_call = self.gip._start_call
+		def counting(args, *vargs, **kwargs):
+			self.runs.append(args)
+			return start_call(args, *vargs, **kwargs)
+		self.gip._start_call = counting
+
+	def tearDown(self):
+		self.gip.close()
+		shutil.rmtree(self.workdir)
+
+	def _runs_for(self, query):
+		self.runs[:] = []
+		first = query().get_result()
+		second = query().get_result()
+		self.assertEqual(first, second)
+		return len(self.runs)
+
+	def test_programme_info_runs_once(self):
+		self.gip._version_result.get_result() # Every info query waits on this, it is not what is being counted
+		self.assertEqual(self._runs_for(lambda: self.gip.get_programme_info(3)), 1)
+
+	def test_filters_run_once(self):
+		self.assertEqual(self._runs_for(lambda: self.gip.get_filters_and_blanks("channel", type="tv")), 1)
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,87 @@
+'''
+The stream proxy serves a spool to Totem while it is still arriving, so seeking must not cut the stream short.
+
+	python2 -m unittest discover tests
+'''
+
+# totem-get-iplayer
+# Copyright (C) 2013  Andy Gurden
+#
+#     This file is part of totem-get-iplayer.
+#
+#     totem-get-iplayer is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     totem-get-iplayer is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with totem-get-iplayer.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import time
+import shutil
+import urllib2
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "get-iplayer"))
+from getiplayer_reactor import IOReactor
+from getiplayer_streaming import Spool, StreamProxy
+
+CHUNK = 16 * 1024
+CHUNKS = 20
+
+class StreamProxyTest(unittest.TestCase):
+	def setUp(self):
+		self.workdir = tempfile.mkdtemp()
+		self.data = "".join(chr(i % 251) for i in xrange(CHUNK * CHUNKS))
+		source, self.writer = os.pipe()
+		self.spool = Spool(source, IOReactor(), self.workdir)
+		self.proxy = StreamProxy()
+		self.url = self.proxy.add(self.spool)
+
+	def tearDown(self):
+		self.proxy.close()
+		shutil.rmtree(self.workdir)
+
+	def _write(self, data):
+		while data:
+			data = data[os.write(self.writer, data):]
+
+	def _arrive_slowly(self, data):
+		for i in xrange(0, len(data), CHUNK):
+			time.sleep(0.02)
+			self._write(data[i:i+CHUNK])
+		os.close(self.writer)
+
+	def test_open_range_reads_to_the_end(self):
+		self._write(self.data[:CHUNK * 2])
+		while self.spool.length < CHUNK * 2:
+			time.sleep(0.01)
+		rest = threading.Thread(target=self._arrive_slowly, args=(self.data[CHUNK * 2:],))
+		rest.start()
+		request = urllib2.Request(self.url, headers={"Range": "bytes=%d-" % (CHUNK,)})
+		response = urllib2.urlopen(request)
+		body = response.read()
+		rest.join()
+		self.assertEqual(response.getcode(), 206)
+		self.assertEqual(response.info().getheader("Content-Length"), None)
+		self.assertEqual(body, self.data[CHUNK:])
+
+	def test_closed_range_on_complete_spool(self):
+		self._arrive_slowly(self.data)
+		self.spool.wait_finished()
+		request = urllib2.Request(self.url, headers={"Range": "bytes=10-19"})
+		response = urllib2.urlopen(request)
+		self.assertEqual(response.info().getheader("Content-Range"), "bytes 10-19/%d" % (len(self.data),))
+		self.assertEqual(response.read(), self.data[10:20])
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,30 @@
+# totem-get-iplayer
+# Copyright (C) 2013  Andy Gurden
+#
+#     This file is part of totem-get-iplayer.
+#
+#     totem-get-iplayer is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     totem-get-iplayer is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with totem-get-iplayer.  If not, see <http://www.gnu.org/licenses/>.
+
+# Stands in for the modules get_iplayer loads at startup. Loading it takes FAKE_GETIPLAYER_STARTUP seconds,
+# once per interpreter, so a warm worker that has already loaded it skips the cost just as it would for the real tool.
+
+package FakeGetIPlayerStartup;
+
+use strict;
+use warnings;
+use Time::HiRes ();
+
+Time::HiRes::sleep($ENV{FAKE_GETIPLAYER_STARTUP}) if $ENV{FAKE_GETIPLAYER_STARTUP};
+
+1;
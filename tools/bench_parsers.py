@@ -0,0 +1,280 @@
+#!/usr/bin/env python2
+'''
+Benchmarks the get_iplayer output parsers over large synthetic outputs.
+
+Results are written as JSON with sorted keys so runs can be diffed, or compared directly:
+	bench_parsers.py --output before.json
+	bench_parsers.py --output after.json
+	bench_parsers.py --compare before.json after.json
+'''
+
+# totem-get-iplayer
+# Copyright (C) 2013  Andy Gurden
+#
+#     This file is part of totem-get-iplayer.
+#
+#     totem-get-iplayer is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     totem-get-iplayer is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with totem-get-iplayer.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import gc
+import json
+import time
+import random
+import platform
+import resource
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "get-iplayer"))
+import getiplayer_interface as gip
+
+DEFAULT_SIZES = [10000, 100000]
+FULL_SIZES = [10000, 100000, 500000]
+CHANNELS = ["BBC One", "BBC Two", "BBC Three", "BBC Four", "CBBC", "CBeebies", "BBC News", "BBC Parliament", "BBC Radio 4"]
+CATEGORIES = ["Comedy", "Drama", "Documentaries", "Factual", "Films", "Music", "News", "Sport", "Children's", "Learning"]
+VERSIONS = ["default", "signed", "audiodescribed", "original", "opensubtitles", "iplayer", "lowbitrate", "uk"]
+MODE_GROUPS = ["flashhd", "flashvhigh", "flashhigh", "flashstd", "flashnormal", "flashlow", "rtspvhigh", "rtsplow", "subtitles"]
+WORDS = ("the of and a to in is you that it he was for on are as with his they at be this have from or one had by word but not what "
+	"all were we when your can said there use an each which she do how their if will up other about out many then them these so").split()
+
+def words(rng, count):
+	return " ".join(rng.choice(WORDS) for _ in xrange(count)).capitalize()
+
+# Generators for each kind of output. They take a seeded random source so every run parses identical input.
+
+def make_listings(rng, programmes):
+	'''Output of get_filters: one line per filter value with its count.'''
+	values = max(10, programmes // 50)
+	lines = ["%s (%d)" % (words(rng, 3), rng.randint(1, 500)) for _ in xrange(values)]
+	lines.append("")
+	lines.append("INFO: %d Matching Programmes" % (programmes,))
+	return "\n".join(lines) + "\n"
+
+def make_tree(rng, programmes):
+	'''Output of get_episodes: series names, each followed by its indented episodes, in a shuffled order.'''
+	lines = []
+	index = 1
+	while index <= programmes:
+		lines.append(words(rng, 3))
+		episodes = [(index + i, rng.choice(["", str(rng.randint(1, 30))]), words(rng, 4)) for i in xrange(min(rng.randint(1, 12), programmes - index + 1))]
+		rng.shuffle(episodes)
+		lines.extend("  %d: (%s) %s" % episode for episode in episodes)
+		index += len(episodes)
+		lines.append("")
+	lines.append("INFO: %d Matching Programmes" % (programmes,))
+	return "\n".join(lines) + "\n"
+
+def version_names(count):
+	return VERSIONS[:count] + ["version%d" % (i,) for i in xrange(count - len(VERSIONS))]
+
+def make_info(rng, versions, modes_per_version):
+	'''Output of get_programme_info for one programme with many versions and modes.'''
+	names = version_names(versions)
+	lines = [
+		"%s:%s%s" % (key, " " * max(1, 12 - len(key)), value) for key, value in [
+			("available", "2013-03-01T21:00:00Z"), ("categories", ",".join(CATEGORIES[:3])),
+			("channel", rng.choice(CHANNELS)), ("desc", words(rng, 40)), ("duration", "3600"),
+			("episode", words(rng, 4)), ("expiry", "2013-03-08T21:59:00Z"), ("index", "1234"),
+			("name", words(rng, 3)), ("pid", "b01r1234"), ("thumbnail", "http://example.com/thumb.jpg"),
+			("versions", ",".join(names)),
+		]]
+	for version in names:
+		modes = ["%s%d" % (rng.choice(MODE_GROUPS), rng.randint(1, 3)) for _ in xrange(modes_per_version)]
+		lines.append("modes:      %s: %s" % (version, ",".join(modes)))
+		lines.append("modesizes:  %s: %s" % (version, ",".join("%s=%dMB" % (mode, rng.randint(50, 900)) for mode in modes)))
+		lines.append("pid:        %s: b01r%04d" % (version, rng.randint(0, 9999)))
+		lines.append("duration:   %s: %d" % (version, rng.randint(60, 7200)))
+	return "INFO: Matching Programmes\n\n" + "\n".join(lines) + "\n\nINFO: 1 Matching Programmes\n"
+
+def make_streaminfo(rng, streams):
+	'''Output of get_stream_info with many streams.'''
+	sections = []
+	for i in xrange(streams):
+		group = rng.choice(MODE_GROUPS)
+		sections.append("\n".join([
+			"stream:     %s%d" % (group, i),
+			"bitrate:    %d" % (rng.randint(100, 3200),),
+			"ext:        mp4",
+			"streamurl:  rtmp://example.com/ondemand/%s/%d" % (group, i),
+			"type:       video/mp4",
+		]))
+	return "\n\n".join(sections) + "\n"
+
+def make_history(rng, programmes):
+	'''Output of get_history.'''
+	lines = []
+	for index in xrange(programmes):
+		version = rng.choice(VERSIONS)
+		name = words(rng, 3)
+		lines.append("(%d):(%s):(%s):(%s):(%s):(/home/user/iplayer/%s_%s.mp4)" % (
+			index, name, words(rng, 4), version, rng.choice(MODE_GROUPS) + "1", name.replace(" ", "_"), version))
+	return "\n".join(lines) + "\n"
+
+def make_mode_pairs(rng, modes):
+	return [("%s%d" % (rng.choice(MODE_GROUPS), i), "%dMB" % (rng.choice([100, 200, 300]),)) for i in xrange(modes)]
+
+def benchmarks(sizes):
+	'''
+	Every benchmark as (name, size, make input, parse). Size is the number of items parsed, which throughput is measured in.
+	Inputs are made fresh in the process that parses them.
+	'''
+	def seeded(make, *args):
+		return lambda: make(random.Random(size_seed(make.__name__, args)), *args)
+	for size in sizes:
+		yield ("parse_listings", size, seeded(make_listings, size), lambda text: list(gip.parse_listings(text, True)))
+		yield ("parse_episodes", size, seeded(make_tree, size), lambda text: gip.collect_episodes(gip.parse_episodes(text)))
+		yield ("parse_history", size, seeded(make_history, size), lambda text: list(gip.parse_history(text, True)))
+	for versions, modes in [(4, 25), (16, 100), (64, 400)]:
+		size = versions * modes
+		make = seeded(make_info, versions, modes)
+		names = version_names(versions)
+		yield ("parse_info", size, make, lambda text, names=names: gip.parse_info(text, names))
+		def parse_all_modes(info, names=names):
+			return [gip.parse_modes(info, name) for name in names]
+		yield ("parse_modes", size, lambda make=make, names=names: gip.parse_info(make(), names), parse_all_modes)
+	for streams in [100, 1000, 10000]:
+		yield ("parse_streaminfo", streams, seeded(make_streaminfo, streams), gip.parse_streaminfo)
+	for modes in [1000, 10000, 100000]:
+		yield ("combine_modes", modes, seeded(make_mode_pairs, modes), gip.combine_modes)
+
+def size_seed(name, args):
+	return hash((name,) + args) & 0xffffffff
+
+def input_bytes(value):
+	if isinstance(value, basestring):
+		return len(value)
+	return 0 # Parsed structures rather than text, only throughput in items is meaningful
+
+def status_kb(field):
+	'''A memory figure for this process from /proc, in kB, or None where there is no /proc.'''
+	try:
+		with open("/proc/self/status") as status:
+			for line in status:
+				if line.startswith(field + ":"):
+					return int(line.split()[1])
+	except IOError:
+		pass
+	return None
+
+def reset_peak_memory():
+	'''Start measuring peak memory from now, returning the memory in use. Linux lets us reset the peak, elsewhere it includes making the input.'''
+	try:
+		with open("/proc/self/clear_refs", "w") as clear:
+			clear.write("5")
+	except IOError:
+		return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	return status_kb("VmRSS")
+
+def peak_memory():
+	peak = status_kb("VmHWM")
+	return peak if peak is not None else resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def measure(make, parse, repeats):
+	'''Parse in a forked child so each parser's peak memory is its own. Returns the child's measurements.'''
+	read, write = os.pipe()
+	pid = os.fork()
+	if pid == 0:
+		os.close(read)
+		try:
+			data = make()
+			gc.collect()
+			baseline = reset_peak_memory()
+			times = []
+			for _ in xrange(repeats):
+				started = time.time()
+				result = parse(data)
+				times.append(time.time() - started)
+				del result
+			peak = peak_memory()
+			outcome = {"times": times, "peak_kb": peak - baseline, "input_bytes": input_bytes(data)}
+		except Exception as exc:
+			outcome = {"error": "%s: %s" % (type(exc).__name__, exc)}
+		with os.fdopen(write, "w") as out:
+			json.dump(outcome, out)
+		os._exit(0)
+	os.close(write)
+	with os.fdopen(read) as result:
+		outcome = json.load(result)
+	os.waitpid(pid, 0)
+	return outcome
+
+def run(sizes, repeats, only=None):
+	results = {}
+	for name, size, make, parse in benchmarks(sizes):
+		if only and name not in only:
+			continue
+		sys.stderr.write("%s %d...\n" % (name, size))
+		outcome = measure(make, parse, repeats)
+		if "error" in outcome:
+			results.setdefault(name, {})[str(size)] = outcome
+			continue
+		best = min(outcome["times"])
+		results.setdefault(name, {})[str(size)] = {
+			"best_seconds": round(best, 6),
+			"median_seconds": round(sorted(outcome["times"])[len(outcome["times"]) // 2], 6),
+			"items_per_second": round(size / best, 1) if best else None,
+			"mb_per_second": round(outcome["input_bytes"] / best / 1e6, 2) if best and outcome["input_bytes"] else None,
+			"input_bytes": outcome["input_bytes"],
+			"peak_memory_kb": outcome["peak_kb"],
+		}
+	return {
+		"environment": {"python": platform.python_version(), "machine": platform.machine(), "repeats": repeats},
+		"results": results,
+	}
+
+def compare(before, after):
+	'''Print how each benchmark changed between two result files.'''
+	lines = ["%-18s %8s %12s %12s %8s %10s %10s" % ("parser", "size", "before s", "after s", "speedup", "mem before", "mem after")]
+	for name in sorted(set(before["results"]) | set(after["results"])):
+		old_sizes = before["results"].get(name, {})
+		new_sizes = after["results"].get(name, {})
+		for size in sorted(set(old_sizes) | set(new_sizes), key=int):
+			old = old_sizes.get(size, {})
+			new = new_sizes.get(size, {})
+			speedup = ""
+			if old.get("best_seconds") and new.get("best_seconds"):
+				speedup = "%.2fx" % (old["best_seconds"] / new["best_seconds"],)
+			lines.append("%-18s %8s %12s %12s %8s %10s %10s" % (
+				name, size, old.get("best_seconds", "-"), new.get("best_seconds", "-"), speedup,
+				old.get("peak_memory_kb", "-"), new.get("peak_memory_kb", "-")))
+	return "\n".join(lines) + "\n"
+
+def main():
+	parser = argparse.ArgumentParser(description="Benchmark the get_iplayer output parsers.")
+	parser.add_argument("--sizes", help="Comma separated programme counts for listing parsers (default %s)" % (",".join(map(str, DEFAULT_SIZES)),))
+	parser.add_argument("--full", action="store_true", help="Use sizes up to 500k programmes")
+	parser.add_argument("--repeats", type=int, default=3)
+	parser.add_argument("--only", help="Comma separated parsers to run")
+	parser.add_argument("--output", help="Write results to this file rather than stdout")
+	parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="Compare two result files instead of running")
+	args = parser.parse_args()
+
+	if args.compare:
+		with open(args.compare[0]) as before, open(args.compare[1]) as after:
+			sys.stdout.write(compare(json.load(before), json.load(after)))
+		return
+
+	sizes = FULL_SIZES if args.full else DEFAULT_SIZES
+	if args.sizes:
+		sizes = [int(s) for s in args.sizes.split(",")]
+	results = run(sizes, args.repeats, set(args.only.split(",")) if args.only else None)
+	text = json.dumps(results, indent=2, sort_keys=True) + "\n"
+	if args.output:
+		with open(args.output, "w") as out:
+			out.write(text)
+	else:
+		sys.stdout.write(text)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,225 @@
+#!/usr/bin/env python2
+'''
+Drives GetIPlayer through realistic sessions against fake_get_iplayer and reports latency per operation.
+
+	latency_harness.py --programmes 20000 --sessions 20 --startup 0.3 --output run.json
+
+Everything runs offline, so spawning, caching and parsing changes can be compared between runs on any Linux box.
+'''
+
+# totem-get-iplayer
+# Copyright (C) 2013  Andy Gurden
+#
+#     This file is part of totem-get-iplayer.
+#
+#     totem-get-iplayer is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     totem-get-iplayer is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with totem-get-iplayer.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import platform
+from collections import defaultdict
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+FAKE_GETIPLAYER = os.path.join(TOOLS_DIR, "fake_get_iplayer")
+sys.path.insert(0, os.path.join(TOOLS_DIR, "..", "get-iplayer"))
+import getiplayer_interface as gip
+from getiplayer_cache import DEFAULT_CACHE_FIELDS
+
+CHANNELS = ["BBC One", "BBC Two", "BBC Three", "BBC Four", "CBBC", "CBeebies", "BBC News", "BBC Parliament", ""]
+CATEGORIES = ["Comedy", "Drama", "Documentaries", "Factual", "Films", "Music", "News", "Sport", "Children's", "Learning"]
+VERSIONS = ["default", "signed", "audiodescribed", "original"]
+WORDS = ("the of and a to in is you that it he was for on are as with his they at be this have from or one had by word but not what "
+	"all were we when your can said there use an each which she do how their if will up other about out many then them these so").split()
+
+def make_fixture(profile_dir, programmes, seed=0):
+	'''Write a get_iplayer programme cache of the given size into profile_dir, the data fake_get_iplayer answers from.'''
+	rng = random.Random(seed)
+	def words(count):
+		return " ".join(rng.choice(WORDS) for _ in xrange(count)).capitalize()
+	series = [words(3) for _ in xrange(max(1, programmes // 6))]
+	if not os.path.isdir(profile_dir):
+		os.makedirs(profile_dir)
+	with open(os.path.join(profile_dir, "tv.cache"), "w") as cache:
+		cache.write("#" + "|".join(DEFAULT_CACHE_FIELDS) + "|\n")
+		for index in xrange(1, programmes + 1):
+			prog = {
+				"index": str(index), "type": "tv", "name": rng.choice(series), "pid": "b0%07d" % (index,),
+				"available": "2013-03-01T21:00:00Z", "expires": "", "episode": words(4),
+				"seriesnum": str(rng.randint(1, 5)), "episodenum": rng.choice(["", str(rng.randint(1, 20))]),
+				"versions": ",".join(sorted(set(["default"] + rng.sample(VERSIONS, rng.randint(0, 2))))),
+				"duration": str(rng.choice([1800, 3600, 5400])), "desc": words(20), "channel": rng.choice(CHANNELS),
+				"categories": ",".join(rng.sample(CATEGORIES, rng.randint(0, 3))),
+				"thumbnail": "http://fake.invalid/%d.jpg" % (index,), "timeadded": "1362000000", "guidance": "", "web": "",
+			}
+			cache.write("|".join(prog[field] for field in DEFAULT_CACHE_FIELDS) + "|\n")
+
+def percentile(ordered, fraction):
+	if not ordered:
+		return None
+	return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+class Recorder(object):
+	'''Collects how long each operation took, and whether it failed.'''
+
+	def __init__(self):
+		self.times = defaultdict(list)
+		self.errors = defaultdict(int)
+
+	def measure(self, operation, start):
+		'''Run start() for a pending result and wait for it, recording the time taken. Returns the result or None on error.'''
+		started = time.time()
+		try:
+			pending = start()
+			result = pending.get_result()
+			errors = pending.get_errors()
+		except Exception as exc:
+			result, errors = None, [str(exc)]
+		self.times[operation].append(time.time() - started)
+		if errors:
+			self.errors[operation] += 1
+			return None
+		return result
+
+	def report(self):
+		report = {}
+		for operation, times in sorted(self.times.iteritems()):
+			ordered = sorted(times)
+			report[operation] = {
+				"count": len(ordered),
+				"errors": self.errors[operation],
+				"mean_ms": round(1000 * sum(ordered) / len(ordered), 2),
+				"p50_ms": round(1000 * percentile(ordered, 0.5), 2),
+				"p99_ms": round(1000 * percentile(ordered, 0.99), 2),
+				"max_ms": round(1000 * ordered[-1], 2),
+			}
+		return report
+
+def browse(gipl, recorder, rng):
+	'''Walk down the filter levels as the sidebar does, then open a few programmes' information.'''
+	filters = {}
+	for level in ["type", "channel", "category"]:
+		values = recorder.measure("filters_" + level, lambda: gipl.get_filters_and_blanks(level, **filters))
+		if not values:
+			return None
+		filters[level] = rng.choice(values)
+	episodes = recorder.measure("episodes", lambda: gipl.get_episodes(**filters))
+	if not episodes:
+		return None
+	chosen = None
+	for _ in xrange(3):
+		series = rng.choice(list(episodes))
+		index, _ = rng.choice(episodes[series])
+		info = recorder.measure("info", lambda: gipl.get_programme_info(index))
+		if info:
+			chosen = (index, info)
+	return chosen
+
+def play(gipl, recorder, index, info):
+	'''Look up the streams for a programme, then stream it and read everything that arrives.'''
+	version = info.get("versions", "default").split(",")[0] or "default"
+	recorder.measure("streaminfo", lambda: gipl.get_stream_info(index, version))
+	started = time.time()
+	rfd, streamresult = gipl.stream_programme_to_pipe(index, version)
+	first = os.read(rfd, 65536)
+	recorder.times["stream_first_byte"].append(time.time() - started)
+	received = len(first)
+	while True:
+		data = os.read(rfd, 65536)
+		if not data:
+			break
+		received += len(data)
+	recorder.times["stream_complete"].append(time.time() - started)
+	if not received:
+		recorder.errors["stream_complete"] += 1
+
+def record(gipl, recorder, index, info):
+	version = info.get("versions", "default").split(",")[0] or "default"
+	recorder.measure("record", lambda: gipl.record_programme(index, version=version))
+	recorder.measure("history", lambda: gipl.get_history())
+
+def run(args):
+	workdir = tempfile.mkdtemp(prefix="fake-get-iplayer-")
+	try:
+		profile = os.path.join(workdir, "profile")
+		make_fixture(profile, args.programmes, args.seed)
+		os.environ["FAKE_GETIPLAYER_STARTUP"] = str(args.startup)
+		os.environ["FAKE_GETIPLAYER_ERROR_RATE"] = str(args.error_rate)
+		os.environ["FAKE_GETIPLAYER_MEDIA_BYTES"] = str(args.media_bytes)
+		os.environ["FAKE_GETIPLAYER_SEED"] = str(args.seed)
+		if args.rate:
+			os.environ["FAKE_GETIPLAYER_RATE"] = str(args.rate)
+		os.environ["PERL5LIB"] = TOOLS_DIR + (os.pathsep + os.environ["PERL5LIB"] if os.environ.get("PERL5LIB") else "")
+
+		recorder = Recorder()
+		started = time.time()
+		gipl = gip.GetIPlayer(
+			FAKE_GETIPLAYER, output_location=os.path.join(workdir, "recordings"), profile_dir=profile,
+			native_cache=args.native, execution=args.execution)
+		recorder.times["startup"].append(time.time() - started)
+		os.makedirs(gipl.output_location)
+		rng = random.Random(args.seed)
+		try:
+			for session in xrange(args.sessions):
+				chosen = browse(gipl, recorder, rng)
+				if chosen is None:
+					continue
+				if session % 2 == 0:
+					play(gipl, recorder, *chosen)
+				if session % 3 == 0:
+					record(gipl, recorder, *chosen)
+		finally:
+			gipl.close()
+		return {
+			"configuration": {
+				"programmes": args.programmes, "sessions": args.sessions, "execution": args.execution,
+				"native_cache": args.native, "startup": args.startup, "rate": args.rate,
+				"error_rate": args.error_rate, "media_bytes": args.media_bytes, "seed": args.seed,
+				"python": platform.python_version(),
+			},
+			"total_seconds": round(time.time() - started, 2),
+			"operations": recorder.report(),
+			"scheduler": gipl.scheduler.stats(),
+		}
+	finally:
+		shutil.rmtree(workdir, True)
+
+def main():
+	parser = argparse.ArgumentParser(description="Measure GetIPlayer latency against a fake get_iplayer.")
+	parser.add_argument("--programmes", type=int, default=5000, help="Programmes in the fixture cache")
+	parser.add_argument("--sessions", type=int, default=10, help="Browse sessions to run, some also play and record")
+	parser.add_argument("--execution", choices=["pool", "popen"], default="pool", help="How GetIPlayer runs get_iplayer")
+	parser.add_argument("--native", action="store_true", help="Let GetIPlayer answer listings from the cache files itself")
+	parser.add_argument("--startup", type=float, default=0.2, help="Seconds the fake takes to start")
+	parser.add_argument("--rate", type=int, default=0, help="Bytes per second the fake writes at, 0 for unlimited")
+	parser.add_argument("--error-rate", type=float, default=0.0, help="Chance of each command failing")
+	parser.add_argument("--media-bytes", type=int, default=1024*1024, help="Size of streams and recordings")
+	parser.add_argument("--seed", type=int, default=0)
+	parser.add_argument("--output", help="Write the report to this file rather than stdout")
+	args = parser.parse_args()
+
+	text = json.dumps(run(args), indent=2, sort_keys=True) + "\n"
+	if args.output:
+		with open(args.output, "w") as out:
+			out.write(text)
+	else:
+		sys.stdout.write(text)
+
+if __name__ == "__main__":
+	main()